@@ -0,0 +1,282 @@
+import difflib
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+# Scripts pulled out of LLM responses are stored by the sha256 of their
+# content, and every session keeps a version lineage per script name. Execution
+# results are memoized on (script hash, command, inputs), so a refinement loop
+# that regenerates a byte-identical script does not run it again. Callers
+# put the session and the resolved limits in the inputs, so a result is only
+# reused by the session that ran the script, under the same limits, and for
+# at most `result_ttl` seconds.
+#
+# On-disk layout under ARTIFACT_DIR:
+#   blobs/ab/<sha256>.<ext>         script contents
+#   results/ab/<key>.json           memoized execution results
+#   lineage/<session>.jsonl         one line per saved version
+#
+# Blobs and results are evicted oldest-used first once they exceed max_bytes.
+# Lineage logs are tiny and kept; diffs against an evicted blob return None.
+
+CODE_BLOCK = re.compile(r'```[ \t]*([\w+-]*)[^\n]*\n(.*?)```', re.DOTALL)
+
+LANGUAGES = {
+    'python': 'python', 'py': 'python', 'python3': 'python',
+    'bash': 'bash', 'sh': 'bash', 'shell': 'bash', 'zsh': 'bash',
+}
+EXTENSIONS = {'python': 'py', 'bash': 'sh'}
+
+# Only outcomes the script itself decides are memoized. Timeouts, kills,
+# spawn errors and cancelled runs are worth retrying, and so are failures,
+# which may come from something outside the script such as the network.
+CACHED_STATUSES = ('ok', 'cpu_limit', 'memory_limit', 'file_size_limit')
+
+
+def extract_code_blocks(text):
+    # Returns [(language, code)] for fenced blocks in a language we can run.
+    blocks = []
+    for tag, code in CODE_BLOCK.findall(text or ''):
+        language = LANGUAGES.get(tag.lower())
+        if language and code.strip():
+            blocks.append((language, code))
+    return blocks
+
+
+def content_hash(code):
+    return hashlib.sha256(code.encode('utf-8')).hexdigest()
+
+
+def result_key(script_hash, command, inputs=None):
+    payload = {'script': script_hash, 'command': command, 'inputs': inputs or {}}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ArtifactStore:
+
+    def __init__(self, root, max_bytes=256 * 1024 * 1024, result_ttl=3600):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.result_ttl = result_ttl
+        self.lock = threading.Lock()
+        self.lineage = {}  # session -> name -> [version record]
+        self.counters = {'saved': 0, 'deduplicated': 0, 'result_hits': 0, 'result_misses': 0, 'result_expired': 0,
+                         'evictions': 0}
+        for sub in ('blobs', 'results', 'lineage'):
+            os.makedirs(os.path.join(root, sub), exist_ok=True)
+        self.total_bytes = sum(size for _, _, size in self._stored_files())
+
+    # Scripts
+
+    def save_script(self, session_id, name, language, code):
+        # Stores `code` and appends it to the session's lineage for `name`
+        # unless it is identical to the latest version. Returns the record.
+        digest = content_hash(code)
+        path = self._blob_path(digest, language)
+        if not os.path.exists(path):
+            self._write(path, code)
+
+        with self.lock:
+            versions = self._versions(session_id, name)
+            if versions and versions[-1]['hash'] == digest:
+                self.counters['deduplicated'] += 1
+                return versions[-1]
+            record = {
+                'name': name,
+                'version': len(versions) + 1,
+                'language': language,
+                'hash': digest,
+                'parent': versions[-1]['hash'] if versions else None,
+                'created': time.time(),
+            }
+            versions.append(record)
+            self.counters['saved'] += 1
+            with open(self._lineage_path(session_id), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + '\n')
+            return record
+
+    def save_from_response(self, session_id, llm_response):
+        # Saves every runnable block of a response and returns [(record, code)].
+        # Blocks are named by language and position, so "the first python
+        # block" of successive responses forms one lineage.
+        saved = []
+        positions = defaultdict(int)
+        for language, code in extract_code_blocks(llm_response):
+            positions[language] += 1
+            saved.append((self.save_script(session_id, f'{language}-{positions[language]}', language, code), code))
+        return saved
+
+    def read_script(self, digest, language):
+        path = self._blob_path(digest, language)
+        try:
+            with open(path, encoding='utf-8') as f:
+                code = f.read()
+        except FileNotFoundError:
+            return None
+        self._touch(path)
+        return code
+
+    def versions(self, session_id, name):
+        with self.lock:
+            return list(self._versions(session_id, name))
+
+    def diff(self, session_id, name, old_version=None, new_version=None):
+        # Unified diff between two versions of a script, by default the last
+        # two. Returns None if either version or its blob is gone.
+        versions = self.versions(session_id, name)
+        new_version = new_version or len(versions)
+        old_version = old_version or new_version - 1
+        if not (1 <= old_version <= len(versions) and 1 <= new_version <= len(versions)):
+            return None
+        old, new = versions[old_version - 1], versions[new_version - 1]
+        if old['hash'] == new['hash']:
+            return ''
+        old_code = self.read_script(old['hash'], old['language'])
+        new_code = self.read_script(new['hash'], new['language'])
+        if old_code is None or new_code is None:
+            return None
+        return ''.join(difflib.unified_diff(
+            old_code.splitlines(keepends=True), new_code.splitlines(keepends=True),
+            fromfile=f"{name}@{old['version']}", tofile=f"{name}@{new['version']}"))
+
+    def forget_session(self, session_id):
+        # Drops the lineage only; blobs may be shared with other sessions and
+        # are left to eviction.
+        with self.lock:
+            self.lineage.pop(session_id, None)
+            try:
+                os.remove(self._lineage_path(session_id))
+            except FileNotFoundError:
+                pass
+
+    # Execution results
+
+    def get_result(self, key):
+        path = self._result_path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                result = json.load(f)
+        except FileNotFoundError:
+            with self.lock:
+                self.counters['result_misses'] += 1
+            return None
+        memoized_at = result.pop('memoized_at', 0)
+        if time.time() - memoized_at > self.result_ttl:
+            with self.lock:
+                self.counters['result_misses'] += 1
+                self.counters['result_expired'] += 1
+            return None
+        self._touch(path)
+        with self.lock:
+            self.counters['result_hits'] += 1
+        return result
+
+    def put_result(self, key, result):
+        if result.get('status') not in CACHED_STATUSES:
+            return
+        self._write(self._result_path(key), json.dumps(dict(result, memoized_at=time.time())))
+
+    def run(self, record, code, command, execute, inputs=None):
+        # Returns (result, cached). `execute(code)` runs the script and
+        # returns the executor's result dict. `inputs` holds whatever else the
+        # result depends on, at least the session and the limits.
+        key = result_key(record['hash'], command, inputs)
+        result = self.get_result(key)
+        if result is not None:
+            return result, True
+        result = execute(code)
+        self.put_result(key, result)
+        return result, False
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, bytes=self.total_bytes, max_bytes=self.max_bytes,
+                        sessions=len(self.lineage))
+
+    # Storage
+
+    def _versions(self, session_id, name):
+        # Caller holds the lock. Lineage is loaded from disk on first use.
+        if session_id not in self.lineage:
+            loaded = defaultdict(list)
+            try:
+                with open(self._lineage_path(session_id), encoding='utf-8') as f:
+                    for line in f:
+                        record = json.loads(line)
+                        loaded[record['name']].append(record)
+            except FileNotFoundError:
+                pass
+            self.lineage[session_id] = loaded
+        return self.lineage[session_id][name]
+
+    def _blob_path(self, digest, language):
+        return os.path.join(self.root, 'blobs', digest[:2], f'{digest}.{EXTENSIONS.get(language, "txt")}')
+
+    def _result_path(self, key):
+        return os.path.join(self.root, 'results', key[:2], f'{key}.json')
+
+    def _lineage_path(self, session_id):
+        safe = re.sub(r'[^\w.-]', '_', str(session_id))
+        return os.path.join(self.root, 'lineage', f'{safe}.jsonl')
+
+    def _write(self, path, text):
+        data = text.encode('utf-8')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        try:
+            previous = os.path.getsize(path)
+        except FileNotFoundError:
+            previous = 0
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.total_bytes += len(data) - previous
+            over = self.total_bytes > self.max_bytes
+        if over:
+            self._evict()
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def _stored_files(self):
+        for sub in ('blobs', 'results'):
+            for directory, _, names in os.walk(os.path.join(self.root, sub)):
+                for filename in names:
+                    path = os.path.join(directory, filename)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield path, stat.st_mtime, stat.st_size
+
+    def _evict(self):
+        # Removes least recently used files until we are under 90% of the
+        # budget, so eviction does not run on every write near the limit.
+        target = self.max_bytes * 0.9
+        for path, _, size in sorted(self._stored_files(), key=lambda item: item[1]):
+            with self.lock:
+                if self.total_bytes <= target:
+                    return
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            with self.lock:
+                self.total_bytes -= size
+                self.counters['evictions'] += 1
+
+
+artifacts = ArtifactStore(
+    os.environ.get('ARTIFACT_DIR', os.path.join(tempfile.gettempdir(), 'llmtoolcraft-artifacts')),
+    max_bytes=int(os.environ.get('ARTIFACT_MAX_BYTES', 256 * 1024 * 1024)),
+    result_ttl=float(os.environ.get('ARTIFACT_RESULT_TTL', 3600)),
+)
@@ -0,0 +1,231 @@
+import argparse
+import importlib
+import json
+import os
+import threading
+import time
+
+import telemetry
+from artifacts import extract_code_blocks
+from craft_sm import CRAFT_MODEL, ToolCraftingProcess
+from llm_client import llm
+
+# Crafts tools without a browser: every line of a JSONL file is one
+# requirement, run through the whole state machine by a pool of workers.
+#
+#   python batch.py tools.jsonl --output results.jsonl --workers 8
+#
+# Input lines look like
+#   {"id": "weather", "requirement": "A tool that reports the weather for a city.",
+#    "responses": {"review": ["Also show the wind speed."]}}
+# where "id" defaults to the line number and "responses" is optional.
+#
+# Every interaction ends waiting for a person, usually in one of the review
+# states. A responder answers for them: responder(job, state, response) gets
+# the job, the state the process is waiting in and the response it is
+# waiting on, and returns the reply, or None to stop the job there.
+# 'scripted' (the default) sends the job's own "responses" for the state in
+# order and approves once they run out; 'approve' always approves;
+# --responder module:function uses any other callable.
+#
+# One result line is appended to --output as each job finishes: its status
+# ('completed' when it reached the end state, 'stopped' or 'failed'), final
+# state and outcome, the transcript and state steps, script iterations,
+# timings and the last script. Running the same command again skips jobs that
+# already have a result, except failed ones, which are retried; the last line
+# for an id is the current one.
+
+BATCH_MAX_TURNS = int(os.environ.get('BATCH_MAX_TURNS', 12))
+
+# The reply in states without an approval, e.g. after a script analysis or
+# an interaction that stopped at its step or time budget.
+CONTINUE = "Continue."
+
+APPROVALS = {
+    'review': "The proposal looks good. Please implement it.",
+    'final_review': "The tool works as intended. Approved, we are done.",
+}
+
+OUTCOMES = {'finalize_success': 'success', 'finalize_timeup': 'timeup'}
+
+
+def approve(job, state, response):
+    return APPROVALS.get(state, CONTINUE)
+
+
+def scripted(job, state, response):
+    replies = job.responses.get(state)
+    if replies:
+        return replies.pop(0)
+    return approve(job, state, response)
+
+
+RESPONDERS = {'approve': approve, 'scripted': scripted}
+
+
+def load_responder(name):
+    if name in RESPONDERS:
+        return RESPONDERS[name]
+    module, _, attribute = name.partition(':')
+    if not attribute:
+        raise ValueError(f"Unknown responder {name!r}; use one of {sorted(RESPONDERS)} or module:function")
+    return getattr(importlib.import_module(module), attribute)
+
+
+class Job:
+
+    def __init__(self, job_id, requirement, responses=None):
+        self.id = job_id
+        self.requirement = requirement
+        # Copied, since the scripted responder consumes them.
+        self.responses = {state: list(replies) for state, replies in (responses or {}).items()}
+
+
+def read_jobs(path):
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            spec = json.loads(line)
+            yield Job(str(spec.get('id', number)), spec['requirement'], spec.get('responses'))
+
+
+def finished_ids(path, retry_failed=True):
+    # The ids that already have a result in `path`. A line cut short by a
+    # crash is ignored, so its job runs again.
+    status = {}
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                status[result['id']] = result['status']
+    except FileNotFoundError:
+        pass
+    return {job_id for job_id, value in status.items() if not (retry_failed and value == 'failed')}
+
+
+def craft(job, responder=scripted, max_turns=BATCH_MAX_TURNS, session_prefix='batch'):
+    # Runs one job to the end state, or until the responder gives up or
+    # `max_turns` interactions have run. Returns its result record.
+    process = ToolCraftingProcess(f'{session_prefix}:{job.id}')
+    history = []
+    steps = []
+    turns = []
+    script_response = None
+
+    def on_event(event, payload):
+        nonlocal script_response
+        if event != 'step':
+            return
+        steps.append({'state': payload['state'], 'next_state': payload['next_state'],
+                      'action_type': payload['action_type'],
+                      'trigger': payload['output'] if payload['action_type'] == 'classification' else None})
+        if payload['state'] == 'script_design_and_execution':
+            script_response = payload['output']
+
+    started = time.time()
+    status, error, message = 'stopped', None, job.requirement
+    with telemetry.labelled(route='batch'):
+        try:
+            for _ in range(max_turns):
+                state = process.state
+                turn_started = time.perf_counter()
+                response = process.process_interaction(message, message_history=history, on_event=on_event)
+                turns.append({'state': state, 'next_state': process.state, 'message': message,
+                              'seconds': time.perf_counter() - turn_started})
+                if process.state == 'end':
+                    status = 'completed'
+                    break
+                message = responder(job, process.state, response)
+                if message is None:
+                    break
+        except Exception as e:
+            status, error = 'failed', f'{type(e).__name__}: {e}'
+
+    outcomes = [OUTCOMES[step['state']] for step in steps if step['state'] in OUTCOMES]
+    return {
+        'id': job.id,
+        'requirement': job.requirement,
+        'status': status,
+        'error': error,
+        'final_state': process.state,
+        'outcome': outcomes[-1] if outcomes else None,
+        'iterations': sum(1 for step in steps if step['state'] == 'script_design_and_execution'),
+        'turns': turns,
+        'steps': steps,
+        'transcript': history,
+        'script': [{'language': language, 'code': code} for language, code in extract_code_blocks(script_response)],
+        'last_execution': process.last_execution and {key: process.last_execution.get(key)
+                                                      for key in ('status', 'returncode', 'duration')},
+        'prompt_eval_tokens': process.prompt_eval_tokens,
+        'started': started,
+        'seconds': time.time() - started,
+    }
+
+
+def run_batch(jobs, output, workers=None, responder=scripted, max_turns=BATCH_MAX_TURNS, retry_failed=True,
+              on_result=None):
+    # Crafts every job in `jobs` without a result in `output` yet, on
+    # `workers` threads, appending each result as soon as it is ready.
+    # Returns {status: count} for the jobs run.
+    if workers is None:
+        # While some jobs run scripts, the others keep the model busy.
+        workers = 2 * llm.limiter(CRAFT_MODEL).limit
+    done = finished_ids(output, retry_failed)
+    pending = (job for job in jobs if job.id not in done)
+    lock = threading.Lock()
+    counts = {}
+
+    with open(output, 'a+', encoding='utf-8') as out:
+        if out.tell():
+            # Start on a fresh line after a result cut short by a crash.
+            out.seek(out.tell() - 1)
+            if out.read(1) != '\n':
+                out.write('\n')
+
+        def worker():
+            while True:
+                with lock:
+                    job = next(pending, None)
+                if job is None:
+                    return
+                result = craft(job, responder, max_turns)
+                with lock:
+                    out.write(json.dumps(result) + '\n')
+                    out.flush()
+                    counts[result['status']] = counts.get(result['status'], 0) + 1
+                    if on_result is not None:
+                        on_result(result)
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Craft the tools in a JSONL file of requirements.')
+    parser.add_argument('input', help='JSONL file with one requirement per line')
+    parser.add_argument('--output', required=True, help='results are appended here; rerunning resumes')
+    parser.add_argument('--workers', type=int, help='concurrent jobs (default: twice the craft model concurrency)')
+    parser.add_argument('--responder', default='scripted', help='approve, scripted or module:function')
+    parser.add_argument('--max-turns', type=int, default=BATCH_MAX_TURNS)
+    parser.add_argument('--no-retry-failed', action='store_true', help='skip jobs whose last result failed')
+    args = parser.parse_args()
+
+    def report(result):
+        print(f"{result['id']}: {result['status']} in {result['final_state']} after {result['seconds']:.1f}s"
+              + (f" ({result['error']})" if result['error'] else ''), flush=True)
+
+    counts = run_batch(read_jobs(args.input), args.output, args.workers, load_responder(args.responder),
+                       args.max_turns, not args.no_retry_failed, on_result=report)
+    print(json.dumps(counts))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+# Connections per process: the threaded server (run.py) vs the asyncio server
+# (run_async.py).
+#
+#   python benchmarks/bench_connections.py --connections 2000 --streams 60
+#
+# For each server, starts it against benchmarks/fake_ollama.py and opens
+# `--connections` Socket.IO connections, each with its own session, in steps
+# of `--step`. After every step it records the server's RSS, threads and open
+# file descriptors. With all connections open, `--streams` of them call
+# /generate at once against a slow model (`--rate` tokens/s) and the report
+# has their time to first chunk and completion time (more than the chat
+# lane's queue, 64 jobs, are partly rejected with 429). A server that stops
+# accepting connections is recorded with the step it failed at. Needs
+# aiohttp for the clients: pip install aiohttp "python-socketio[asyncio_client]".
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import aiohttp
+import socketio
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_ollama
+import load_test
+
+
+def proc_status(pid):
+    values = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in ('VmRSS', 'Threads'):
+                    values[name] = int(value.split()[0])
+        values['fds'] = len(os.listdir(f'/proc/{pid}/fd'))
+    except OSError:
+        return None
+    return {'rss_bytes': values.get('VmRSS', 0) * 1024, 'threads': values.get('Threads'), 'fds': values['fds']}
+
+
+class Connection:
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.http = None
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.first_chunk = None
+        self.completed = asyncio.Event()
+        self.sio.on('response_chunk', self.on_chunk)
+        self.sio.on('response_complete', self.on_complete)
+
+    async def on_chunk(self, data):
+        if self.first_chunk is None:
+            self.first_chunk = time.monotonic()
+
+    async def on_complete(self, data=None):
+        self.completed.set()
+
+    async def open(self, timeout):
+        # unsafe=True: the jar drops cookies set by IP-address hosts otherwise.
+        self.http = aiohttp.ClientSession(base_url=self.base_url, cookie_jar=aiohttp.CookieJar(unsafe=True),
+                                          timeout=aiohttp.ClientTimeout(total=timeout))
+        async with self.http.get('/') as response:
+            await response.read()
+        cookie = '; '.join(f'{c.key}={c.value}' for c in self.http.cookie_jar)
+        await self.sio.connect(self.base_url, headers={'Cookie': cookie}, transports=['websocket'],
+                               wait_timeout=timeout)
+
+    async def generate(self, timeout):
+        self.first_chunk = None
+        self.completed.clear()
+        start = time.monotonic()
+        async with self.http.post('/generate', data={'prompt': 'Stream something slowly.'}) as response:
+            if response.status == 429:
+                return None
+        await asyncio.wait_for(self.completed.wait(), timeout)
+        return {'ttft': (self.first_chunk or time.monotonic()) - start, 'e2e': time.monotonic() - start}
+
+    async def close(self):
+        try:
+            await self.sio.disconnect()
+        finally:
+            if self.http is not None:
+                await self.http.close()
+
+
+async def drive(base_url, pid, args):
+    connections = []
+    steps = []
+    baseline = proc_status(pid)
+    failed_at = None
+    try:
+        while len(connections) < args.connections:
+            batch = [Connection(base_url) for _ in range(min(args.step, args.connections - len(connections)))]
+            start = time.monotonic()
+            results = await asyncio.gather(*(c.open(args.timeout) for c in batch), return_exceptions=True)
+            opened = [c for c, result in zip(batch, results) if not isinstance(result, Exception)]
+            connections.extend(opened)
+            errors = [f'{type(r).__name__}: {r}' for r in results if isinstance(r, Exception)]
+            steps.append(dict(proc_status(pid) or {}, connections=len(connections),
+                              connect_seconds=time.monotonic() - start, errors=errors[:3]))
+            if errors:
+                failed_at = len(connections) + len(errors)
+                for c in batch:
+                    if c not in opened:
+                        await c.close()
+                break
+        await asyncio.sleep(1)
+        idle = proc_status(pid)
+
+        streams = None
+        if connections and args.streams:
+            start = time.monotonic()
+            results = await asyncio.gather(*(c.generate(args.timeout) for c in connections[:args.streams]),
+                                           return_exceptions=True)
+            done = [r for r in results if isinstance(r, dict)]
+            streams = {
+                'requested': min(args.streams, len(connections)),
+                'completed': len(done),
+                'rejected': sum(1 for r in results if r is None),
+                'errors': [f'{type(r).__name__}: {r}' for r in results if isinstance(r, Exception)][:3],
+                'seconds': time.monotonic() - start,
+                'ttft': load_test.percentiles([r['ttft'] for r in done]),
+                'e2e': load_test.percentiles([r['e2e'] for r in done]),
+                'server': proc_status(pid),
+            }
+    finally:
+        await asyncio.gather(*(c.close() for c in connections), return_exceptions=True)
+
+    opened = len(connections)
+    return {
+        'baseline': baseline,
+        'steps': steps,
+        'connections': opened,
+        'failed_at': failed_at,
+        'idle': idle,
+        'bytes_per_connection': (idle['rss_bytes'] - baseline['rss_bytes']) / opened if opened and idle else None,
+        'threads_per_connection': (idle['threads'] - baseline['threads']) / opened if opened and idle else None,
+        'streams': streams,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Open connections per process, threaded vs asyncio server.')
+    parser.add_argument('--servers', default='threaded,async')
+    parser.add_argument('--connections', type=int, default=2000)
+    parser.add_argument('--step', type=int, default=250)
+    parser.add_argument('--streams', type=int, default=60)
+    parser.add_argument('--ttft', type=float, default=0.5)
+    parser.add_argument('--rate', type=float, default=10.0)
+    parser.add_argument('--tokens', type=int, default=50)
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--output', help='write the JSON report here')
+    args = parser.parse_args()
+
+    # Every stream gets a model slot and a scheduler worker, so neither the
+    # model nor the job queue is the bottleneck.
+    env = {'LLM_DEFAULT_CONCURRENCY': str(max(args.streams, 1)), 'SCHEDULER_WORKERS': str(max(args.streams, 4))}
+    config = fake_ollama.FakeOllamaConfig(args.ttft, args.rate, args.tokens)
+    ollama_server = fake_ollama.start(0, config)
+    report = {'commit': load_test.git_commit(), 'settings': vars(args), 'servers': {}}
+    try:
+        for server in args.servers.split(','):
+            app = load_test.start_app(args.port, f'http://127.0.0.1:{ollama_server.server_port}', env, server)
+            try:
+                report['servers'][server] = asyncio.run(drive(f'http://127.0.0.1:{args.port}', app.pid, args))
+            finally:
+                app.terminate()
+                app.wait()
+    finally:
+        ollama_server.shutdown()
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# Prompt size per refinement loop with the whole history vs. state-scoped
+# context selection.
+#
+#   python benchmarks/bench_context.py --iterations 10
+#
+# Builds the history a session accumulates when every script fails and is
+# refined, the way ToolCraftingProcess.step writes it, and reports the
+# estimated prompt tokens that script_design_and_execution would send at each
+# iteration, plus the time it takes to select the context.
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import craft_context
+from craft_sm import SPEC
+from history import message_tokens
+
+
+def text(label, tokens):
+    return (label + ' ') * (tokens * 4 // (len(label) + 1))
+
+
+def build_history(iterations, proposal_tokens, script_tokens, result_tokens, analysis_tokens):
+    entry = craft_context.entry
+    history = [
+        entry('user', text('requirement', 80), state='requirement_proposal'),
+        entry('assistant', text('proposal', proposal_tokens), state='requirement_proposal'),
+        entry('user', text('feedback', 40), state='proposal_refinement'),
+        entry('assistant', text('refined', proposal_tokens), state='proposal_refinement'),
+    ]
+    snapshots = []
+    feedback = text('looks good', 10)
+    for _ in range(iterations):
+        snapshots.append(list(history))
+        history.append(entry('user', feedback, state='script_design_and_execution'))
+        history.append(entry('assistant', text('script', script_tokens), state='script_design_and_execution'))
+        history.append(entry('user', text('traceback', result_tokens), state='script_analysis_and_refinement'))
+        history.append(entry('assistant', text('analysis', analysis_tokens), state='script_analysis_and_refinement'))
+        feedback = text('please fix', 10)
+    return snapshots
+
+
+def prompt_tokens(history, mode):
+    state = 'script_design_and_execution'
+    messages = [{'role': 'system', 'content': SPEC.system_messages[state]}]
+    messages.extend(craft_context.select(history, state, mode=mode))
+    return sum(message_tokens(message) for message in messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Craft prompt size with full vs scoped history.')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--proposal-tokens', type=int, default=400)
+    parser.add_argument('--script-tokens', type=int, default=600)
+    parser.add_argument('--result-tokens', type=int, default=300)
+    parser.add_argument('--analysis-tokens', type=int, default=300)
+    args = parser.parse_args()
+
+    snapshots = build_history(args.iterations, args.proposal_tokens, args.script_tokens, args.result_tokens,
+                              args.analysis_tokens)
+    rows = []
+    for iteration, history in enumerate(snapshots, 1):
+        start = time.perf_counter()
+        scoped = prompt_tokens(history, 'scoped')
+        select_us = (time.perf_counter() - start) * 1e6
+        rows.append({'iteration': iteration, 'history_messages': len(history),
+                     'full_tokens': prompt_tokens(history, 'full'), 'scoped_tokens': scoped,
+                     'select_us': select_us})
+    report = {
+        'iterations': rows,
+        'last_full_tokens': rows[-1]['full_tokens'],
+        'last_scoped_tokens': rows[-1]['scoped_tokens'],
+        'reduction': 1 - rows[-1]['scoped_tokens'] / rows[-1]['full_tokens'],
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
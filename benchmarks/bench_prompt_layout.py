@@ -0,0 +1,59 @@
+# Measures prompt evaluation per craft call for both prompt layouts.
+#
+#   CRAFT_CONTEXT=full CRAFT_MODEL=llama3.1:70b python benchmarks/bench_prompt_layout.py
+#
+# Without CRAFT_CONTEXT=full each state sends its own selection of the
+# history, and prefix_stable can only reuse the shared preamble.
+# Requires a running Ollama. The same scripted conversation is run through a
+# fresh ToolCraftingProcess once per layout, and the prompt_eval_count and
+# prompt_eval_duration Ollama reports for every call are printed and summed.
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from craft_sm import ToolCraftingProcess
+
+DEFAULT_CONVERSATION = [
+    "I need a command line tool that prints the ten largest files under a directory, with human readable sizes.",
+    "Please also allow excluding directories by glob pattern.",
+    "Looks good, go ahead and implement it.",
+]
+
+
+def run(layout, conversation):
+    process = ToolCraftingProcess(session_id=f'bench-{layout}', prompt_layout=layout)
+    process.prompt_eval_log = []  # every call, not just the last few
+    history = []
+    for message in conversation:
+        process.process_interaction(message, message_history=history)
+    return process.prompt_eval_log
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare prompt evaluation cost of the craft prompt layouts.')
+    parser.add_argument('--conversation', help='JSON file with a list of user messages')
+    parser.add_argument('--layouts', default='state_first,prefix_stable')
+    args = parser.parse_args()
+
+    conversation = DEFAULT_CONVERSATION
+    if args.conversation:
+        with open(args.conversation) as f:
+            conversation = json.load(f)
+
+    for layout in args.layouts.split(','):
+        log = run(layout, conversation)
+        print(f"\n{layout}")
+        for entry in log:
+            duration_ms = (entry['prompt_eval_duration'] or 0) / 1e6
+            print(f"  {entry['state']:<32} messages={entry['messages']:<3} "
+                  f"prompt_eval_count={entry['prompt_eval_count']!s:<6} prompt_eval={duration_ms:8.1f} ms")
+        total_tokens = sum(entry['prompt_eval_count'] or 0 for entry in log)
+        total_ms = sum(entry['prompt_eval_duration'] or 0 for entry in log) / 1e6
+        print(f"  total: {len(log)} calls, {total_tokens} prompt tokens evaluated, {total_ms:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
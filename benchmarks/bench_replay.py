@@ -0,0 +1,152 @@
+# Craft sessions without a model: records one session, then replays it.
+#
+#   python benchmarks/bench_replay.py record session.llm
+#   python benchmarks/bench_replay.py replay session.llm --sessions 200 --workers 8 --speed max
+#
+# `record` runs one tool requirement through the state machine (batch.craft,
+# approving every review) against benchmarks/fake_ollama.py, or a real
+# Ollama with --ollama, and writes the calls to the recording (llm_record.py).
+# `replay` runs `--sessions` copies of that session against the recording and
+# reports sessions and steps per second and the time per step by state, so
+# the Python side of process_interaction (history handling, prompt building,
+# script runs, telemetry) is measured on its own. `--speed max` drops the
+# recorded model delays; `--profile out.prof` also writes a cProfile of the
+# run and prints its top functions. The same recording drives the servers:
+# LLM_REPLAY=session.llm python run.py (or benchmarks/load_test.py --env).
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+REQUIREMENT = 'Make a tool that reports the weather for a city.'
+
+
+def configure(env):
+    # llm_client reads its settings at import, so they are set before the
+    # app's modules are imported. The generated scripts are run, unless
+    # CRAFT_EXECUTE_SCRIPTS=0 is set.
+    os.environ.setdefault('CRAFT_EXECUTE_SCRIPTS', '1')
+    os.environ.update(env, LLM_CACHE='0')
+    import batch
+    import llm_client
+    return batch, llm_client
+
+
+def record(args):
+    server = None
+    if args.ollama:
+        host = args.ollama
+    else:
+        import fake_ollama
+        server = fake_ollama.start(0, fake_ollama.FakeOllamaConfig(args.ttft, args.rate, args.tokens))
+        host = f'http://127.0.0.1:{server.server_port}'
+    if os.path.exists(args.recording):
+        os.remove(args.recording)
+    batch, llm_client = configure({'OLLAMA_HOST': host, 'LLM_RECORD': args.recording})
+    try:
+        result = batch.craft(batch.Job('recorded', args.requirement), batch.approve)
+    finally:
+        if server is not None:
+            server.shutdown()
+    return {'status': result['status'], 'final_state': result['final_state'], 'seconds': result['seconds'],
+            'steps': len(result['steps']), 'recording': llm_client.llm.client.stats(),
+            'bytes': os.path.getsize(args.recording)}
+
+
+def replay(args):
+    batch, llm_client = configure({'LLM_REPLAY': args.recording, 'LLM_REPLAY_SPEED': args.speed,
+                                   'LLM_DEFAULT_CONCURRENCY': str(args.workers)})
+    import telemetry
+
+    jobs = iter(range(args.sessions))
+    lock = threading.Lock()
+    results = []
+
+    def worker():
+        while True:
+            with lock:
+                index = next(jobs, None)
+            if index is None:
+                return
+            result = batch.craft(batch.Job(f'replay-{index}', args.requirement), batch.approve,
+                                 session_prefix='bench')
+            with lock:
+                results.append(result)
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(25)
+
+    steps = {}
+    histogram = telemetry.craft_step_seconds
+    with histogram.lock:
+        values = {key: list(counts) for key, counts in histogram.values.items()}
+    for key, counts in values.items():
+        labels = dict(zip(histogram.labelnames, key))
+        if labels['outcome'] == 'ok':
+            entry = steps.setdefault(labels['state'], {'count': 0, 'seconds': 0.0})
+            entry['count'] += sum(counts[:-1])
+            entry['seconds'] += counts[-1]
+    for entry in steps.values():
+        entry['mean_ms'] = entry['seconds'] / entry['count'] * 1000
+
+    step_count = sum(len(result['steps']) for result in results)
+    return {
+        'sessions': len(results),
+        'statuses': dict(Counter(result['status'] for result in results)),
+        'errors': sorted({result['error'] for result in results if result['error']})[:5],
+        'seconds': seconds,
+        'sessions_per_second': len(results) / seconds,
+        'steps_per_second': step_count / seconds,
+        'steps': steps,
+        'recording': llm_client.llm.client.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record a craft session, or replay it without a model.')
+    parser.add_argument('mode', choices=('record', 'replay'))
+    parser.add_argument('recording')
+    parser.add_argument('--requirement', default=REQUIREMENT)
+    parser.add_argument('--ollama', help='record from this Ollama instead of the fake server')
+    parser.add_argument('--ttft', type=float, default=0.2)
+    parser.add_argument('--rate', type=float, default=200.0)
+    parser.add_argument('--tokens', type=int, default=200)
+    parser.add_argument('--sessions', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--speed', default='max', help="'recorded', 'max' or a speed-up factor")
+    parser.add_argument('--profile', help='write a cProfile of the replay here')
+    parser.add_argument('--output', help='write the JSON report here')
+    args = parser.parse_args()
+
+    report = record(args) if args.mode == 'record' else replay(args)
+    report['settings'] = vars(args)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
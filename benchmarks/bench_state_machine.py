@@ -0,0 +1,103 @@
+# Compares the shared, slotted state machine with the old design that built a
+# transitions.Machine for every ToolCraftingProcess.
+#
+#   python benchmarks/bench_state_machine.py --sessions 100000 --legacy-sessions 5000
+#
+# For each design the report shows construction time and memory per session
+# (tracemalloc, with the sessions kept alive), and the time to step every
+# session through a full crafting path including the conditional `iterate`
+# transition. A Machine per session costs about 100 KB, so the legacy design
+# is measured on `--legacy-sessions` and reported per session.
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transitions import Machine
+
+from craft_sm import TRANSITIONS, ToolCraftingProcess
+
+PATH = ['propose_design', 'refine_design', 'propose_refined_design', 'implement_design', 'eval_script',
+        'results_not_met_expectations', 'iterate', 'eval_script', 'results_met_expectations',
+        'summarize_development', 'end_tool_crafting', 'new_project']
+
+
+class LegacyProcess:
+    # The per-session part of ToolCraftingProcess before the shared engine.
+
+    def __init__(self, session_id=None):
+        self.session_id = session_id
+        self.prompt_layout = 'state_first'
+        self.prompt_eval_log = []
+        self.prefetched = None
+        self.last_execution = None
+        self.max_iterations = 5
+        self.iteration_count = 0
+        self.message = None
+        self.transitions = TRANSITIONS
+        self.machine = Machine(model=self, states=ToolCraftingProcess.states, transitions=self.transitions,
+                               initial='requirement_proposal')
+        self.evaluation_status = 'result_met_expectations'
+
+    def max_iterations_reached(self):
+        return self.iteration_count >= self.max_iterations
+
+
+def measure(factory, sessions):
+    gc.collect()
+    start = time.perf_counter()
+    processes = [factory(str(i)) for i in range(sessions)]
+    construct = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for process in processes:
+        for trigger in PATH:
+            getattr(process, trigger)()
+    step = time.perf_counter() - start
+    assert all(process.state == 'requirement_proposal' for process in processes)
+    del processes
+
+    # Memory is measured separately because tracemalloc slows allocation down.
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    processes = [factory(str(i)) for i in range(sessions)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del processes
+
+    return {
+        'sessions': sessions,
+        'construct_seconds': construct,
+        'construct_us_per_session': construct / sessions * 1e6,
+        'step_us_per_transition': step / (sessions * len(PATH)) * 1e6,
+        'bytes_per_session': (after - before) / sessions,
+        'total_mb': (after - before) / 2 ** 20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shared slotted state machine vs a Machine per session.')
+    parser.add_argument('--sessions', type=int, default=100000)
+    parser.add_argument('--legacy-sessions', type=int, default=5000)
+    args = parser.parse_args()
+
+    shared = measure(ToolCraftingProcess, args.sessions)
+    legacy = measure(LegacyProcess, args.legacy_sessions)
+    report = {
+        'shared': shared,
+        'machine_per_session': legacy,
+        'memory_ratio': legacy['bytes_per_session'] / shared['bytes_per_session'],
+        'construct_speedup': legacy['construct_us_per_session'] / shared['construct_us_per_session'],
+        'step_speedup': legacy['step_us_per_transition'] / shared['step_us_per_transition'],
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# Compares the old per-token broadcast with session-scoped, coalesced frames.
+#
+#   python benchmarks/bench_streaming.py --streams 8 --tokens 500 --rate 200
+#
+# Each stream produces `--tokens` tokens at `--rate` tokens/s. Every stream
+# has one connected Socket.IO test client. The report shows the websocket
+# frames the server emitted and delivered, frames per second and server CPU
+# time for both modes.
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from flask_socketio import SocketIO, join_room
+
+from streaming import ChunkCoalescer, FLUSH_BYTES, FLUSH_INTERVAL
+
+TOKEN = 'tok '
+
+
+def build_app():
+    app = Flask(__name__)
+    socketio = SocketIO(app)
+
+    @socketio.on('connect')
+    def connect(auth):
+        join_room(auth['room'])
+
+    return app, socketio
+
+
+def naive_stream(socketio, room, tokens, delay):
+    for _ in range(tokens):
+        socketio.emit('response_chunk', {'chunk': TOKEN})
+        time.sleep(delay)
+    socketio.emit('response_complete')
+
+
+def coalesced_stream(socketio, room, tokens, delay, interval, max_bytes):
+    coalescer = ChunkCoalescer(socketio, 'response_chunk', room=room,
+                               interval=interval, max_bytes=max_bytes)
+    for _ in range(tokens):
+        coalescer.push(TOKEN)
+        time.sleep(delay)
+    coalescer.close()
+    socketio.emit('response_complete', to=room)
+
+
+def run(mode, args):
+    app, socketio = build_app()
+    clients = [socketio.test_client(app, auth={'room': f'session-{i}'}) for i in range(args.streams)]
+    delay = 1.0 / args.rate
+
+    threads = []
+    for i in range(args.streams):
+        room = f'session-{i}'
+        if mode == 'naive':
+            target, target_args = naive_stream, (socketio, room, args.tokens, delay)
+        else:
+            target, target_args = coalesced_stream, (socketio, room, args.tokens, delay,
+                                                     args.interval, args.max_bytes)
+        threads.append(threading.Thread(target=target, args=target_args))
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    delivered = 0
+    for client in clients:
+        delivered += sum(1 for packet in client.get_received() if packet['name'] == 'response_chunk')
+        client.disconnect()
+
+    return {
+        'mode': mode,
+        'delivered_frames': delivered,
+        'frames_per_second': delivered / wall,
+        'wall_seconds': wall,
+        'server_cpu_seconds': cpu,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark per-token vs coalesced streaming.')
+    parser.add_argument('--streams', type=int, default=8)
+    parser.add_argument('--tokens', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=200.0, help='tokens per second per stream')
+    parser.add_argument('--interval', type=float, default=FLUSH_INTERVAL)
+    parser.add_argument('--max-bytes', type=int, default=FLUSH_BYTES)
+    args = parser.parse_args()
+
+    print(f"{args.streams} streams x {args.tokens} tokens @ {args.rate:.0f} tok/s")
+    for mode in ('naive', 'coalesced'):
+        result = run(mode, args)
+        print(f"{result['mode']:>10}: {result['delivered_frames']:>8} frames delivered, "
+              f"{result['frames_per_second']:>10.1f} frames/s, "
+              f"cpu {result['server_cpu_seconds']:.3f}s over {result['wall_seconds']:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# Compares per-run latency of Python tools started as a fresh interpreter with
+# runs forked from a warm zygote.
+#
+#   python benchmarks/bench_zygote.py --runs 50 --concurrency 2
+#
+# The script imports a few common modules and prints a line, which is what
+# most crafted tools do before any real work. Latency is measured from the
+# call until the result (including captured output) is back.
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from executor import ScriptExecutor
+from zygote import ZygotePool
+
+SCRIPT = 'import json, csv, re, datetime, urllib.request\nprint(json.dumps({"ok": True}))\n'
+
+
+def measure(executor, runs, concurrency):
+    def one(_):
+        start = time.monotonic()
+        result = executor.run_python(SCRIPT)
+        assert result['status'] == 'ok', result
+        return time.monotonic() - start
+
+    executor.run_python(SCRIPT)  # warm-up, also starts the zygote
+    start = time.monotonic()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = sorted(pool.map(one, range(runs)))
+    elapsed = time.monotonic() - start
+    return {
+        'runs': runs,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+        'runs_per_second': runs / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fresh interpreter vs zygote fork for Python tools.')
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=2)
+    args = parser.parse_args()
+
+    report = {'subprocess': measure(ScriptExecutor(workers=args.concurrency), args.runs, args.concurrency)}
+    zygotes = ZygotePool(processes=1)
+    try:
+        report['zygote'] = measure(ScriptExecutor(workers=args.concurrency, zygotes=zygotes),
+                                   args.runs, args.concurrency)
+    finally:
+        zygotes.close()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+# Offline evaluation of the classification cascade against the large model.
+#
+#   python benchmarks/eval_classifier.py cases.jsonl
+#
+# Each line of the cases file is a JSON object:
+#   {"state": "review", "user_message": "...", "history": [...], "expected": "implement_design"}
+# `history` and `expected` are optional. Requires a running Ollama with both
+# the craft model and the small classifier model. For every case the large
+# model baseline and the cascade are run and the report shows, per state, how
+# often the cascade agrees with the baseline, which stage answered, and the
+# latency of both.
+import argparse
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import classifier
+from craft_sm import SPEC, ToolCraftingProcess
+from llm_client import llm
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def run_case(case):
+    process = ToolCraftingProcess(session_id='eval-classifier')
+    process.state = case['state']
+    history = case.get('history', [])
+    messages = process.build_messages(case['user_message'], history)
+    tools = SPEC.tools[case['state']]
+
+    start = time.monotonic()
+    baseline = classifier.tool_call_trigger(process.call_llm(messages, tools), SPEC.valid_triggers)
+    baseline_seconds = time.monotonic() - start
+
+    start = time.monotonic()
+    trigger, stage = classifier.classify(
+        case['state'], case['user_message'], process.get_system_message(), history, tools,
+        process.get_triggers(), call_large=lambda: process.call_llm(messages, tools))
+    cascade_seconds = time.monotonic() - start
+
+    return {
+        'state': case['state'],
+        'expected': case.get('expected'),
+        'baseline': baseline,
+        'cascade': trigger,
+        'stage': stage,
+        'baseline_seconds': baseline_seconds,
+        'cascade_seconds': cascade_seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the classification cascade with the large-model baseline.')
+    parser.add_argument('cases')
+    parser.add_argument('--output', help='write per-case results as JSONL')
+    args = parser.parse_args()
+
+    # Both paths must really hit the models for the latency comparison.
+    llm.cache = None
+
+    with open(args.cases) as f:
+        cases = [json.loads(line) for line in f if line.strip()]
+
+    results = [run_case(case) for case in cases]
+    if args.output:
+        with open(args.output, 'w') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+
+    by_state = defaultdict(list)
+    for result in results:
+        by_state[result['state']].append(result)
+
+    for state, rows in sorted(by_state.items()):
+        agree = sum(1 for row in rows if row['cascade'] == row['baseline'])
+        labelled = [row for row in rows if row['expected']]
+        stages = {stage: sum(1 for row in rows if row['stage'] == stage) for stage in classifier.STAGES}
+        baseline_latency = [row['baseline_seconds'] for row in rows]
+        cascade_latency = [row['cascade_seconds'] for row in rows]
+        print(f"\n{state} ({len(rows)} cases)")
+        print(f"  agreement with baseline: {agree / len(rows):.1%}")
+        if labelled:
+            baseline_acc = sum(1 for row in labelled if row['baseline'] == row['expected']) / len(labelled)
+            cascade_acc = sum(1 for row in labelled if row['cascade'] == row['expected']) / len(labelled)
+            print(f"  accuracy: baseline {baseline_acc:.1%}, cascade {cascade_acc:.1%}")
+        print(f"  answered by: {stages}")
+        print(f"  latency p50/p95: baseline {percentile(baseline_latency, 0.5):.2f}s/{percentile(baseline_latency, 0.95):.2f}s, "
+              f"cascade {percentile(cascade_latency, 0.5):.2f}s/{percentile(cascade_latency, 0.95):.2f}s")
+
+
+if __name__ == '__main__':
+    main()
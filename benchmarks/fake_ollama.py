@@ -0,0 +1,213 @@
+# A stand-in for the Ollama HTTP API, for load tests without a GPU.
+#
+#   python benchmarks/fake_ollama.py --port 11435 --ttft 0.2 --rate 40 --tokens 200
+#   OLLAMA_HOST=http://127.0.0.1:11435 python run.py
+#
+# /api/chat answers after `--ttft` seconds and then produces `--tokens` tokens
+# at `--rate` tokens/s, streamed as NDJSON or returned at once. Requests that
+# carry the state machine's send_trigger tool get a tool call instead. The
+# trigger is taken from HAPPY_PATH, so a craft session runs from requirement
+# proposal to the end. --trigger state=trigger overrides the choice. Task
+# responses in script_design_and_execution contain a small Python script.
+import argparse
+import json
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TOKEN = 'tok '
+HAPPY_PATH = ['implement_design', 'results_met_expectations', 'end_tool_crafting']
+STATE_PATTERN = re.compile(r'Current State:\s*(\w+)')
+SCRIPT = "\n```python\nimport json\nprint(json.dumps({'ok': True}))\n```\n"
+
+
+class FakeOllamaConfig:
+
+    def __init__(self, ttft=0.2, rate=40.0, tokens=200, tool_latency=0.1, triggers=None):
+        self.ttft = ttft
+        self.rate = rate
+        self.tokens = tokens
+        self.tool_latency = tool_latency
+        self.triggers = triggers or {}
+        self.lock = threading.Lock()
+        self.counters = {'chat': 0, 'stream': 0, 'tool_calls': 0, 'tokens': 0}
+
+    def count(self, **increments):
+        with self.lock:
+            for name, value in increments.items():
+                self.counters[name] += value
+
+
+def current_state(messages):
+    for message in reversed(messages):
+        match = STATE_PATTERN.search(message.get('content') or '')
+        if match:
+            return match.group(1)
+    return None
+
+
+def choose_trigger(config, state, tools):
+    allowed = tools[0]['function']['parameters']['properties']['trigger'].get('enum') or []
+    if state in config.triggers:
+        return config.triggers[state]
+    for trigger in HAPPY_PATH:
+        if trigger in allowed:
+            return trigger
+    return allowed[0] if allowed else ''
+
+
+def timestamp():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def final_fields(request, started, prompt_tokens, eval_count):
+    total = time.monotonic() - started
+    return {
+        'done': True,
+        'done_reason': 'stop',
+        'total_duration': int(total * 1e9),
+        'load_duration': 0,
+        'prompt_eval_count': prompt_tokens,
+        'prompt_eval_duration': int(prompt_tokens * 1e5),
+        'eval_count': eval_count,
+        'eval_duration': int(total * 1e9),
+        'model': request.get('model', ''),
+        'created_at': timestamp(),
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/api/version':
+            self.send_json({'version': '0.0.0-fake'})
+        elif self.path == '/api/tags':
+            self.send_json({'models': []})
+        elif self.path == '/stats':
+            with self.config.lock:
+                self.send_json(dict(self.config.counters))
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if self.path != '/api/chat':
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        messages = request.get('messages') or []
+        started = time.monotonic()
+        prompt_tokens = sum(len(m.get('content') or '') for m in messages) // 4 + 1
+        state = current_state(messages)
+        self.config.count(chat=1)
+
+        if request.get('tools'):
+            time.sleep(self.config.tool_latency)
+            self.config.count(tool_calls=1)
+            trigger = choose_trigger(self.config, state, request['tools'])
+            message = {'role': 'assistant', 'content': '',
+                       'tool_calls': [{'function': {'name': 'send_trigger', 'arguments': {'trigger': trigger}}}]}
+            body = dict(final_fields(request, started, prompt_tokens, 1), message=message)
+            if request.get('stream', True):
+                self.send_stream([body])
+            else:
+                self.send_json(body)
+            return
+
+        pieces = [TOKEN] * self.config.tokens
+        if state == 'script_design_and_execution':
+            pieces.append(SCRIPT)
+        if request.get('stream', True):
+            self.config.count(stream=1)
+            self.send_stream(self.stream_chunks(request, started, prompt_tokens, pieces))
+        else:
+            time.sleep(self.config.ttft + len(pieces) / self.config.rate)
+            self.config.count(tokens=len(pieces))
+            message = {'role': 'assistant', 'content': ''.join(pieces)}
+            self.send_json(dict(final_fields(request, started, prompt_tokens, len(pieces)), message=message))
+
+    def stream_chunks(self, request, started, prompt_tokens, pieces):
+        time.sleep(self.config.ttft)
+        delay = 1.0 / self.config.rate
+        next_at = time.monotonic()
+        for piece in pieces:
+            yield {'model': request.get('model', ''), 'created_at': timestamp(),
+                   'message': {'role': 'assistant', 'content': piece}, 'done': False}
+            self.config.count(tokens=1)
+            next_at += delay
+            time.sleep(max(0.0, next_at - time.monotonic()))
+        yield dict(final_fields(request, started, prompt_tokens, len(pieces)),
+                   message={'role': 'assistant', 'content': ''})
+
+    def send_json(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, chunks):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                line = json.dumps(chunk).encode() + b'\n'
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+                self.wfile.flush()
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream early.
+            self.close_connection = True
+
+
+class Server(ThreadingHTTPServer):
+    # The default listen backlog of 5 resets connections when many streams
+    # start at once.
+    request_queue_size = 1024
+
+
+def start(port=0, config=None):
+    # Starts the server in a daemon thread and returns it; server.server_port
+    # is the bound port when `port` is 0.
+    handler = type('ConfiguredHandler', (Handler,), {'config': config or FakeOllamaConfig()})
+    server = Server(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_triggers(items):
+    return dict(item.split('=', 1) for item in items)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Ollama server with a configurable token rate.')
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--ttft', type=float, default=0.2, help='seconds before the first token')
+    parser.add_argument('--rate', type=float, default=40.0, help='tokens per second per request')
+    parser.add_argument('--tokens', type=int, default=200, help='tokens per response')
+    parser.add_argument('--tool-latency', type=float, default=0.1, help='seconds per tool-call response')
+    parser.add_argument('--trigger', action='append', default=[], metavar='STATE=TRIGGER')
+    args = parser.parse_args()
+
+    config = FakeOllamaConfig(args.ttft, args.rate, args.tokens, args.tool_latency, parse_triggers(args.trigger))
+    server = start(args.port, config)
+    print(f'fake ollama listening on http://127.0.0.1:{server.server_port}', flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
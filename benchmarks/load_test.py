@@ -0,0 +1,308 @@
+# Offline load test: the app against benchmarks/fake_ollama.py, driven by N
+# concurrent Socket.IO clients.
+#
+#   python benchmarks/load_test.py --clients 20 --rounds 3 --output results.json
+#
+# Starts the fake Ollama server in this process and the app (run.py, or
+# run_async.py with --server async) in a subprocess, then has every client
+# repeat `--rounds` times:
+#   generate   POST /generate, timed to the first 'response_chunk' (TTFT) and
+#              to 'response_complete'
+#   clipboard  POST /add_text, timed until its 'clipboard_delta' arrives
+#   craft      a full /craft/craft-tools session: the request, "looks good"
+#              and "thanks", each timed to its first 'tool_chunk' and to
+#              'tool_response'
+# The report has p50/p95/p99 TTFT and end-to-end latency per scenario,
+# streamed tokens per second received by the clients and the app's RSS
+# (from /proc). It is printed and written to --output as JSON, together with
+# the commit and the settings, so runs on different commits can be compared.
+# Needs the Socket.IO client extras: pip install "python-socketio[client]".
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_ollama
+
+CRAFT_TURNS = ['Make a tool that reports the weather for a city.', 'looks good', 'thanks']
+SCENARIOS = ('generate', 'clipboard', 'craft')
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pick(fraction):
+        return values[min(len(values) - 1, int(len(values) * fraction))]
+
+    return {'count': len(values), 'mean': sum(values) / len(values), 'p50': pick(0.50), 'p95': pick(0.95),
+            'p99': pick(0.99), 'max': values[-1]}
+
+
+def rss_bytes(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+class RSSSampler(threading.Thread):
+
+    def __init__(self, pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            value = rss_bytes(self.pid)
+            if value is not None:
+                self.samples.append(value)
+
+    def report(self):
+        if not self.samples:
+            return None
+        return {'start': self.samples[0], 'peak': max(self.samples), 'end': self.samples[-1]}
+
+
+class VirtualUser:
+    # One browser: an HTTP client with its own session cookie and a Socket.IO
+    # connection that joins the session's room.
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.http = httpx.Client(base_url=base_url, timeout=timeout)
+        self.http.get('/')
+        cookie = '; '.join(f'{name}={value}' for name, value in self.http.cookies.items())
+        self.sio = socketio.Client(reconnection=False)
+        self.waiting = {}  # event name -> [threading.Event, timestamp, payloads]
+        self.lock = threading.Lock()
+        for event in ('response_chunk', 'response_complete', 'clipboard_delta', 'tool_chunk', 'tool_response'):
+            self.sio.on(event, self._handler(event))
+        self.sio.connect(base_url, headers={'Cookie': cookie}, transports=['websocket'], wait_timeout=timeout)
+
+    def _handler(self, event):
+        def handle(data=None):
+            now = time.monotonic()
+            with self.lock:
+                waiter = self.waiting.get(event)
+                if waiter is not None:
+                    if waiter['first'] is None:
+                        waiter['first'] = now
+                    waiter['payloads'].append(data)
+                    waiter['done'].set()
+        return handle
+
+    def expect(self, *events):
+        with self.lock:
+            for event in events:
+                self.waiting[event] = {'done': threading.Event(), 'first': None, 'payloads': []}
+
+    def wait(self, event):
+        waiter = self.waiting[event]
+        if not waiter['done'].wait(self.timeout):
+            raise TimeoutError(f'no {event} within {self.timeout}s')
+        return waiter
+
+    def close(self):
+        self.sio.disconnect()
+        self.http.close()
+
+
+def count_tokens(payloads):
+    return sum(len(payload['chunk'].split()) for payload in payloads if payload)
+
+
+def run_generate(user, results, round_index):
+    user.expect('response_chunk', 'response_complete')
+    start = time.monotonic()
+    response = user.http.post('/generate', data={'prompt': f'Explain round {round_index} in detail.'})
+    if response.status_code == 429:
+        results['rejected'] += 1
+        return
+    end = user.wait('response_complete')['first']
+    first = user.waiting['response_chunk']['first'] or end
+    tokens = count_tokens(user.waiting['response_chunk']['payloads'])
+    results['ttft'].append(first - start)
+    results['e2e'].append(end - start)
+    results['tokens'] += tokens
+    if end > first:
+        results['tokens_per_second'].append(tokens / (end - first))
+
+
+def run_clipboard(user, results, round_index):
+    user.expect('clipboard_delta')
+    start = time.monotonic()
+    user.http.post('/add_text', data={'text': f'clip {round_index} ' + 'x' * 2000})
+    results['e2e'].append(user.wait('clipboard_delta')['first'] - start)
+
+
+def run_craft(user, results, round_index):
+    for turn in CRAFT_TURNS:
+        user.expect('tool_chunk', 'tool_response')
+        start = time.monotonic()
+        response = user.http.post('/craft/craft-tools', json={'prompt': turn})
+        if response.status_code == 429:
+            results['rejected'] += 1
+            return
+        end = user.wait('tool_response')['first']
+        first = user.waiting['tool_chunk']['first'] or end
+        tokens = count_tokens(user.waiting['tool_chunk']['payloads'])
+        results['ttft'].append(first - start)
+        results['e2e'].append(end - start)
+        results['tokens'] += tokens
+    user.http.post('/craft/clear_craft_history')
+
+
+RUNNERS = {'generate': run_generate, 'clipboard': run_clipboard, 'craft': run_craft}
+
+
+def drive(base_url, scenario, clients, rounds, timeout):
+    results = {'ttft': [], 'e2e': [], 'tokens': 0, 'tokens_per_second': [], 'rejected': 0, 'errors': []}
+    lock = threading.Lock()
+
+    def client(index):
+        local = {'ttft': [], 'e2e': [], 'tokens': 0, 'tokens_per_second': [], 'rejected': 0}
+        user = None
+        try:
+            user = VirtualUser(base_url, timeout)
+            for round_index in range(rounds):
+                RUNNERS[scenario](user, local, round_index)
+        except Exception as e:
+            with lock:
+                results['errors'].append(f'client {index}: {type(e).__name__}: {e}')
+        finally:
+            if user is not None:
+                user.close()
+        with lock:
+            for key in ('ttft', 'e2e', 'tokens_per_second'):
+                results[key].extend(local[key])
+            results['tokens'] += local['tokens']
+            results['rejected'] += local['rejected']
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    return {
+        'seconds': elapsed,
+        'ttft': percentiles(results['ttft']),
+        'e2e': percentiles(results['e2e']),
+        'tokens_received': results['tokens'],
+        'tokens_per_second': results['tokens'] / elapsed if elapsed else None,
+        'per_stream_tokens_per_second': percentiles(results['tokens_per_second']),
+        'rejected': results['rejected'],
+        'errors': results['errors'][:20],
+    }
+
+
+SERVERS = {
+    'threaded': ('import run; run.socketio.run(run.app, host="127.0.0.1", port=%d, '
+                 'debug=False, use_reloader=False, log_output=False, allow_unsafe_werkzeug=True)'),
+    'async': ('import run_async; from aiohttp import web; '
+              'web.run_app(run_async.create_app(), host="127.0.0.1", port=%d, print=None, access_log=None)'),
+}
+
+
+def start_app(port, ollama_url, extra_env, server='threaded'):
+    env = dict(os.environ, OLLAMA_HOST=ollama_url, LLM_CACHE='0', **extra_env)
+    code = SERVERS[server] % port
+    # stderr goes to a file: the request log would fill a pipe nobody reads
+    # and block the server.
+    log = tempfile.TemporaryFile()
+    proc = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=log)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            log.seek(0)
+            raise RuntimeError('app exited: ' + log.read().decode(errors='replace')[-2000:])
+        try:
+            httpx.get(f'http://127.0.0.1:{port}/stats', timeout=1)
+            return proc
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError('app did not start within 30s')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the app against a fake Ollama server.')
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--ttft', type=float, default=0.2)
+    parser.add_argument('--rate', type=float, default=40.0)
+    parser.add_argument('--tokens', type=int, default=200)
+    parser.add_argument('--tool-latency', type=float, default=0.1)
+    parser.add_argument('--server', choices=sorted(SERVERS), default='threaded',
+                        help='run.py (threaded) or run_async.py (asyncio)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra environment for the app, e.g. --env LLM_DEFAULT_CONCURRENCY=8')
+    parser.add_argument('--output', help='write the JSON report here')
+    args = parser.parse_args()
+
+    config = fake_ollama.FakeOllamaConfig(args.ttft, args.rate, args.tokens, args.tool_latency)
+    ollama_server = fake_ollama.start(0, config)
+    app = start_app(args.port, f'http://127.0.0.1:{ollama_server.server_port}',
+                    dict(item.split('=', 1) for item in args.env), args.server)
+    sampler = RSSSampler(app.pid)
+    sampler.start()
+    report = {
+        'commit': git_commit(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'settings': {key: value for key, value in vars(args).items() if key != 'output'},
+        'scenarios': {},
+    }
+    try:
+        base_url = f'http://127.0.0.1:{args.port}'
+        for scenario in args.scenarios.split(','):
+            report['scenarios'][scenario] = drive(base_url, scenario, args.clients, args.rounds, args.timeout)
+        report['app_stats'] = httpx.get(f'{base_url}/stats', timeout=10).json()
+    finally:
+        sampler.stopped.set()
+        app.terminate()
+        app.wait()
+        ollama_server.shutdown()
+    report['rss_bytes'] = sampler.report()
+    report['fake_ollama'] = dict(config.counters)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+import asyncio
+import contextvars
+import os
+import threading
+import traceback
+from collections import defaultdict
+from contextlib import contextmanager
+
+import telemetry
+
+# Background work started for a session (a chat reply, a craft chain, a
+# script run) carries a CancelToken. A new request of the same kind cancels
+# the session's previous one, the clear routes cancel theirs, and when the
+# last socket of a session disconnects everything it started is cancelled
+# unless a socket reconnects within DISCONNECT_GRACE seconds.
+#
+# The running job finds its token through a context variable. Model streams
+# stop at the next chunk and close their HTTP response, calls waiting for a
+# model slot leave the queue, a craft chain stops at the next step boundary
+# and a running script's process group is killed. Tokens are per process:
+# with several workers, a cancel only reaches jobs running in the worker
+# that handles it.
+DISCONNECT_GRACE = float(os.environ.get('CANCEL_DISCONNECT_GRACE', 10))
+
+cancellations_total = telemetry.registry.counter(
+    'cancellations_total', 'Background jobs cancelled, by kind and reason.', ('kind', 'reason'))
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CancelToken:
+
+    def __init__(self, session_id, kind):
+        self.session_id = session_id
+        self.kind = kind
+        self.reason = None
+        self.event = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self, reason):
+        with self.lock:
+            if self.event.is_set():
+                return False
+            self.reason = reason
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        cancellations_total.inc(kind=self.kind, reason=reason)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                traceback.print_exc()
+        return True
+
+    def check(self):
+        if self.event.is_set():
+            raise Cancelled(self.reason)
+
+    def on_cancel(self, callback):
+        # Calls `callback` (from the cancelling thread) when the token is
+        # cancelled, or right away if it already is. Returns a function that
+        # unregisters it.
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return lambda: self._remove(callback)
+        callback()
+        return lambda: None
+
+    def _remove(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+
+current_token = contextvars.ContextVar('cancel_token', default=None)
+
+
+def current():
+    return current_token.get()
+
+
+def check():
+    token = current_token.get()
+    if token is not None:
+        token.check()
+
+
+@contextmanager
+def active(token):
+    reset = current_token.set(token)
+    try:
+        yield token
+    finally:
+        current_token.reset(reset)
+
+
+class CancellationRegistry:
+
+    def __init__(self, disconnect_grace=DISCONNECT_GRACE):
+        self.disconnect_grace = disconnect_grace
+        self.tokens = {}  # (session, kind) -> the latest token
+        self.sockets = defaultdict(int)  # session -> connected sockets
+        self.timers = {}  # session -> disconnect timer
+        self.lock = threading.Lock()
+
+    def start(self, session_id, kind):
+        # A token for a new job; the session's previous job of this kind is
+        # cancelled.
+        token = CancelToken(session_id, kind)
+        with self.lock:
+            previous = self.tokens.get((session_id, kind))
+            self.tokens[(session_id, kind)] = token
+        if previous is not None:
+            previous.cancel('resubmit')
+        return token
+
+    def finish(self, token):
+        with self.lock:
+            if self.tokens.get((token.session_id, token.kind)) is token:
+                del self.tokens[(token.session_id, token.kind)]
+
+    def cancel(self, session_id, kinds=None, reason='clear'):
+        with self.lock:
+            tokens = [token for (session, kind), token in self.tokens.items()
+                      if session == session_id and (kinds is None or kind in kinds)]
+        return sum(1 for token in tokens if token.cancel(reason))
+
+    def connected(self, session_id):
+        with self.lock:
+            self.sockets[session_id] += 1
+            timer = self.timers.pop(session_id, None)
+        if timer is not None:
+            timer.cancel()
+
+    def disconnected(self, session_id):
+        with self.lock:
+            self.sockets[session_id] -= 1
+            if self.sockets[session_id] > 0:
+                return
+            del self.sockets[session_id]
+            timer = threading.Timer(self.disconnect_grace, self._expire)
+            timer.args = (session_id, timer)
+            self.timers[session_id] = timer
+        timer.daemon = True
+        timer.start()
+
+    def _expire(self, session_id, timer):
+        # A timer that fired while a reconnect was cancelling it must not act
+        # on the timer of a later disconnect.
+        with self.lock:
+            if self.sockets.get(session_id) or self.timers.get(session_id) is not timer:
+                return
+            del self.timers[session_id]
+        self.cancel(session_id, reason='disconnect')
+
+    def stats(self):
+        with self.lock:
+            return {'active': len(self.tokens), 'sessions_connected': len(self.sockets),
+                    'disconnect_timers': len(self.timers)}
+
+
+cancellations = CancellationRegistry()
+
+
+def run(token, job, on_cancelled=None):
+    # Runs job() with `token` active. A cancelled job ends quietly, after
+    # on_cancelled(reason) if given.
+    try:
+        with active(token):
+            token.check()
+            return job()
+    except Cancelled:
+        if on_cancelled is not None:
+            on_cancelled(token.reason)
+    finally:
+        cancellations.finish(token)
+
+
+async def arun(token, job, on_cancelled=None):
+    # run() for coroutines: job() runs in its own task, which cancelling the
+    # token cancels, so the job stops at whatever it is awaiting.
+    loop = asyncio.get_running_loop()
+    with active(token):
+        task = loop.create_task(job())
+    unregister = token.on_cancel(lambda: loop.call_soon_threadsafe(task.cancel))
+    try:
+        return await task
+    except (Cancelled, asyncio.CancelledError):
+        if not token.cancelled:
+            raise
+        if on_cancelled is not None:
+            on_cancelled(token.reason)
+    finally:
+        unregister()
+        cancellations.finish(token)
@@ -0,0 +1,144 @@
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+
+from llm_client import llm
+
+# Classification states try cheaper classifiers first and only fall back to
+# the large craft model when they are not confident:
+#   1. keyword heuristics on the latest user message,
+#   2. a small local model given the state prompt and only the recent history,
+#   3. the large model with the full prompt (the original behaviour).
+CASCADE_ENABLED = os.environ.get('CRAFT_CLASSIFIER_CASCADE', '0') == '1'
+SMALL_MODEL = os.environ.get('CRAFT_CLASSIFIER_MODEL', 'llama3.1:8b')
+
+# The status line format_execution_result() writes under each script's header.
+STATUS_LINE = re.compile(r'^Script .*\nExecution status: (\w+)', re.MULTILINE)
+
+
+def execution_statuses(outcome):
+    # Only the statuses of the runs: the scripts' own output often says
+    # 'error' or 'failed' (a log line, a test name) without the run failing.
+    return ' '.join(STATUS_LINE.findall(outcome))
+
+CASCADE_CONFIG = {
+    'review': {
+        'keywords': {
+            'implement_design': ['looks good', 'lgtm', 'approve', 'approved', 'go ahead', 'proceed',
+                                 'sounds good', 'implement it', 'perfect', 'ship it'],
+            'refine_design': ['change', 'instead', 'add', 'remove', 'missing', 'should', "shouldn't",
+                              'refine', 'rather', 'not what', 'wrong'],
+        },
+        'keyword_confidence': 0.75,
+        'small_model': SMALL_MODEL,
+        'history_messages': 2,
+    },
+    'script_execution_evaluation': {
+        # A run that did not succeed has not met expectations; whether a
+        # clean run did is for a model to judge. The status is reliable, so
+        # one match is enough.
+        'keyword_text': execution_statuses,
+        'keywords': {
+            'results_not_met_expectations': ['failed', 'timeout', 'killed', 'cpu_limit', 'memory_limit',
+                                             'file_size_limit', 'error'],
+            'results_met_expectations': [],
+        },
+        'keyword_confidence': 0.5,
+        'small_model': SMALL_MODEL,
+        'history_messages': 2,
+    },
+    'final_review': {
+        'keywords': {
+            'end_tool_crafting': ['thanks', 'thank you', 'great', 'perfect', "that's all", 'done', 'stop',
+                                  'abandon', 'good enough', 'finish'],
+            'refine_tool': ['fix', 'change', 'add', 'improve', 'continue', 'more time', 'not working', 'still'],
+        },
+        'keyword_confidence': 0.75,
+        'small_model': SMALL_MODEL,
+        'history_messages': 2,
+    },
+}
+
+STAGES = ('keywords', 'small_model', 'large_model')
+
+stats_lock = threading.Lock()
+cascade_stats = defaultdict(lambda: {stage: {'count': 0, 'seconds': 0.0} for stage in STAGES})
+
+
+def compile_keywords(keywords):
+    return {
+        trigger: [re.compile(r'\b' + re.escape(word) + r'\b', re.IGNORECASE) for word in words]
+        for trigger, words in keywords.items()
+    }
+
+
+COMPILED_KEYWORDS = {state: compile_keywords(config['keywords']) for state, config in CASCADE_CONFIG.items()}
+
+
+def keyword_vote(state, text):
+    # Returns (trigger, confidence). Confidence grows with how many more
+    # keywords the winning trigger matched than the runner-up.
+    scores = {trigger: sum(1 for pattern in patterns if pattern.search(text))
+              for trigger, patterns in COMPILED_KEYWORDS[state].items()}
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    best_trigger, best = ranked[0]
+    runner_up = ranked[1][1] if len(ranked) > 1 else 0
+    if best == 0:
+        return None, 0.0
+    return best_trigger, 1 - 0.5 ** (best - runner_up)
+
+
+def tool_call_trigger(response_dict, valid_triggers):
+    tool_calls = response_dict['message'].get('tool_calls') or []
+    if not tool_calls:
+        return None
+    trigger = str(tool_calls[0]['function']['arguments'].get('trigger', '')).strip().lower()
+    return trigger if trigger in valid_triggers else None
+
+
+def record(state, stage, seconds):
+    with stats_lock:
+        entry = cascade_stats[state][stage]
+        entry['count'] += 1
+        entry['seconds'] += seconds
+
+
+def classify(state, user_message, system_message, message_history, tools, valid_triggers, call_large,
+             session_id=None, config=None):
+    # Picks a trigger for a classification state. `call_large()` runs the
+    # original large-model call and returns its response dict. Returns
+    # (trigger, stage); trigger is None only if the large model also failed.
+    config = config or CASCADE_CONFIG.get(state)
+    start = time.monotonic()
+
+    if config:
+        keyword_text = config.get('keyword_text')
+        voted, confidence = keyword_vote(state, keyword_text(user_message) if keyword_text else user_message)
+        if voted in valid_triggers and confidence >= config['keyword_confidence']:
+            record(state, 'keywords', time.monotonic() - start)
+            return voted, 'keywords'
+
+        if config.get('small_model'):
+            recent = message_history[-config['history_messages']:] if config['history_messages'] else []
+            messages = [{"role": "system", "content": system_message}] + list(recent)
+            messages.append({"role": "user", "content": user_message})
+            response_dict = llm.chat(config['small_model'], messages=messages, session_id=session_id,
+                                     options={'temperature': 0}, tools=tools)
+            trigger = tool_call_trigger(response_dict, valid_triggers)
+            # A weak keyword vote that disagrees with the small model counts
+            # as low confidence and is escalated.
+            if trigger and (voted is None or voted == trigger):
+                record(state, 'small_model', time.monotonic() - start)
+                return trigger, 'small_model'
+
+    trigger = tool_call_trigger(call_large(), valid_triggers)
+    record(state, 'large_model', time.monotonic() - start)
+    return trigger, 'large_model'
+
+
+def stats():
+    with stats_lock:
+        return {state: {stage: dict(values) for stage, values in stages.items()}
+                for state, stages in cascade_stats.items()}
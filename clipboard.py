@@ -0,0 +1,163 @@
+import hashlib
+import os
+import re
+
+from history import estimate_tokens
+from session_store import store
+
+# Every session has its own clipboard: the last `capacity` clips, kept as the
+# session store's 'clipboard' log so each clip has a stable id (its sequence
+# number). Changes are reported as deltas for the client to apply:
+#   {'op': 'append', 'id': 7, 'text': '...'}
+#   {'op': 'evict', 'ids': [2]}
+#   {'op': 'clear'}
+
+CLIP_PATTERN = re.compile(r'\\clipboard\+(\d+)')
+CAPACITY = int(os.environ.get('CLIPBOARD_CAPACITY', 5))
+
+# Chat messages do not inline clips. reference() stores each clip once per
+# session under its sha256 and leaves {{clip:<sha256>}} in the message;
+# render() expands the references when the prompt is sent. A clip gets up to
+# CLIP_MAX_TOKENS in the newest message and CLIP_HISTORY_TOKENS in older
+# ones, and is only shown once per prompt. Clips over budget are truncated to
+# their head and tail, or with CLIP_OVERFLOW=summarize replaced by a summary
+# that is computed once and kept with the clip.
+CLIP_REF = re.compile(r'\{\{clip:([0-9a-f]{64})\}\}')
+CLIP_MAX_TOKENS = int(os.environ.get('CLIP_MAX_TOKENS', 4096))
+CLIP_HISTORY_TOKENS = int(os.environ.get('CLIP_HISTORY_TOKENS', 512))
+CLIP_OVERFLOW = os.environ.get('CLIP_OVERFLOW', 'truncate')
+
+CLIP_SUMMARY_PROMPT = """Summarize the text below in at most {budget} tokens so it can stand in for the original in a conversation.
+Keep names, numbers, error messages, identifiers and anything a question about it is likely to need.
+Answer with the summary only."""
+
+
+class SessionClipboard:
+
+    def __init__(self, store, capacity=CAPACITY, log='clipboard'):
+        self.store = store
+        self.capacity = capacity
+        self.log = log
+
+    def items(self, session_id):
+        # [(id, text)], oldest first.
+        return self.store.read(session_id, self.log)[-self.capacity:]
+
+    def add(self, session_id, text):
+        seq = self.store.append(session_id, self.log, text)
+        evicted = [clip_id for clip_id, _ in self.store.read(session_id, self.log) if clip_id <= seq - self.capacity]
+        if evicted:
+            self.store.trim(session_id, self.log, seq - self.capacity)
+        deltas = [{'op': 'append', 'id': seq, 'text': text}]
+        if evicted:
+            deltas.append({'op': 'evict', 'ids': evicted})
+        return deltas
+
+    def clear(self, session_id):
+        self.store.clear_log(session_id, self.log)
+        return [{'op': 'clear'}]
+
+    def reference(self, session_id, prompt):
+        # Replaces every \clipboard+N (N = 1 for the newest clip) in one pass
+        # with a reference to the stored clip; unknown numbers are left as
+        # typed. Returns {'role': 'user', 'content', 'clips', 'clip_tokens'},
+        # where 'clip_tokens' is what the clips cost once they are history.
+        texts = [text for _, text in self.items(session_id)]
+        digests = []
+
+        def replace(match):
+            index = int(match.group(1))
+            if not 1 <= index <= len(texts):
+                return match.group(0)
+            digest = self.save_clip(session_id, texts[-index])
+            if digest not in digests:
+                digests.append(digest)
+            return '{{clip:%s}}' % digest
+
+        content = CLIP_PATTERN.sub(replace, prompt) if '\\clipboard+' in prompt else prompt
+        message = {'role': 'user', 'content': content}
+        if digests:
+            message['clips'] = digests
+            message['clip_tokens'] = sum(min(self.clip(session_id, d)['tokens'], CLIP_HISTORY_TOKENS) for d in digests)
+        return message
+
+    def save_clip(self, session_id, text):
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        key = f'clip:{digest}'
+        if self.store.get(session_id, key) is None:
+            self.store.set(session_id, key, {'text': text, 'tokens': estimate_tokens(text), 'chars': len(text)})
+            index = self.store.get(session_id, 'clip_index', [])
+            self.store.set(session_id, 'clip_index', index + [digest])
+        return digest
+
+    def clip(self, session_id, digest):
+        return self.store.get(session_id, f'clip:{digest}')
+
+    def clip_stats(self, session_id):
+        # Per-clip token counts for the session's stored clips. Ollama only
+        # measures whole prompts, so these are the chars/4 estimates the
+        # budgets use, and named as such.
+        stats = []
+        for digest in self.store.get(session_id, 'clip_index', []):
+            record = self.clip(session_id, digest)
+            if record is not None:
+                stats.append({'hash': digest, 'estimated_tokens': record['tokens'], 'chars': record['chars'],
+                              'estimated_summary_tokens': record.get('summary_tokens')})
+        return stats
+
+    def forget_clips(self, session_id):
+        for digest in self.store.get(session_id, 'clip_index', []):
+            self.store.delete(session_id, f'clip:{digest}')
+        self.store.delete(session_id, 'clip_index')
+
+    def render(self, session_id, messages, summarize=None, newest_budget=CLIP_MAX_TOKENS,
+               history_budget=CLIP_HISTORY_TOKENS):
+        # Returns plain {'role', 'content'} messages with references expanded.
+        # Walks from the newest message so a clip used several times is shown
+        # in full where it was used last and as a pointer elsewhere.
+        shown = set()
+        rendered = []
+        newest_user = True
+        for message in reversed(messages):
+            content = message['content']
+            if message.get('clips'):
+                budget = newest_budget if newest_user else history_budget
+
+                def replace(match):
+                    digest = match.group(1)
+                    if digest in shown:
+                        return f'[clip {digest[:12]}, quoted in a later message]'
+                    shown.add(digest)
+                    record = self.clip(session_id, digest)
+                    if record is None:
+                        return f'[clip {digest[:12]} is no longer available]'
+                    return self.fit(session_id, digest, record, budget, summarize)
+
+                content = CLIP_REF.sub(replace, content)
+            if message['role'] == 'user':
+                newest_user = False
+            rendered.append({'role': message['role'], 'content': content})
+        rendered.reverse()
+        return rendered
+
+    def fit(self, session_id, digest, record, budget, summarize=None):
+        if record['tokens'] <= budget:
+            return record['text']
+        if CLIP_OVERFLOW == 'summarize' and summarize is not None:
+            if record.get('summary') is None:
+                record['summary'] = summarize(session_id, record['text'], budget)
+                record['summary_tokens'] = estimate_tokens(record['summary'])
+                self.store.set(session_id, f'clip:{digest}', record)
+            if record['summary_tokens'] <= budget:
+                return f"[summary of a {record['tokens']}-token clip]\n{record['summary']}"
+        return truncate(record['text'], record['tokens'], budget)
+
+
+def truncate(text, tokens, budget):
+    # Keeps the head and tail of the clip, about `budget` tokens in total.
+    keep = budget * 4 // 2
+    omitted = tokens - budget
+    return f'{text[:keep]}\n[... about {omitted} tokens of this clip omitted ...]\n{text[-keep:]}'
+
+
+clipboards = SessionClipboard(store)
@@ -1,86 +1,152 @@
 from flask import Blueprint, request, jsonify, session
-from collections import defaultdict
-from craft_sm import ToolCraftingProcess
-import subprocess
-import time
+from session_store import store, MessageLog
+from process_cache import processes
+from scheduler import QueueFull
+from streaming import ChunkCoalescer
+from executor import executor, format_execution_result
+from artifacts import artifacts
+import cancellation
+from cancellation import cancellations
+import craft_context
+import telemetry
 
-def create_craft_blueprint(app, socketio):
-    craft_bp = Blueprint('craft', __name__)
+# The routes are registered by create_craft_blueprint for the threaded server;
+# the functions below are shared with the asyncio server (run_async.py). They
+# only need an object with socketio's emit(event, data, to=room).
+
+def load_history(session_id):
+    return MessageLog(store, session_id, 'craft')
+
+def step_listener(socketio, session_id, process):
+    streams = {}
+
+    def on_event(event, payload):
+        # Task steps stream their tokens as 'tool_chunk' frames; every
+        # finished step is announced with 'tool_step' so the client can
+        # follow the state machine while the chain is still running.
+        if event == 'token':
+            coalescer = streams.get(payload['state'])
+            if coalescer is None:
+                coalescer = streams[payload['state']] = ChunkCoalescer(
+                    socketio, 'tool_chunk', room=session_id, extra={'state': payload['state']})
+            coalescer.push(payload['chunk'])
+        elif event == 'step':
+            coalescer = streams.pop(payload['state'], None)
+            if coalescer is not None:
+                coalescer.close()
+            socketio.emit('tool_step', {
+                'state': payload['state'],
+                'next_state': payload['next_state'],
+                'action_type': payload['action_type'],
+                'description': process.get_state_description(),
+                'output': payload['output'] if payload['action_type'] == 'classification' else None,
+            }, to=session_id)
+
+    return on_event
+
+def run_script(socketio, session_id, script, language, history):
+    with telemetry.labelled(route='/craft/execute-script', session=session_id), \
+            processes.use(session_id) as process:
+        streams = {}
+
+        def on_output(stream, text):
+            coalescer = streams.get(stream)
+            if coalescer is None:
+                coalescer = streams[stream] = ChunkCoalescer(
+                    socketio, 'execution_chunk', room=session_id, extra={'stream': stream})
+            coalescer.push(text)
+
+        if language == 'python':
+            result = executor.run_python(script, on_output=on_output)
+        else:
+            result = executor.run_bash(script, on_output=on_output)
+        for coalescer in streams.values():
+            coalescer.close()
+        if result['status'] == 'cancelled':
+            # Killed by a newer run, a cleared session or a closed browser.
+            return
+
+        # Only the bounded digest goes into the history, never the full output.
+        execution_result = format_execution_result(result)
+        history.append(craft_context.entry('assistant', execution_result, kind='result'))
+
+        process.record_execution(result)
+
+        state_message = get_current_state_message(process)
+        socketio.emit('execution_response', {'result': execution_result, 'state': state_message,
+                                             'status': result['status']}, to=session_id)
 
-    tool_crafting_histories = defaultdict(list)
-    tool_processes = {}
+def clear_session(session_id):
+    cancellations.cancel(session_id, ('craft', 'script'), 'clear')
+    store.clear_log(session_id, 'craft')
+    processes.forget(session_id)
+    artifacts.forget_session(session_id)
+    telemetry.tracer.forget(session_id)
 
-    @craft_bp.before_request
-    def initialize_tool_process():
-        session_id = session.get('session')
-        if session_id not in tool_processes:
-            tool_processes[session_id] = ToolCraftingProcess()
+def get_current_state_message(process):
+    # Implement this function to get the current state message
+    return "Current State"  # Placeholder
+
+def create_craft_blueprint(app, socketio, scheduler):
+    craft_bp = Blueprint('craft', __name__)
 
     @craft_bp.route('/craft-tools', methods=['POST'])
     def craft_tools():
         session_id = session['session']
         user_message = request.json.get('prompt')
-        
-        if session_id not in tool_processes:
-            tool_processes[session_id] = ToolCraftingProcess()
-        
-        process = tool_processes[session_id]
-        
+        # A newer requirement, a cleared session or a closed browser cancels
+        # the chain at its next step boundary.
+        token = cancellations.start(session_id, 'craft')
+
         def generate_tool_response():
-            with app.app_context():
-                llm_response = process.process_interaction(user_message, message_history=tool_crafting_histories[session_id])
-                # llm_response = "Hello World"
-                time.sleep(0.5)
+            # The process is only created (or rehydrated) once the job runs.
+            with app.app_context(), telemetry.labelled(route='/craft/craft-tools', session=session_id), \
+                    processes.use(session_id) as process:
+                llm_response = process.process_interaction(user_message, message_history=load_history(session_id),
+                                                           on_event=step_listener(socketio, session_id, process))
                 state_description = process.get_state_description()
-                socketio.emit('tool_response', {'response': llm_response, 'state': state_description})
-        
-        socketio.start_background_task(generate_tool_response)
+                socketio.emit('tool_response', {'response': llm_response, 'state': state_description}, to=session_id)
+
+        def run_cancellable():
+            cancellation.run(token, generate_tool_response, on_cancelled=lambda reason: socketio.emit(
+                'tool_cancelled', {'reason': reason}, to=session_id))
+
+        try:
+            position = scheduler.submit('craft', run_cancellable, session_id)
+        except QueueFull:
+            cancellations.finish(token)
+            return jsonify({'response': "The server is busy, please try again shortly.", 'state': 'rejected'}), 429
+        if position:
+            return jsonify({'response': f"Queued at position {position}...", 'state': 'queued', 'position': position})
         return jsonify({'response': "Processing...", 'state': 'crafting'})
 
     @craft_bp.route('/execute-script', methods=['POST'])
     def execute_script():
         session_id = session['session']
         script = request.json.get('script')
-        
-        process = tool_processes[session_id]
-        
-        tool_crafting_histories[session_id].append({'role': 'user', 'content': script})
-        
+        language = request.json.get('language', 'bash')
+
+        history = load_history(session_id)
+        history.append(craft_context.entry('user', script, kind='script'))
+
+        token = cancellations.start(session_id, 'script')
+
         def execute_script_response():
             with app.app_context():
-                try:
-                    result = subprocess.run(['bash', '-c', script], capture_output=True, text=True)
-                    execution_result = result.stdout if result.returncode == 0 else result.stderr
-                    
-                    tool_crafting_histories[session_id].append({'role': 'assistant', 'content': execution_result})
-                    
-                    process.test_script()
-                    
-                    state_message = get_current_state_message(process)
-                    socketio.emit('execution_response', {'result': execution_result, 'state': state_message})
-                except Exception as e:
-                    error_message = str(e)
-                    
-                    tool_crafting_histories[session_id].append({'role': 'assistant', 'content': error_message})
-                    
-                    state_message = get_current_state_message(process)
-                    socketio.emit('execution_response', {'result': error_message, 'state': state_message})
-        
+                cancellation.run(token, lambda: run_script(socketio, session_id, script, language, history))
+
         socketio.start_background_task(execute_script_response)
         return jsonify({'status': 'executing'})
 
     @craft_bp.route('/clear_craft_history', methods=['POST'])
     def clear_history():
-        session_id = session['session']
-        if session_id in tool_crafting_histories:
-            del tool_crafting_histories[session_id]
-        if session_id in tool_processes:
-            del tool_processes[session_id]
-        print("hello world")
+        clear_session(session['session'])
         return jsonify({'status': 'success'})
 
-    def get_current_state_message(process):
-        # Implement this function to get the current state message
-        return "Current State"  # Placeholder
+    @craft_bp.route('/trace', methods=['GET'])
+    def trace():
+        # The session's recent trace spans: interactions, steps, LLM calls and
+        # script runs, linked by their parent ids.
+        return jsonify(telemetry.tracer.dump(session['session']))
 
-    return craft_bp
\ No newline at end of file
+    return craft_bp
@@ -0,0 +1,130 @@
+import os
+from collections import defaultdict
+
+import telemetry
+from history import estimate_tokens, message_tokens
+
+# What each tool-crafting state gets to see of the session's history.
+#
+# History entries are typed when they are written (see entry()):
+#   requirement  the request that started the current project
+#   proposal     a design proposal; the latest one is the approved design
+#   feedback     the user's comments on a proposal, script or summary
+#   script       a script, written by the model or sent by the user
+#   result       the output of running a script
+#   analysis     the model's analysis of a failed run
+#   summary      the development summary at the end of a project
+#
+# A state takes the latest N entries of the kinds listed for it, in priority
+# order, within its token budget; entries that no longer fit are shortened
+# or left out, and the chosen ones are sent in their original order. Earlier
+# drafts, scripts and runs are never sent, so the prompt of the tenth
+# refinement loop is about as large as the first one's. Only the current
+# project counts: everything before its requirement is ignored.
+#
+# CRAFT_CONTEXT=full sends the whole history instead, as before.
+CONTEXT_MODE = os.environ.get('CRAFT_CONTEXT', 'scoped')
+CONTEXT_TOKENS = int(os.environ.get('CRAFT_CONTEXT_TOKENS', 3000))
+CLASSIFICATION_CONTEXT_TOKENS = int(os.environ.get('CRAFT_CLASSIFICATION_CONTEXT_TOKENS', 1024))
+
+# An entry is shortened rather than dropped if at least this much room is left.
+MIN_ENTRY_TOKENS = 128
+
+STATE_CONTEXT = {
+    'requirement_proposal': {'kinds': [], 'budget': CONTEXT_TOKENS},
+    'review': {'kinds': [('requirement', 1), ('proposal', 1), ('feedback', 2)],
+               'budget': CLASSIFICATION_CONTEXT_TOKENS},
+    'proposal_refinement': {'kinds': [('requirement', 1), ('proposal', 1), ('feedback', 3)],
+                            'budget': CONTEXT_TOKENS},
+    'script_design_and_execution': {'kinds': [('requirement', 1), ('proposal', 1), ('script', 1), ('result', 1),
+                                              ('analysis', 1), ('feedback', 3)],
+                                    'budget': CONTEXT_TOKENS},
+    'script_execution_evaluation': {'kinds': [('requirement', 1), ('script', 1)],
+                                    'budget': CLASSIFICATION_CONTEXT_TOKENS},
+    'script_analysis_and_refinement': {'kinds': [('requirement', 1), ('proposal', 1), ('script', 1)],
+                                       'budget': CONTEXT_TOKENS},
+    'finalize_success': {'kinds': [('requirement', 1), ('proposal', 1), ('script', 1), ('feedback', 2)],
+                         'budget': CONTEXT_TOKENS},
+    'finalize_timeup': {'kinds': [('requirement', 1), ('proposal', 1), ('script', 1), ('analysis', 1),
+                                  ('feedback', 2)],
+                        'budget': CONTEXT_TOKENS},
+    'final_review': {'kinds': [('requirement', 1), ('script', 1), ('summary', 1)],
+                     'budget': CLASSIFICATION_CONTEXT_TOKENS},
+    'end': {'kinds': [('summary', 1)], 'budget': CLASSIFICATION_CONTEXT_TOKENS},
+}
+
+# The kind of the messages a task state writes, by role.
+ENTRY_KINDS = {
+    ('requirement_proposal', 'user'): 'requirement',
+    ('requirement_proposal', 'assistant'): 'proposal',
+    ('proposal_refinement', 'user'): 'feedback',
+    ('proposal_refinement', 'assistant'): 'proposal',
+    ('script_design_and_execution', 'user'): 'feedback',
+    ('script_design_and_execution', 'assistant'): 'script',
+    ('script_analysis_and_refinement', 'user'): 'result',
+    ('script_analysis_and_refinement', 'assistant'): 'analysis',
+    ('finalize_success', 'user'): 'result',
+    ('finalize_success', 'assistant'): 'summary',
+    ('finalize_timeup', 'user'): 'result',
+    ('finalize_timeup', 'assistant'): 'summary',
+}
+
+context_tokens = telemetry.registry.histogram(
+    'craft_context_tokens', 'Estimated history tokens sent with a craft prompt.', ('state',), telemetry.TOKEN_BUCKETS)
+
+
+def entry(role, content, kind=None, state=None):
+    # A history message with its kind, derived from the state that wrote it
+    # unless given.
+    kind = kind or ENTRY_KINDS.get((state, role), 'other')
+    return {'role': role, 'content': content, 'kind': kind, 'state': state}
+
+
+def plain(message, content=None):
+    return {'role': message['role'], 'content': message['content'] if content is None else content}
+
+
+def shorten(text, tokens, budget):
+    # Keeps the beginning and end, which is where scripts have their imports
+    # and entry point and where run output has its errors.
+    keep = budget * 4 // 2
+    return f'{text[:keep]}\n[... about {tokens - budget} tokens omitted ...]\n{text[-keep:]}'
+
+
+def current_project(history):
+    start = 0
+    for index, message in enumerate(history):
+        if message.get('kind') == 'requirement':
+            start = index
+    return list(enumerate(history))[start:]
+
+
+def select(history, state, budget=None, mode=None):
+    # Returns the plain {'role', 'content'} messages to send in `state`.
+    mode = mode or CONTEXT_MODE
+    if mode == 'full' or not any('kind' in message for message in history):
+        # Histories written before entries were typed are sent whole.
+        messages = [plain(message) for message in history]
+    else:
+        config = STATE_CONTEXT[state]
+        remaining = config['budget'] if budget is None else budget
+        by_kind = defaultdict(list)
+        for index, message in current_project(history):
+            by_kind[message.get('kind', 'other')].append((index, message))
+
+        chosen = []
+        for kind, count in config['kinds']:
+            for index, message in reversed(by_kind[kind][-count:]):
+                tokens = message_tokens(message)
+                if tokens <= remaining:
+                    chosen.append((index, plain(message)))
+                    remaining -= tokens
+                elif remaining >= MIN_ENTRY_TOKENS:
+                    fit = remaining - 8
+                    content = shorten(message['content'], estimate_tokens(message['content']), fit)
+                    chosen.append((index, plain(message, content)))
+                    remaining = 0
+        chosen.sort(key=lambda item: item[0])
+        messages = [message for _, message in chosen]
+    context_tokens.observe(sum(message_tokens(message) for message in messages), state=state)
+    return messages
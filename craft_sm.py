@@ -1,17 +1,98 @@
-from transitions import Machine
-import ollama
-from sm_utils import STATE_DESCRIPTIONS_DICT, SYSTEM_MESSAGE_TEMPLATE, extract_trigger, get_tools_with_triggers
+import asyncio
+import os
+import tempfile
+import time
+from collections import deque
+from llm_client import llm, get_async_llm
+from artifacts import artifacts
+from executor import executor, format_execution_result
+import cancellation
+import classifier
+import craft_context
+import speculation
+import telemetry
+from sm_utils import STATE_DESCRIPTIONS_DICT, SHARED_SYSTEM_MESSAGE, SharedMachine, StateMachineSpec, extract_trigger
 
-def craft_call_llm(messages, tools=[]):
-    response_dict = ollama.chat(
-            model='llama3.1:70b',
+CRAFT_MODEL = os.environ.get('CRAFT_MODEL', 'llama3.1:70b')
+
+# 'state_first' puts the state-specific system message before the history.
+# 'prefix_stable' keeps a shared preamble and the history first and puts the
+# state instructions at the tail, so the prompt prefix survives transitions.
+# Reusing the history part of that prefix needs CRAFT_CONTEXT=full. With the
+# default scoped context (craft_context.py) every state selects different
+# entries, so only the shared preamble is certain to be reused.
+PROMPT_LAYOUT = os.environ.get('CRAFT_PROMPT_LAYOUT', 'state_first')
+
+# Every craft call uses the same keep_alive and context size. A different
+# num_ctx makes Ollama reload the model and throws away its cache.
+CRAFT_KEEP_ALIVE = os.environ.get('CRAFT_KEEP_ALIVE', '30m')
+CRAFT_OPTIONS = {'temperature': 0, 'num_ctx': int(os.environ.get('CRAFT_NUM_CTX', 8192))}
+
+# Budget for one process_interaction call, which may chain several steps
+# (classification -> task -> script execution -> evaluation -> ...).
+MAX_STEPS = int(os.environ.get('CRAFT_MAX_STEPS', 20))
+TIME_BUDGET = float(os.environ.get('CRAFT_TIME_BUDGET', 900))
+
+# While a classification call runs, start the task call of the most likely
+# next state. Only worth it when the craft model has spare concurrency.
+SPECULATIVE = os.environ.get('CRAFT_SPECULATIVE', '0') == '1'
+
+# Scripts from script_design_and_execution responses are run automatically
+# only when CRAFT_EXECUTE_SCRIPTS=1. They run on this server as its user, with
+# rlimits but no filesystem or network isolation, so only enable it where
+# that is acceptable. Otherwise the step gets a placeholder outcome.
+EXECUTE_SCRIPTS = os.environ.get('CRAFT_EXECUTE_SCRIPTS', '0') == '1'
+PLACEHOLDER_OUTCOME = "The execution's results: Beijing's temperature is 35 celcicus degree."
+
+# Each process keeps the prompt evaluation of its last few calls only; the
+# llm_prompt_eval_* histograms have the totals.
+PROMPT_EVAL_LOG_SIZE = int(os.environ.get('CRAFT_PROMPT_EVAL_LOG', 32))
+
+def craft_call_llm(messages, tools=[], session_id=None, stream=False):
+    response_dict = llm.chat(
+            CRAFT_MODEL,
             messages=messages,
-            options={'temperature': 0},
+            session_id=session_id,
+            stream=stream,
+            options=CRAFT_OPTIONS,
+            keep_alive=CRAFT_KEEP_ALIVE,
             tools=tools
         )
     return response_dict
 
-class ToolCraftingProcess:
+async def acraft_call_llm(messages, tools=[], session_id=None, stream=False):
+    return await get_async_llm().chat(
+        CRAFT_MODEL,
+        messages=messages,
+        session_id=session_id,
+        stream=stream,
+        options=CRAFT_OPTIONS,
+        keep_alive=CRAFT_KEEP_ALIVE,
+        tools=tools
+    )
+
+def notify(on_event, event, payload):
+    if on_event is not None:
+        on_event(event, payload)
+
+TRANSITIONS = [
+    {'trigger': 'propose_design', 'source': 'requirement_proposal', 'dest': 'review'},
+    {'trigger': 'refine_design', 'source': 'review', 'dest': 'proposal_refinement'}, 
+    {'trigger': 'propose_refined_design', 'source': 'proposal_refinement', 'dest': 'review'}, 
+    {'trigger': 'implement_design', 'source': 'review', 'dest': 'script_design_and_execution'},
+    {'trigger': 'eval_script', 'source': 'script_design_and_execution', 'dest': 'script_execution_evaluation'},
+    {'trigger': 'results_met_expectations', 'source': 'script_execution_evaluation', 'dest': 'finalize_success'},
+    {'trigger': 'results_not_met_expectations', 'source': 'script_execution_evaluation', 'dest': 'script_analysis_and_refinement'},
+    {'trigger': 'iterate', 'source': 'script_analysis_and_refinement', 'dest': 'finalize_timeup', 'conditions': 'max_iterations_reached'},
+    {'trigger': 'iterate', 'source': 'script_analysis_and_refinement', 'dest': 'script_design_and_execution', 'unless': 'max_iterations_reached'},
+    {'trigger': 'summarize_development', 'source': 'finalize_success', 'dest': 'final_review'},
+    {'trigger': 'summarize_development', 'source': 'finalize_timeup', 'dest': 'final_review'},
+    {'trigger': 'refine_tool', 'source': 'final_review', 'dest': 'script_design_and_execution'},
+    {'trigger': 'end_tool_crafting', 'source': 'final_review', 'dest': 'end'},
+    {'trigger': 'new_project', 'source': 'end', 'dest': 'requirement_proposal'}
+]
+
+class ToolCraftingProcess(SharedMachine):
     states = [
         'requirement_proposal',  # Includes information collection
         'review', 
@@ -24,36 +105,51 @@ class ToolCraftingProcess:
         'final_review',
         'end'
     ]
+    transitions = TRANSITIONS
+    max_iterations = 5
 
-    def __init__(self):
-        self.max_iterations = 5
+    # Sessions can number in the tens of thousands, so instances only carry
+    # per-session values; the transition table is shared through SPEC.
+    __slots__ = ('session_id', 'prompt_layout', 'prompt_eval_log', 'prompt_eval_tokens', 'prefetched',
+                 'last_execution', 'iteration_count', 'message', 'evaluation_status')
+
+    def __init__(self, session_id=None, prompt_layout=None):
+        self.session_id = session_id
+        self.prompt_layout = prompt_layout or PROMPT_LAYOUT
+        self.prompt_eval_log = deque(maxlen=PROMPT_EVAL_LOG_SIZE)
+        self.prompt_eval_tokens = 0  # over all calls
+        self.prefetched = None  # A committed SpeculativeCall for the current state
+        self.last_execution = None
         self.iteration_count = 0
         self.message = self.init_message()
-
-        self.transitions = [
-            {'trigger': 'propose_design', 'source': 'requirement_proposal', 'dest': 'review'},
-            {'trigger': 'refine_design', 'source': 'review', 'dest': 'proposal_refinement'}, 
-            {'trigger': 'propose_refined_design', 'source': 'proposal_refinement', 'dest': 'review'}, 
-            {'trigger': 'implement_design', 'source': 'review', 'dest': 'script_design_and_execution'},
-            {'trigger': 'eval_script', 'source': 'script_design_and_execution', 'dest': 'script_execution_evaluation'},
-            {'trigger': 'results_met_expectations', 'source': 'script_execution_evaluation', 'dest': 'finalize_success'},
-            {'trigger': 'results_not_met_expectations', 'source': 'script_execution_evaluation', 'dest': 'script_analysis_and_refinement'},
-            {'trigger': 'iterate', 'source': 'script_analysis_and_refinement', 'dest': 'finalize_timeup', 'conditions': 'max_iterations_reached'},
-            {'trigger': 'iterate', 'source': 'script_analysis_and_refinement', 'dest': 'script_design_and_execution', 'unless': 'max_iterations_reached'},
-            {'trigger': 'summarize_development', 'source': 'finalize_success', 'dest': 'final_review'},
-            {'trigger': 'summarize_development', 'source': 'finalize_timeup', 'dest': 'final_review'},
-            {'trigger': 'refine_tool', 'source': 'final_review', 'dest': 'script_design_and_execution'},
-            {'trigger': 'end_tool_crafting', 'source': 'final_review', 'dest': 'end'},
-            {'trigger': 'new_project', 'source': 'end', 'dest': 'requirement_proposal'}
-        ]
-
-        # Initialize the state machine
-        self.machine = Machine(model=self, states=ToolCraftingProcess.states, transitions=self.transitions, initial='requirement_proposal')
+        self.state = 'requirement_proposal'
         
         self.evaluation_status = 'result_met_expectations'
 
 
 
+    def snapshot(self):
+        # Everything needed to resume this process in another worker; the
+        # message history is stored separately as the session's 'craft' log.
+        return {
+            'state': self.state,
+            'iteration_count': self.iteration_count,
+            'evaluation_status': self.evaluation_status,
+            'prompt_layout': self.prompt_layout,
+            'last_execution': self.last_execution,
+        }
+
+    @classmethod
+    def restore(cls, session_id, snapshot):
+        process = cls(session_id, prompt_layout=snapshot.get('prompt_layout'))
+        if snapshot['state'] not in SPEC.states:
+            raise ValueError(f"Unknown state in snapshot: {snapshot['state']}")
+        process.state = snapshot['state']
+        process.iteration_count = snapshot['iteration_count']
+        process.evaluation_status = snapshot['evaluation_status']
+        process.last_execution = snapshot.get('last_execution')
+        return process
+
     def is_timeup_or_satisfactory(self):
         # Check if the results meet expectations
         return self.evaluation_status == 'result_met_expectations' or self.iteration_count >= self.max_iterations
@@ -80,111 +176,361 @@ class ToolCraftingProcess:
 
     
     def extract_and_save_scripts(self, llm_response):
-        # Extract the scripts from the LLM response.
-        # Save the scripts.
-        # Return the scripts.
-        pass
-        return "The scripts", "The execution commands"
+        # Saves the response's runnable code blocks in the artifact store and
+        # returns (version records, execution commands).
+        saved = artifacts.save_from_response(self.session_id, llm_response)
+        scripts = [record for record, _ in saved]
+        execution_commands = [{'script': record, 'code': code, 'command': record['language']} for record, code in saved]
+        return scripts, execution_commands
     
+    def record_execution(self, result):
+        # Structured outcome of the last script run (status, exit code,
+        # duration, output digest and the limits it ran under).
+        self.last_execution = result
+
     def execute_scripts(self, execution_commands):
-        # Execute the scripts.
-        # Return the outcome.
-        return "The execution's results: Beijing's temperature is 35 celcicus degree."
+        # Runs the scripts in order and stops at the first one that does not
+        # succeed. Byte-identical scripts reuse their memoized result.
+        if not EXECUTE_SCRIPTS:
+            return PLACEHOLDER_OUTCOME
+        if not execution_commands:
+            return "No runnable script was found in the response. Scripts must be in ```python or ```bash code blocks."
+        outcomes = []
+        for item in execution_commands:
+            record = item['script']
+            run = executor.run_python if item['command'] == 'python' else executor.run_bash
+            with tempfile.TemporaryDirectory(prefix='craft-') as workdir:
+                result, cached = artifacts.run(record, item['code'], item['command'],
+                                               lambda code: run(code, cwd=workdir),
+                                               inputs={'session': self.session_id, 'limits': executor.limits})
+            self.record_execution(result)
+            header = f"Script {record['name']} version {record['version']} ({record['hash'][:12]})"
+            if cached:
+                telemetry.scripts_reused.inc(language=item['command'])
+                header += ", unchanged since an earlier run; reusing its result"
+            outcomes.append(header + "\n" + format_execution_result(result))
+            if result['status'] != 'ok':
+                break
+        return "\n\n".join(outcomes)
 
-    
-    def process_interaction(self, user_message, message_history=[]):
-        system_message = self.get_system_message()
-        state_info = STATE_DESCRIPTIONS_DICT[self.state]
-        
-        # Construct messages for LLM
-        messages = [{"role": "system", "content": system_message}]
-        
-        # Add history
-        messages.extend(message_history)
+    def build_messages(self, user_message, message_history, state=None):
+        # Only the part of the history that `state` needs is sent; see craft_context.
+        state = state or self.state
+        context = craft_context.select(message_history, state)
+        if self.prompt_layout == 'prefix_stable':
+            messages = [{"role": "system", "content": SHARED_SYSTEM_MESSAGE}]
+            messages.extend(context)
+            messages.append({"role": "system", "content": SPEC.state_messages[state]})
+        else:
+            messages = [{"role": "system", "content": SPEC.system_messages[state]}]
+            messages.extend(context)
+        messages.append({"role": "user", "content": user_message})
+        return messages
+
+    def record_prompt_eval(self, response_dict, message_count):
+        # Ollama only counts the prompt tokens it had to evaluate, so a reused
+        # prefix shows up as a smaller prompt_eval_count.
+        self.prompt_eval_tokens += response_dict.get('prompt_eval_count') or 0
+        self.prompt_eval_log.append({
+            'state': self.state,
+            'layout': self.prompt_layout,
+            'messages': message_count,
+            'prompt_eval_count': response_dict.get('prompt_eval_count'),
+            'prompt_eval_duration': response_dict.get('prompt_eval_duration'),
+        })
+
+    def call_llm(self, messages, tools, on_token=None):
+        if on_token is None:
+            response_dict = craft_call_llm(messages, tools, session_id=self.session_id)
+            self.record_prompt_eval(response_dict, len(messages))
+            return response_dict
+
+        stream = craft_call_llm(messages, tools, session_id=self.session_id, stream=True)
+        return self.consume_stream(stream, len(messages), on_token)
+
+    def consume_stream(self, stream, message_count, on_token=None):
+        content = []
+        response_dict = {}
+        for chunk in stream:
+            text = chunk['message']['content']
+            content.append(text)
+            if on_token is not None:
+                on_token(text)
+            if chunk.get('done'):
+                response_dict = chunk
+        self.record_prompt_eval(response_dict, message_count)
+        return {'message': {'role': 'assistant', 'content': ''.join(content)}}
+
+    def speculate(self, user_message, message_history):
+        # Starts the task call for the predicted next state. The classification
+        # step leaves the history untouched, so if the prediction is right the
+        # prefetched messages are exactly the ones the next step would send.
+        if llm.limiter(CRAFT_MODEL).limit < 2:
+            # The prefetch would queue in front of the classification call itself.
+            return None
+        trigger = speculation.predict(self.state, self.get_triggers())
+        next_state = SPEC.destinations.get((self.state, trigger))
+        if next_state is None or SPEC.action_types[next_state] != 'task':
+            return None
+        messages = self.build_messages(user_message, message_history, state=next_state)
+        return speculation.SpeculativeCall(
+            self.state, trigger, next_state, messages,
+            call=lambda prefetch_messages: craft_call_llm(prefetch_messages, SPEC.tools[next_state],
+                                                          session_id=self.session_id, stream=True))
+
+    def classify(self, user_message, messages, message_history, tools):
+        if classifier.CASCADE_ENABLED:
+            trigger, _ = classifier.classify(
+                self.state, user_message, self.get_system_message(), message_history, tools,
+                self.get_triggers(), call_large=lambda: self.call_llm(messages, tools),
+                session_id=self.session_id)
+            if trigger is None:
+                raise ValueError(f"No valid trigger for current state: {self.state}")
+            return trigger
+        return self.trigger_from_response(self.call_llm(messages, tools))
+
+    def trigger_from_response(self, response_dict):
+        trigger = response_dict['message']['tool_calls'][0]['function']['arguments']['trigger']
+        return extract_trigger(trigger, SPEC.valid_triggers)
+
+    def process_interaction(self, user_message, message_history=[], on_event=None,
+                            max_steps=MAX_STEPS, time_budget=TIME_BUDGET):
+        # Runs steps until a task state produces a response for the user.
+        # Classification steps and script execution hand their output on to
+        # the next step instead of returning. `on_event(event, payload)` is
+        # told about every streamed token ('token') and finished step ('step').
+        # A cancelled interaction (see cancellation.py) raises Cancelled at
+        # the next step boundary.
+        deadline = time.monotonic() + time_budget if time_budget else None
+        started = time.perf_counter()
+        with telemetry.labelled(session=self.session_id), \
+                telemetry.tracer.span('interaction', state=self.state) as span:
+            try:
+                for _ in range(max_steps):
+                    cancellation.check()
+                    user_message, llm_response = self.timed_step(user_message, message_history, on_event)
+                    if user_message is None:
+                        return llm_response
+                    if deadline is not None and time.monotonic() > deadline:
+                        break
+                span.set(budget_exhausted=True)
+                return (f"Stopped in state '{self.state}' after reaching the step or time budget. "
+                        "Send a message to continue.")
+            finally:
+                span.set(final_state=self.state)
+                telemetry.craft_interaction_seconds.observe(time.perf_counter() - started)
+
+    def timed_step(self, user_message, message_history, on_event=None):
+        # step() inside a trace span, with every LLM call it makes labelled by
+        # the state it started in.
+        state = self.state
+        action_type = SPEC.action_types[state]
+        started = time.perf_counter()
+        outcome = 'error'
+        with telemetry.labelled(state=state), \
+                telemetry.tracer.span('step', state=state, action_type=action_type) as span:
+            try:
+                result = self.step(user_message, message_history, on_event)
+                outcome = 'ok'
+                span.set(next_state=self.state)
+                return result
+            except cancellation.Cancelled:
+                outcome = 'cancelled'
+                raise
+            finally:
+                telemetry.craft_step_seconds.observe(time.perf_counter() - started, state=state,
+                                                     action_type=action_type, outcome=outcome)
+
+    def step(self, user_message, message_history, on_event=None):
+        # Makes one LLM call in the current state. Returns (next_message, response):
+        # next_message is the input for the following step, or None when
+        # response should be returned to the user.
+        state = self.state
+        action_type = SPEC.action_types[state]
         
-        tools = get_tools_with_triggers(state_info['action_type'], self.get_triggers())
-        print(tools)
+        tools = SPEC.tools[state]
 
         # "\n\nUser's message: " + 
         full_user_message = user_message
         
-        # Add the new user message with state context
-        messages.append({"role": "user", "content": full_user_message})
-
-        # Call LLM and get response
-        response_dict = craft_call_llm(messages, tools)
+        # Construct messages for LLM: system message(s), history and the new user message
+        messages = self.build_messages(full_user_message, message_history)
 
         # Process the LLM's response based on the action type
-        if state_info['action_type'] == 'classification':
-            trigger = response_dict['message']['tool_calls'][0]['function']['arguments']['trigger']
-            trigger = extract_trigger(trigger)
-            if trigger in self.get_triggers():
-                # Execute the trigger
-                print(self.state, trigger)
-                getattr(self, trigger)()
-                # Recursively call to get the next system message
-                # If it is a classification task, the user_message will be passed to the next stage.
-                # For example, the feedback to the refinement.
-                return self.process_interaction(user_message, message_history)
-            else:
-                raise ValueError(f"Invalid trigger for current state: {trigger}")
-        else:  # action_type is 'task'
-            llm_response = response_dict['message']['content']
-            print("###################################", self.state, llm_response)
-
-            # Update message history
-            # The message history is only updated during 'task' action_type
-            message_history.append({"role": "user", "content": full_user_message})
-            message_history.append({"role": "assistant", "content": llm_response})
-                
-            # Process task-based states
-            if self.state == 'requirement_proposal':
-                self.propose_design()
-            elif self.state == 'proposal_refinement':
-                self.propose_refined_design()
-            elif self.state == 'script_design_and_execution':
-                self.iteration_count += 1
-                # This will return the design.
-                scripts, execution_commands = self.extract_and_save_scripts(llm_response)
-                # This will execute the codes.
-                execution_outcome = self.execute_scripts(execution_commands)
-                # This will enter the scrip_execution_evaluation state, and no need to return to the user.
-                self.eval_script()
-                # This will enter the evaluation to decide the next state.
-                return self.process_interaction(execution_outcome, message_history)
-            elif self.state == 'script_analysis_and_refinement':
-                # This stage will make analysis based on the exection outcome followed by the evaluation state.
-                self.iterate()
-            elif self.state == 'finalize_success' or self.state == 'finalize_timeup':
-                # This state presents the user the summary of the experiment.
-                # Will go to the final review stage to see the user's sentiment based on the summary.
-                self.clear_iteration_count()
-                self.summarize_development()
-            elif self.state == 'end':
-                # This state is handled by classification, but included for completeness
-                pass
+        if action_type == 'classification':
+            speculative = self.speculate(full_user_message, message_history) if SPECULATIVE else None
+            try:
+                trigger = self.classify(full_user_message, messages, craft_context.select(message_history, state),
+                                        tools)
+            except Exception:
+                if speculative is not None:
+                    speculative.cancel()
+                raise
+            speculation.observe(state, trigger)
+            if speculative is not None:
+                if speculative.trigger == trigger:
+                    self.prefetched = speculative
+                else:
+                    speculative.cancel()
+            return self.apply_trigger(state, trigger, user_message, on_event)
+
+        # action_type is 'task'
+        # Call LLM and get response, streaming the tokens if someone is listening
+        on_token = (lambda chunk: on_event('token', {'state': state, 'chunk': chunk})) if on_event else None
+        prefetched, self.prefetched = self.prefetched, None
+        if prefetched is not None and prefetched.next_state == state and prefetched.messages == messages:
+            response_dict = self.consume_stream(prefetched.commit(), len(messages), on_token)
+        else:
+            if prefetched is not None:
+                prefetched.cancel()
+            response_dict = self.call_llm(messages, tools, on_token=on_token)
+        return self.complete_task(state, full_user_message, response_dict['message']['content'], message_history,
+                                  on_event)
+
+    def apply_trigger(self, state, trigger, user_message, on_event=None):
+        if trigger in self.get_triggers():
+            # Execute the trigger
+            getattr(self, trigger)()
+            notify(on_event, 'step', {'state': state, 'next_state': self.state, 'action_type': 'classification', 'output': trigger})
+            # If it is a classification task, the user_message will be passed to the next stage.
+            # For example, the feedback to the refinement.
+            return user_message, None
+        else:
+            raise ValueError(f"Invalid trigger for current state: {trigger}")
+
+    def complete_task(self, state, full_user_message, llm_response, message_history, on_event=None):
+        # A response that finished after its interaction was cancelled is dropped.
+        cancellation.check()
+        # Update message history
+        # The message history is only updated during 'task' action_type
+        message_history.append(craft_context.entry("user", full_user_message, state=state))
+        message_history.append(craft_context.entry("assistant", llm_response, state=state))
+
+        next_message = None
+        # Process task-based states
+        if self.state == 'requirement_proposal':
+            self.propose_design()
+        elif self.state == 'proposal_refinement':
+            self.propose_refined_design()
+        elif self.state == 'script_design_and_execution':
+            self.iteration_count += 1
+            # This will return the design.
+            scripts, execution_commands = self.extract_and_save_scripts(llm_response)
+            # This will execute the codes.
+            execution_outcome = self.execute_scripts(execution_commands)
+            # This will enter the scrip_execution_evaluation state, and no need to return to the user.
+            self.eval_script()
+            # The evaluation step decides the next state based on the outcome.
+            next_message = execution_outcome
+        elif self.state == 'script_analysis_and_refinement':
+            # This stage will make analysis based on the exection outcome followed by the evaluation state.
+            self.iterate()
+        elif self.state == 'finalize_success' or self.state == 'finalize_timeup':
+            # This state presents the user the summary of the experiment.
+            # Will go to the final review stage to see the user's sentiment based on the summary.
+            self.clear_iteration_count()
+            self.summarize_development()
+        elif self.state == 'end':
+            # This state is handled by classification, but included for completeness
+            pass
+        else:
+            raise ValueError(f"Unexpected state: {self.state}")
+
+        notify(on_event, 'step', {'state': state, 'next_state': self.state, 'action_type': 'task', 'output': llm_response})
+        return next_message, llm_response
+
+    # The asyncio server runs the same steps as coroutines. LLM calls go
+    # through the async client; the classifier cascade and the rest of a
+    # task step, which may run scripts, run in a worker thread. Speculative
+    # prefetching is not used.
+
+    async def aprocess_interaction(self, user_message, message_history=[], on_event=None,
+                                   max_steps=MAX_STEPS, time_budget=TIME_BUDGET):
+        deadline = time.monotonic() + time_budget if time_budget else None
+        started = time.perf_counter()
+        with telemetry.labelled(session=self.session_id), \
+                telemetry.tracer.span('interaction', state=self.state) as span:
+            try:
+                for _ in range(max_steps):
+                    cancellation.check()
+                    user_message, llm_response = await self.atimed_step(user_message, message_history, on_event)
+                    if user_message is None:
+                        return llm_response
+                    if deadline is not None and time.monotonic() > deadline:
+                        break
+                span.set(budget_exhausted=True)
+                return (f"Stopped in state '{self.state}' after reaching the step or time budget. "
+                        "Send a message to continue.")
+            finally:
+                span.set(final_state=self.state)
+                telemetry.craft_interaction_seconds.observe(time.perf_counter() - started)
+
+    async def atimed_step(self, user_message, message_history, on_event=None):
+        state = self.state
+        action_type = SPEC.action_types[state]
+        started = time.perf_counter()
+        outcome = 'error'
+        with telemetry.labelled(state=state), \
+                telemetry.tracer.span('step', state=state, action_type=action_type) as span:
+            try:
+                result = await self.astep(user_message, message_history, on_event)
+                outcome = 'ok'
+                span.set(next_state=self.state)
+                return result
+            except (cancellation.Cancelled, asyncio.CancelledError):
+                outcome = 'cancelled'
+                raise
+            finally:
+                telemetry.craft_step_seconds.observe(time.perf_counter() - started, state=state,
+                                                     action_type=action_type, outcome=outcome)
+
+    async def astep(self, user_message, message_history, on_event=None):
+        state = self.state
+        tools = SPEC.tools[state]
+        messages = self.build_messages(user_message, message_history)
+
+        if SPEC.action_types[state] == 'classification':
+            if classifier.CASCADE_ENABLED:
+                trigger = await asyncio.to_thread(self.classify, user_message, messages,
+                                                  craft_context.select(message_history, state), tools)
             else:
-                raise ValueError(f"Unexpected state: {self.state}")
-        
-        return llm_response
+                trigger = self.trigger_from_response(await self.acall_llm(messages, tools))
+            speculation.observe(state, trigger)
+            return self.apply_trigger(state, trigger, user_message, on_event)
+
+        on_token = (lambda chunk: on_event('token', {'state': state, 'chunk': chunk})) if on_event else None
+        response_dict = await self.acall_llm(messages, tools, on_token=on_token)
+        return await asyncio.to_thread(self.complete_task, state, user_message, response_dict['message']['content'],
+                                       message_history, on_event)
+
+    async def acall_llm(self, messages, tools, on_token=None):
+        if on_token is None:
+            response_dict = await acraft_call_llm(messages, tools, session_id=self.session_id)
+            self.record_prompt_eval(response_dict, len(messages))
+            return response_dict
+
+        stream = await acraft_call_llm(messages, tools, session_id=self.session_id, stream=True)
+        content = []
+        response_dict = {}
+        async for chunk in stream:
+            text = chunk['message']['content']
+            content.append(text)
+            on_token(text)
+            if chunk.get('done'):
+                response_dict = chunk
+        self.record_prompt_eval(response_dict, len(messages))
+        return {'message': {'role': 'assistant', 'content': ''.join(content)}}
         
     def get_triggers(self):
-            state = self.state  # Get the current state of the machine
-            triggers = [t['trigger'] for t in self.transitions if t['source'] == state]  # Extract triggers for the current state
-            return triggers
-    
+        return SPEC.triggers[self.state]  # Triggers available in the current state
+
     def get_system_message(self):
-        available_actions = ', '.join(self.get_triggers())
-        state_info = STATE_DESCRIPTIONS_DICT[self.state]
-        
-        return SYSTEM_MESSAGE_TEMPLATE.format(
-            current_state=self.state,
-            state_description=state_info['description'],
-            available_actions=available_actions,
-            action_type=state_info['action_type'],
-            expected_behavior=state_info['expected_behavior'],
-            response_format=state_info['response_format']
-        )
+        return SPEC.system_messages[self.state]
 
     def get_state_description(self):
-        return STATE_DESCRIPTIONS_DICT[self.state]['description']
\ No newline at end of file
+        return STATE_DESCRIPTIONS_DICT[self.state]['description']
+
+
+# Built once at import; fails loudly if craft_sm.py and sm_utils.py disagree.
+SPEC = StateMachineSpec(ToolCraftingProcess.states, TRANSITIONS, STATE_DESCRIPTIONS_DICT)
+ToolCraftingProcess.bind_spec(SPEC)
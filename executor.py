@@ -0,0 +1,326 @@
+import codecs
+import json
+import os
+import resource
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+import cancellation
+import telemetry
+from zygote import ZygotePool
+
+DEFAULT_LIMITS = {
+    'wall_seconds': float(os.environ.get('SCRIPT_WALL_SECONDS', 60)),
+    'cpu_seconds': int(os.environ.get('SCRIPT_CPU_SECONDS', 30)),
+    'memory_bytes': int(os.environ.get('SCRIPT_MEMORY_BYTES', 1024 * 1024 * 1024)),
+    # RLIMIT_NPROC counts every process of the server's user, not just this
+    # script's, so keep it well above what the server itself runs.
+    'max_processes': int(os.environ.get('SCRIPT_MAX_PROCESSES', 256)),
+    'file_bytes': int(os.environ.get('SCRIPT_FILE_BYTES', 64 * 1024 * 1024)),
+}
+
+CAPTURE_HEAD = 8 * 1024
+CAPTURE_TAIL = 8 * 1024
+READ_SIZE = 4096
+
+
+class OutputDigest:
+    # Keeps the first `head` and last `tail` bytes of a stream and counts the
+    # rest, so a script that prints gigabytes costs a fixed amount of memory.
+
+    def __init__(self, head=CAPTURE_HEAD, tail=CAPTURE_TAIL):
+        self.head_limit = head
+        self.tail_limit = tail
+        self.head = bytearray()
+        self.tail = deque()
+        self.tail_bytes = 0
+        self.total = 0
+
+    def feed(self, data):
+        self.total += len(data)
+        room = self.head_limit - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if not data:
+            return
+        self.tail.append(data)
+        self.tail_bytes += len(data)
+        while self.tail and self.tail_bytes - len(self.tail[0]) >= self.tail_limit:
+            self.tail_bytes -= len(self.tail.popleft())
+
+    @property
+    def truncated(self):
+        return self.total > len(self.head) + min(self.tail_bytes, self.tail_limit)
+
+    def text(self):
+        tail = b''.join(self.tail)[-self.tail_limit:]
+        omitted = self.total - len(self.head) - len(tail)
+        parts = [self.head.decode('utf-8', 'replace')]
+        if omitted > 0:
+            parts.append(f'\n... [{omitted} bytes omitted] ...\n')
+        parts.append(tail.decode('utf-8', 'replace'))
+        return ''.join(parts)
+
+
+def rlimits(limits):
+    return [
+        ('RLIMIT_CPU', limits['cpu_seconds'], limits['cpu_seconds'] + 1),
+        ('RLIMIT_AS', limits['memory_bytes'], limits['memory_bytes']),
+        ('RLIMIT_NPROC', limits['max_processes'], limits['max_processes']),
+        ('RLIMIT_FSIZE', limits['file_bytes'], limits['file_bytes']),
+    ]
+
+
+def apply_limits(limits):
+    def set_limits():
+        for name, soft, hard in rlimits(limits):
+            resource.setrlimit(getattr(resource, name), (soft, hard))
+    return set_limits
+
+
+# Subprocess runs start under this trampoline, which sets the rlimits in its
+# own process and then execs the command. The server is threaded, so running
+# Python between fork and exec (preexec_fn) could deadlock the child on a lock
+# another thread held; setting them with prlimit after the spawn would leave
+# the command running unlimited for a moment. Like Popen's restore_signals,
+# it also undoes the interpreter ignoring SIGPIPE and SIGXFSZ.
+LIMITS_TRAMPOLINE = """\
+import json, os, resource, signal, sys
+for name, soft, hard in json.loads(sys.argv[1]):
+    resource.setrlimit(getattr(resource, name), (soft, hard))
+for signum in (signal.SIGPIPE, signal.SIGXFSZ):
+    signal.signal(signum, signal.SIG_DFL)
+try:
+    os.execvp(sys.argv[2], sys.argv[2:])
+except OSError as e:
+    sys.stderr.write(f'{sys.argv[2]}: {e.strerror}\\n')
+    os._exit(127)
+"""
+
+
+def limited(command, limits):
+    return [sys.executable, '-I', '-S', '-c', LIMITS_TRAMPOLINE, json.dumps(rlimits(limits))] + list(command)
+
+
+def classify_exit(returncode, timed_out, stderr_text):
+    if timed_out:
+        return 'timeout'
+    if returncode == 0:
+        return 'ok'
+    if returncode in (-signal.SIGXCPU, 128 + signal.SIGXCPU):
+        return 'cpu_limit'
+    if returncode in (-signal.SIGXFSZ, 128 + signal.SIGXFSZ):
+        return 'file_size_limit'
+    if 'MemoryError' in stderr_text or 'Cannot allocate memory' in stderr_text:
+        return 'memory_limit'
+    if returncode < 0:
+        return 'killed'
+    return 'failed'
+
+
+class ScriptExecutor:
+    # Runs scripts on a bounded number of workers. Each run gets a new process
+    # group with rlimits on CPU, memory, processes and file size plus a
+    # wall-clock timeout. Output is passed to `on_output(stream, text)` as it
+    # arrives and only a head/tail digest is kept. Cancelling the caller's
+    # cancellation token kills the run's process group; its result then has
+    # the status 'cancelled'.
+
+    def __init__(self, workers=2, limits=None, zygotes=None):
+        self.workers = workers
+        self.zygotes = zygotes
+        self.slots = threading.BoundedSemaphore(workers)
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.lock = threading.Lock()
+        self.counters = {'runs': 0, 'running': 0}
+
+    def run_bash(self, script, on_output=None, cwd=None, limits=None):
+        return self.run(['bash', '-c', script], on_output=on_output, cwd=cwd, limits=limits)
+
+    def run(self, command, on_output=None, cwd=None, limits=None, stdin_data=None):
+        limits = dict(self.limits, **(limits or {}))
+        return self._measured('subprocess', lambda: self._run(command, on_output, cwd, limits, stdin_data))
+
+    def _measured(self, runner, run):
+        # Runs `run()` in a worker slot, timing the wait for the slot and the
+        # run itself.
+        queued = time.monotonic()
+        with telemetry.tracer.span('script', runner=runner) as span, self.slots:
+            telemetry.script_queue_seconds.observe(time.monotonic() - queued, runner=runner)
+            cancellation.check()
+            with self.lock:
+                self.counters['runs'] += 1
+                self.counters['running'] += 1
+            try:
+                result = run()
+            finally:
+                with self.lock:
+                    self.counters['running'] -= 1
+            telemetry.script_seconds.observe(result['duration'], runner=runner, status=result['status'])
+            span.set(status=result['status'], returncode=result['returncode'], duration=result['duration'])
+            return result
+
+    def _run(self, command, on_output, cwd, limits, stdin_data):
+        start = time.monotonic()
+        try:
+            proc = subprocess.Popen(
+                limited(command, limits), cwd=cwd,
+                stdin=subprocess.PIPE if stdin_data is not None else subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                start_new_session=True)
+        except OSError as e:
+            return {'status': 'error', 'returncode': None, 'duration': 0.0, 'stdout': '', 'stderr': str(e),
+                    'stdout_bytes': 0, 'stderr_bytes': 0, 'truncated': False, 'limits': limits}
+
+        token = cancellation.current()
+        unregister = token.on_cancel(lambda: kill_group(proc.pid)) if token is not None else None
+        digests, readers = self._start_readers(proc.stdout, proc.stderr, on_output)
+        if stdin_data is not None:
+            try:
+                proc.stdin.write(stdin_data.encode('utf-8'))
+                proc.stdin.close()
+            except OSError:
+                pass
+
+        timed_out = False
+        try:
+            proc.wait(timeout=limits['wall_seconds'])
+        except subprocess.TimeoutExpired:
+            timed_out = True
+        if unregister is not None:
+            unregister()
+        # Also removes background processes the script left behind, which
+        # would otherwise keep the pipes open.
+        kill_group(proc.pid)
+        proc.wait()
+        for reader in readers:
+            reader.join()
+        return self._result(proc.returncode, timed_out, start, digests, limits, token)
+
+    def run_python(self, code, on_output=None, cwd=None, limits=None):
+        # Python tools run in a fork of a warm zygote when the pool is
+        # enabled, otherwise in a fresh interpreter.
+        if self.zygotes is None:
+            return self.run([sys.executable, '-c', code], on_output=on_output, cwd=cwd, limits=limits)
+        limits = dict(self.limits, **(limits or {}))
+        return self._measured('zygote', lambda: self._run_forked(code, on_output, cwd, limits))
+
+    def _run_forked(self, code, on_output, cwd, limits):
+        start = time.monotonic()
+        out_read, out_write = os.pipe()
+        err_read, err_write = os.pipe()
+        try:
+            replies, pid = self.zygotes.spawn(code, out_write, err_write, limits, cwd=cwd)
+        except OSError as e:
+            os.close(out_read)
+            os.close(err_read)
+            return {'status': 'error', 'returncode': None, 'duration': 0.0, 'stdout': '', 'stderr': str(e),
+                    'stdout_bytes': 0, 'stderr_bytes': 0, 'truncated': False, 'limits': limits}
+        finally:
+            os.close(out_write)
+            os.close(err_write)
+
+        token = cancellation.current()
+        unregister = token.on_cancel(lambda: kill_group(pid)) if token is not None else None
+        digests, readers = self._start_readers(os.fdopen(out_read, 'rb'), os.fdopen(err_read, 'rb'), on_output)
+        timed_out = False
+        try:
+            returncode = replies.read(timeout=limits['wall_seconds'])['returncode']
+        except TimeoutError:
+            timed_out = True
+            kill_group(pid)
+            returncode = replies.read()['returncode']
+        finally:
+            replies.close()
+            if unregister is not None:
+                unregister()
+        kill_group(pid)
+        for reader in readers:
+            reader.join()
+        return self._result(returncode, timed_out, start, digests, limits, token)
+
+    def _start_readers(self, stdout, stderr, on_output):
+        digests = {'stdout': OutputDigest(), 'stderr': OutputDigest()}
+        readers = [
+            threading.Thread(target=self._pump, args=(stdout, 'stdout', digests['stdout'], on_output), daemon=True),
+            threading.Thread(target=self._pump, args=(stderr, 'stderr', digests['stderr'], on_output), daemon=True),
+        ]
+        for reader in readers:
+            reader.start()
+        return digests, readers
+
+    def _result(self, returncode, timed_out, start, digests, limits, token=None):
+        stderr_text = digests['stderr'].text()
+        cancelled = token is not None and token.cancelled
+        return {
+            'status': 'cancelled' if cancelled else classify_exit(returncode, timed_out, stderr_text),
+            'returncode': returncode,
+            'duration': time.monotonic() - start,
+            'stdout': digests['stdout'].text(),
+            'stderr': stderr_text,
+            'stdout_bytes': digests['stdout'].total,
+            'stderr_bytes': digests['stderr'].total,
+            'truncated': digests['stdout'].truncated or digests['stderr'].truncated,
+            'limits': limits,
+        }
+
+    def _pump(self, pipe, name, digest, on_output):
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        with pipe:
+            while True:
+                data = pipe.read1(READ_SIZE)
+                if not data:
+                    return
+                digest.feed(data)
+                if on_output is not None:
+                    text = decoder.decode(data)
+                    if text:
+                        on_output(name, text)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters, workers=self.workers)
+        if self.zygotes is not None:
+            stats['zygotes'] = self.zygotes.stats()
+        return stats
+
+
+def kill_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def format_execution_result(result):
+    # Text for the message history: status first, then the captured output.
+    lines = [f"Execution status: {result['status']} (exit code {result['returncode']}, {result['duration']:.1f}s)"]
+    if result['status'] == 'timeout':
+        lines.append(f"The script was stopped after the {result['limits']['wall_seconds']}s wall-clock limit.")
+    elif result['status'] == 'cpu_limit':
+        lines.append(f"The script exceeded the {result['limits']['cpu_seconds']}s CPU time limit.")
+    elif result['status'] == 'memory_limit':
+        lines.append(f"The script exceeded the {result['limits']['memory_bytes']} byte memory limit.")
+    elif result['status'] == 'file_size_limit':
+        lines.append(f"The script tried to write a file larger than {result['limits']['file_bytes']} bytes.")
+    elif result['status'] == 'cancelled':
+        lines.append("The script was stopped because its request was cancelled.")
+    if result.get('truncated'):
+        lines.append("Output was truncated to its beginning and end.")
+    if result.get('stdout'):
+        lines.append("--- stdout ---\n" + result['stdout'])
+    if result.get('stderr'):
+        lines.append("--- stderr ---\n" + result['stderr'])
+    return '\n'.join(lines)
+
+
+executor = ScriptExecutor(
+    workers=int(os.environ.get('SCRIPT_WORKERS', 2)),
+    zygotes=ZygotePool(processes=int(os.environ.get('ZYGOTE_PROCESSES', 1)))
+    if os.environ.get('ZYGOTE_POOL', '1') != '0' else None,
+)
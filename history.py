@@ -0,0 +1,134 @@
+from session_store import MemoryStore
+
+SUMMARY_PROMPT = """Summarize the conversation below so it can replace the original messages as context for the rest of the chat.
+Keep every fact, requirement, decision, file name, code identifier and open question. Drop greetings and repetition.
+Answer with the summary only."""
+
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text and code, which is
+    # close enough for budgeting without loading a tokenizer.
+    return (len(text) + 3) // 4
+
+
+def message_tokens(message):
+    # A few extra tokens for the role and the chat template around each
+    # message, plus what its clip references expand to.
+    return estimate_tokens(message['content']) + 4 + message.get('clip_tokens', 0)
+
+
+class ChatHistoryManager:
+    # Keeps per-session chat history within a token budget.
+    #
+    # Recent messages are kept verbatim. Once a session goes over the budget,
+    # the oldest messages are folded into a rolling summary (the previous
+    # summary plus the newly folded messages are summarized again) and the
+    # folded messages are dropped, so both memory and the prompt sent to the
+    # model stay bounded. Compaction folds down to `low_water` of the budget
+    # so the summarizer runs once every few turns rather than on every turn.
+    #
+    # Messages live in the session store's `log` and the summary in a store
+    # value, so every worker process sees the same history.
+
+    def __init__(self, summarize, token_budget=3000, summary_budget=512, low_water=0.5, keep_recent=2,
+                 store=None, log='chat'):
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.summary_budget = summary_budget
+        self.low_water = low_water
+        self.keep_recent = keep_recent
+        self.store = store if store is not None else MemoryStore()
+        self.log = log
+        self.summary_key = f'{log}_summary'
+        self.measured_key = f'{log}_measured_prompt_tokens'
+
+    def append(self, session_id, message):
+        self.store.append(session_id, self.log, message)
+
+    def clear(self, session_id):
+        self.store.clear_log(session_id, self.log)
+        self.store.delete(session_id, self.summary_key)
+        self.store.delete(session_id, self.measured_key)
+
+    def record_prompt_tokens(self, session_id, prompt_eval_count):
+        # Ollama reports the real prompt size in the last streamed chunk.
+        if prompt_eval_count:
+            self.store.set(session_id, self.measured_key, prompt_eval_count)
+
+    def prompt_messages(self, session_id):
+        # Returns the messages to send to the model for this session,
+        # compacting older history first if the session is over budget.
+        self.compact(session_id)
+        messages = [message for _, message in self.store.read(session_id, self.log)]
+        summary = self.store.get(session_id, self.summary_key)
+        if summary:
+            messages.insert(0, {'role': 'system', 'content': 'Summary of the earlier conversation:\n' + summary['text']})
+        return messages
+
+    def compact(self, session_id):
+        entries = self.store.read(session_id, self.log)
+        history = [message for _, message in entries]
+        summary = self.store.get(session_id, self.summary_key)
+        summary_tokens = summary['tokens'] if summary else 0
+        recent_budget = self.token_budget - self.summary_budget
+
+        if summary_tokens + sum(message_tokens(m) for m in history) <= self.token_budget:
+            return
+
+        # Walk back from the newest message and keep as much as fits under the
+        # low-water mark, but always keep the last `keep_recent` messages.
+        target = recent_budget * self.low_water
+        kept_tokens = 0
+        split = len(history)
+        while split > 0:
+            tokens = message_tokens(history[split - 1])
+            if len(history) - split >= self.keep_recent and kept_tokens + tokens > target:
+                break
+            kept_tokens += tokens
+            split -= 1
+        if split == 0:
+            return
+
+        folded = history[:split]
+        text = self.summarize(session_id, summary['text'] if summary else None, folded)
+        upto = entries[split - 1][0]
+        new_summary = {
+            'text': text,
+            'tokens': estimate_tokens(text),
+            'folded': (summary['folded'] if summary else 0) + len(folded),
+            'upto': upto,
+        }
+
+        # Another worker may have compacted the same messages meanwhile; the
+        # summary covering more of the log wins. Messages appended while the
+        # summarizer was running have higher sequence numbers and are kept.
+        current = self.store.get(session_id, self.summary_key)
+        if current and current.get('upto', 0) >= upto:
+            return
+        self.store.set(session_id, self.summary_key, new_summary)
+        self.store.trim(session_id, self.log, upto)
+
+    def token_counts(self, session_id):
+        history = [message for _, message in self.store.read(session_id, self.log)]
+        summary = self.store.get(session_id, self.summary_key)
+        measured = self.store.get(session_id, self.measured_key)
+        history_tokens = sum(message_tokens(m) for m in history)
+        summary_tokens = summary['tokens'] if summary else 0
+        return {
+            'token_budget': self.token_budget,
+            'verbatim_messages': len(history),
+            'verbatim_tokens': history_tokens,
+            'summary_tokens': summary_tokens,
+            'folded_messages': summary['folded'] if summary else 0,
+            'prompt_tokens': history_tokens + summary_tokens,
+            'last_measured_prompt_tokens': measured,
+        }
+
+
+def format_for_summary(previous_summary, messages):
+    parts = []
+    if previous_summary:
+        parts.append('Summary so far:\n' + previous_summary)
+    for message in messages:
+        parts.append(f"{message['role']}: {message['content']}")
+    return '\n\n'.join(parts)
@@ -0,0 +1,277 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+
+def is_deterministic(options):
+    options = options or {}
+    return options.get('temperature', None) == 0
+
+
+def to_plain(response):
+    # ChatResponse objects from the ollama client -> plain dicts for storage.
+    if hasattr(response, 'model_dump'):
+        return response.model_dump(exclude_none=True)
+    return dict(response)
+
+
+def stream_chunks(response):
+    # Splits a stored response back into stream chunks: one per word of the
+    # content, then a final chunk that carries the rest of the response, so a
+    # cached reply streams to the client like a generated one.
+    message = response.get('message') or {}
+    words = re.findall(r'\S+\s*|\s+', message.get('content') or '')
+    base = {key: value for key, value in response.items() if key in ('model', 'created_at')}
+    chunks = [dict(base, message={'role': message.get('role', 'assistant'), 'content': word}, done=False)
+              for word in words]
+    chunks.append(dict(response, message=dict(message, content='')))
+    return chunks
+
+
+class Flight:
+    # The end of one in-flight call, which threads and coroutines can wait for.
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.waiters = []  # (loop, future) of waiting coroutines
+        self.lock = threading.Lock()
+
+    def wait(self):
+        self.event.wait()
+
+    async def wait_async(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.waiters.append((loop, future))
+        await future
+
+    def set(self):
+        with self.lock:
+            self.event.set()
+            waiters, self.waiters = self.waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(lambda future=future: future.done() or future.set_result(None))
+
+
+class ResponseCache:
+    # Content-addressed cache for deterministic (temperature 0) LLM calls.
+    #
+    # Keys are the sha256 of model, messages, tools and options. Values live
+    # in an in-memory LRU bounded by total bytes, and optionally in a
+    # directory on disk that survives restarts, bounded the same way by
+    # `disk_max_bytes`. The disk LRU order is the files' mtimes, which reads
+    # refresh. Each process evicts among the files it has found at startup,
+    # written or read, so workers sharing a directory can overshoot the bound
+    # by what the others wrote since. get_or_call() makes
+    # concurrent identical requests share one upstream call; aget_or_call()
+    # does the same for coroutines, and the two wait for each other.
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, cache_dir=None, disk_max_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.entries = OrderedDict()  # key -> (encoded value, size)
+        self.total_bytes = 0
+        self.disk_entries = OrderedDict()  # key -> size, least recently used first
+        self.disk_bytes = 0
+        self.in_flight = {}  # key -> Flight
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0,
+                         'disk_evictions': 0}
+        if cache_dir:
+            self._scan_disk()
+
+    @staticmethod
+    def key(model, messages, tools=None, options=None, **extra):
+        payload = {'model': model, 'messages': messages, 'tools': tools or [], 'options': options or {}}
+        if extra.get('format'):
+            payload['format'] = extra['format']
+        encoded = json.dumps(payload, sort_keys=True, default=str)
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return json.loads(entry[0])
+
+        encoded = self._read_disk(key)
+        if encoded is None:
+            return None
+        with self.lock:
+            self.counters['disk_hits'] += 1
+            self._store_memory(key, encoded)
+        return json.loads(encoded)
+
+    def put(self, key, value):
+        encoded = json.dumps(value, default=str)
+        with self.lock:
+            self._store_memory(key, encoded)
+        self._write_disk(key, encoded)
+
+    def get_or_call(self, key, call):
+        # Returns (value, hit). Only one caller per key runs `call`; the
+        # others wait for it and read the stored result.
+        while True:
+            value = self.get(key)
+            if value is not None:
+                return value, True
+            with self.lock:
+                event = self.in_flight.get(key)
+                if event is None:
+                    event = self.in_flight[key] = Flight()
+                    self.counters['misses'] += 1
+                    break
+                self.counters['coalesced'] += 1
+            event.wait()
+            value = self.get(key)
+            if value is not None:
+                return value, True
+            # The leader failed; try again and possibly become the leader.
+
+        try:
+            value = to_plain(call())
+            self.put(key, value)
+            return value, False
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            event.set()
+
+    async def aget_or_call(self, key, call):
+        # get_or_call() for a coroutine function `call`.
+        while True:
+            value = self.get(key)
+            if value is not None:
+                return value, True
+            with self.lock:
+                event = self.in_flight.get(key)
+                if event is None:
+                    event = self.in_flight[key] = Flight()
+                    self.counters['misses'] += 1
+                    break
+                self.counters['coalesced'] += 1
+            await event.wait_async()
+            value = self.get(key)
+            if value is not None:
+                return value, True
+
+        try:
+            value = to_plain(await call())
+            self.put(key, value)
+            return value, False
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            event.set()
+
+    def record_miss(self):
+        with self.lock:
+            self.counters['misses'] += 1
+
+    def _store_memory(self, key, encoded):
+        size = len(encoded)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (encoded, size)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+            self.counters['evictions'] += 1
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def _scan_disk(self):
+        found = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    info = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                found.append((info.st_mtime, name[:-len('.json')], info.st_size))
+        with self.lock:
+            for _, key, size in sorted(found):
+                self.disk_entries[key] = size
+                self.disk_bytes += size
+            evicted = self._evict_disk()
+        self._remove(evicted)
+
+    def _read_disk(self, key):
+        if not self.cache_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                encoded = f.read()
+        except FileNotFoundError:
+            with self.lock:
+                self.disk_bytes -= self.disk_entries.pop(key, 0)
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self._track_disk(key, len(encoded.encode('utf-8')))
+        return encoded
+
+    def _write_disk(self, key, encoded):
+        if not self.cache_dir:
+            return
+        size = len(encoded.encode('utf-8'))
+        if size > self.disk_max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(encoded)
+        os.replace(tmp_path, path)
+        self._track_disk(key, size)
+
+    def _track_disk(self, key, size):
+        # Marks `key` as the most recently used file, including files another
+        # worker wrote, and deletes the least recently used ones over the bound.
+        with self.lock:
+            self.disk_bytes += size - self.disk_entries.pop(key, 0)
+            self.disk_entries[key] = size
+            evicted = self._evict_disk()
+        self._remove(evicted)
+
+    def _evict_disk(self):
+        # Called with the lock held; returns the keys whose files to delete.
+        evicted = []
+        while self.disk_bytes > self.disk_max_bytes:
+            key, size = self.disk_entries.popitem(last=False)
+            self.disk_bytes -= size
+            self.counters['disk_evictions'] += 1
+            evicted.append(key)
+        return evicted
+
+    def _remove(self, keys):
+        for key in keys:
+            try:
+                os.unlink(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries), bytes=self.total_bytes, max_bytes=self.max_bytes,
+                        disk_entries=len(self.disk_entries), disk_bytes=self.disk_bytes,
+                        disk_max_bytes=self.disk_max_bytes)
@@ -0,0 +1,378 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import ollama
+
+import cancellation
+import llm_record
+import telemetry
+from llm_cache import ResponseCache, is_deterministic, stream_chunks, to_plain
+
+DEFAULT_CONCURRENCY = 2
+
+
+def parse_concurrency(spec):
+    # "codellama:13b=4,llama3.1:70b=1" -> {'codellama:13b': 4, 'llama3.1:70b': 1}
+    limits = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        model, _, limit = item.rpartition('=')
+        limits[model.strip()] = int(limit)
+    return limits
+
+
+class FairLimiter:
+    # Caps the number of in-flight requests for one model.
+    #
+    # Waiters are queued per session and slots are handed out round-robin
+    # across sessions: after a session gets a slot it moves to the back of the
+    # line, so a session with many queued requests cannot starve the others.
+    # A waiter whose cancellation token is cancelled leaves the queue.
+    #
+    # Threads wait in acquire() and coroutines in acquire_async(), in the same
+    # queue, so the threaded and asyncio clients of a process share one cap.
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiting = OrderedDict()  # session key -> deque of tickets
+        self.cond = threading.Condition()
+
+    def acquire(self, key=None, token=None):
+        ticket = object()
+        unregister = token.on_cancel(self._wake) if token is not None else None
+        try:
+            with self.cond:
+                queue = self.waiting.setdefault(key, deque())
+                queue.append(ticket)
+                while self.active >= self.limit or self._head() is not ticket:
+                    if token is not None and token.cancelled:
+                        self._leave(key, ticket)
+                        token.check()
+                    self.cond.wait()
+                self._take(key)
+        finally:
+            if unregister is not None:
+                unregister()
+
+    async def acquire_async(self, key=None):
+        # A cancelled task leaves the queue, or gives back a slot it was
+        # granted but had not resumed to use.
+        ticket = AsyncTicket(asyncio.get_running_loop(), self)
+        with self.cond:
+            self.waiting.setdefault(key, deque()).append(ticket)
+            self._dispatch()
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            with self.cond:
+                queue = self.waiting.get(key)
+                if queue is not None and ticket in queue:
+                    self._leave(key, ticket)
+                    raise
+            if not ticket.future.cancelled():
+                self.release()
+            raise
+
+    def _take(self, key):
+        # Caller holds cond: the head ticket of `key` gets a slot and the
+        # session moves to the back of the line.
+        queue = self.waiting.pop(key)
+        queue.popleft()
+        if queue:
+            self.waiting[key] = queue
+        self.active += 1
+        self._dispatch()
+
+    def _leave(self, key, ticket):
+        queue = self.waiting[key]
+        queue.remove(ticket)
+        if not queue:
+            del self.waiting[key]
+        self._dispatch()
+
+    def _dispatch(self):
+        # Caller holds cond. Coroutines at the head of the line are granted
+        # their slots here; threads take theirs when woken.
+        while self.active < self.limit and self.waiting:
+            key = next(iter(self.waiting))
+            ticket = self.waiting[key][0]
+            if not isinstance(ticket, AsyncTicket):
+                break
+            queue = self.waiting.pop(key)
+            queue.popleft()
+            if queue:
+                self.waiting[key] = queue
+            self.active += 1
+            ticket.loop.call_soon_threadsafe(ticket.grant)
+        self.cond.notify_all()
+
+    def _wake(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self._dispatch()
+
+    def queued(self):
+        with self.cond:
+            return sum(len(queue) for queue in self.waiting.values())
+
+    def _head(self):
+        return self.waiting[next(iter(self.waiting))][0]
+
+
+class AsyncTicket:
+    # A coroutine's place in a FairLimiter queue.
+
+    def __init__(self, loop, limiter):
+        self.loop = loop
+        self.limiter = limiter
+        self.future = loop.create_future()
+
+    def grant(self):
+        # Runs on the loop. A waiter cancelled after the slot was handed out
+        # gives it back.
+        if self.future.cancelled():
+            self.limiter.release()
+        elif not self.future.done():
+            self.future.set_result(None)
+
+
+class LLMClient:
+    # One Ollama client for the whole app. The underlying httpx client keeps
+    # its connections open between calls, and every request waits for a slot
+    # of its model's FairLimiter before it is sent. Temperature-0 requests are
+    # answered from the response cache when possible. Calls that reach the
+    # model are measured by telemetry.LLMCall, and can be recorded or
+    # replayed from a recording (see llm_record.py).
+
+    client_class = ollama.Client
+
+    def __init__(self, host=None, concurrency=None, default_concurrency=DEFAULT_CONCURRENCY, cache=None,
+                 share_limits_with=None):
+        # `share_limits_with` is another client whose per-model limiters this
+        # one uses too, so the two together stay within each model's limit.
+        self.client = llm_record.wrap(self.client_class(host=host))
+        self.cache = cache
+        self.concurrency = concurrency or {}
+        self.default_concurrency = default_concurrency
+        if share_limits_with is None:
+            self.limiters = {}
+            self.lock = threading.Lock()
+        else:
+            self.limiters = share_limits_with.limiters
+            self.lock = share_limits_with.lock
+
+    def limiter(self, model):
+        with self.lock:
+            if model not in self.limiters:
+                self.limiters[model] = FairLimiter(self.concurrency.get(model, self.default_concurrency))
+            return self.limiters[model]
+
+    def chat(self, model, messages, session_id=None, stream=False, use_cache=True, **kwargs):
+        if not (use_cache and self.cache and is_deterministic(kwargs.get('options'))):
+            return self._call(model, messages, session_id, stream, kwargs)
+
+        key = self.cache.key(model, messages, **kwargs)
+        if not stream:
+            response, _ = self.cache.get_or_call(key, lambda: self._call(model, messages, session_id, False, kwargs))
+            return response
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            return iter(stream_chunks(cached))
+        self.cache.record_miss()
+        return self._record_stream(key, self._call(model, messages, session_id, True, kwargs))
+
+    def _record_stream(self, key, stream):
+        # Passes chunks through and stores the combined response once the
+        # stream has finished. Abandoned streams are not cached.
+        content = []
+        for chunk in stream:
+            content.append(chunk['message']['content'])
+            if chunk.get('done'):
+                final = to_plain(chunk)
+                final['message'] = dict(final['message'], content=''.join(content))
+                self.cache.put(key, final)
+            yield chunk
+
+    def _call(self, model, messages, session_id, stream, kwargs):
+        if stream:
+            return self._stream(model, messages, session_id, kwargs)
+        token = cancellation.current()
+        limiter = self.limiter(model)
+        queued = time.monotonic()
+        limiter.acquire(session_id, token)
+        call = telemetry.LLMCall(model, time.monotonic() - queued, stream=False)
+        error = None
+        try:
+            response = self.client.chat(model=model, messages=messages, stream=False, **kwargs)
+            call.chunk(response)
+            return response
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            call.end(error)
+            limiter.release()
+
+    def _stream(self, model, messages, session_id, kwargs):
+        # Nothing happens until the first chunk is requested. The slot is
+        # held from then until the stream is exhausted, closed or cancelled;
+        # closing the stream also closes the HTTP response, which makes Ollama
+        # stop generating. A cancelled call stops at its next chunk.
+        token = cancellation.current()
+        limiter = self.limiter(model)
+        queued = time.monotonic()
+        limiter.acquire(session_id, token)
+        call = telemetry.LLMCall(model, time.monotonic() - queued, stream=True)
+        error = None
+        stream = None
+        try:
+            stream = self.client.chat(model=model, messages=messages, stream=True, **kwargs)
+            for chunk in stream:
+                if token is not None:
+                    token.check()
+                call.chunk(chunk)
+                yield chunk
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if stream is not None and hasattr(stream, 'close'):
+                stream.close()
+            call.end(error, cancelled=isinstance(error, cancellation.Cancelled))
+            limiter.release()
+
+    def stats(self):
+        with self.lock:
+            limiters = dict(self.limiters)
+        return {model: {'limit': limiter.limit, 'active': limiter.active, 'queued': limiter.queued()}
+                for model, limiter in limiters.items()}
+
+
+class AsyncLLMClient(LLMClient):
+    # LLMClient for the asyncio server: chat() is a coroutine, and a streamed
+    # call returns an async iterator whose aclose() ends the HTTP response.
+    # Limits, cache and telemetry work as in LLMClient. The server's blocking
+    # work (classifier cascade, summaries) still calls the threaded client, so
+    # the two share their limiters and in-flight cache entries.
+
+    client_class = ollama.AsyncClient
+
+    async def chat(self, model, messages, session_id=None, stream=False, use_cache=True, **kwargs):
+        if not (use_cache and self.cache and is_deterministic(kwargs.get('options'))):
+            return await self._call(model, messages, session_id, stream, kwargs)
+
+        key = self.cache.key(model, messages, **kwargs)
+        if not stream:
+            response, _ = await self.cache.aget_or_call(
+                key, lambda: self._call(model, messages, session_id, False, kwargs))
+            return response
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            return self._replay(cached)
+        self.cache.record_miss()
+        return self._record_stream(key, await self._call(model, messages, session_id, True, kwargs))
+
+    async def _replay(self, cached):
+        for chunk in stream_chunks(cached):
+            yield chunk
+
+    async def _record_stream(self, key, stream):
+        content = []
+        try:
+            async for chunk in stream:
+                content.append(chunk['message']['content'])
+                if chunk.get('done'):
+                    final = to_plain(chunk)
+                    final['message'] = dict(final['message'], content=''.join(content))
+                    self.cache.put(key, final)
+                yield chunk
+        finally:
+            await stream.aclose()
+
+    async def _call(self, model, messages, session_id, stream, kwargs):
+        if stream:
+            return self._stream(model, messages, session_id, kwargs)
+        limiter = self.limiter(model)
+        queued = time.monotonic()
+        await limiter.acquire_async(session_id)
+        call = telemetry.LLMCall(model, time.monotonic() - queued, stream=False)
+        error = None
+        cancelled = False
+        try:
+            response = await self.client.chat(model=model, messages=messages, stream=False, **kwargs)
+            call.chunk(response)
+            return response
+        except asyncio.CancelledError as e:
+            error, cancelled = e, True
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            call.end(error, cancelled)
+            limiter.release()
+
+    async def _stream(self, model, messages, session_id, kwargs):
+        limiter = self.limiter(model)
+        queued = time.monotonic()
+        await limiter.acquire_async(session_id)
+        call = telemetry.LLMCall(model, time.monotonic() - queued, stream=True)
+        error = None
+        cancelled = False
+        stream = None
+        try:
+            stream = await self.client.chat(model=model, messages=messages, stream=True, **kwargs)
+            async for chunk in stream:
+                call.chunk(chunk)
+                yield chunk
+        except asyncio.CancelledError as e:
+            # The job's task was cancelled while this stream was waiting.
+            error, cancelled = e, True
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if stream is not None and hasattr(stream, 'aclose'):
+                await stream.aclose()
+            call.end(error, cancelled)
+            limiter.release()
+
+
+def create_client(cls=LLMClient, cache=None, share_limits_with=None):
+    return cls(
+        host=os.environ.get('OLLAMA_HOST'),
+        concurrency=parse_concurrency(os.environ.get('LLM_CONCURRENCY', '')),
+        default_concurrency=int(os.environ.get('LLM_DEFAULT_CONCURRENCY', DEFAULT_CONCURRENCY)),
+        cache=cache,
+        share_limits_with=share_limits_with,
+    )
+
+
+llm = create_client(cache=ResponseCache(
+    max_bytes=int(os.environ.get('LLM_CACHE_BYTES', 64 * 1024 * 1024)),
+    cache_dir=os.environ.get('LLM_CACHE_DIR'),
+    disk_max_bytes=int(os.environ.get('LLM_CACHE_DISK_BYTES', 1024 * 1024 * 1024)),
+) if os.environ.get('LLM_CACHE', '1') != '0' else None)
+
+# Created by the asyncio server only; it shares the response cache and the
+# per-model limits with `llm`.
+async_llm = None
+
+
+def get_async_llm():
+    global async_llm
+    if async_llm is None:
+        async_llm = create_client(AsyncLLMClient, cache=llm.cache, share_limits_with=llm)
+    return async_llm
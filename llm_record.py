@@ -0,0 +1,331 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+import ollama
+
+from llm_cache import ResponseCache, to_plain
+
+# Records the calls that reach Ollama and plays them back without a model:
+#
+#   LLM_RECORD=/tmp/session.llm python run.py     # talk to Ollama, keep a copy
+#   LLM_REPLAY=/tmp/session.llm python run.py     # no Ollama needed
+#
+# The recording clients wrap the Ollama client inside LLMClient, so the
+# limiters, response cache and telemetry above them run as usual; only calls
+# that get past the cache are recorded. The file is append-only JSON lines,
+# one per call, written when the call ends:
+#   {"key": ..., "model": ..., "stream": true, "chunks": [[delay, content], ...],
+#    "final": {...}}
+# A chunk is its delay after the previous one (the first one's after the
+# request was sent) and its content; message fields other than the content,
+# e.g. tool_calls, are kept as a third item. "final" is the last chunk
+# without its content, with Ollama's counts and durations. Non-streamed calls
+# keep their "latency" and "response" instead, and failed ones their "error".
+#
+# Replay looks calls up by the request (ResponseCache.key: model, messages,
+# tools, options and format), so concurrent sessions do not have to ask in
+# the recorded order. Requests that differ only in details such as a script's
+# run time are matched by their shape instead: the same model, tools, options
+# and system messages, i.e. the same craft state asking. Either way, repeated
+# requests get their recorded responses in turn, and the last one again once
+# those run out, so a recording of one session can serve a load test of many
+# alike. A request without a match fails with RecordingMissing.
+# LLM_REPLAY_SPEED is 'recorded' (the default, with the recorded delays),
+# 'max' (no delays) or a speed-up factor.
+
+
+class RecordingMissing(LookupError):
+    pass
+
+
+def parse_speed(value):
+    # -> the factor applied to recorded delays
+    if value in (None, '', 'recorded'):
+        return 1.0
+    if value == 'max':
+        return 0.0
+    return 1.0 / float(value)
+
+
+def split_message(message):
+    # -> (content, the other message fields or None)
+    content = message.get('content') or ''
+    extra = {key: value for key, value in message.items() if key not in ('role', 'content') and value}
+    return content, extra or None
+
+
+class Recording:
+    # One recording file, shared by every client of the process.
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.calls = None  # key -> [entries], loaded for replay
+        self.shapes = None  # shape -> [entries]
+        self.served = defaultdict(int)
+        self.counters = {'recorded': 0, 'replayed': 0, 'by_shape': 0, 'repeated': 0, 'missing': 0}
+
+    def append(self, entry):
+        line = json.dumps(entry, separators=(',', ':'), default=str) + '\n'
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+            self.counters['recorded'] += 1
+
+    def next(self, key, shape):
+        with self.lock:
+            if self.calls is None:
+                self.calls, self.shapes = self._load()
+            if key in self.calls:
+                entries, served = self.calls[key], ('key', key)
+            elif shape in self.shapes:
+                self.counters['by_shape'] += 1
+                entries, served = self.shapes[shape], ('shape', shape)
+            else:
+                self.counters['missing'] += 1
+                raise RecordingMissing(f'No recorded call for request {key[:12]} in {self.path}')
+            index = self.served[served]
+            self.served[served] += 1
+            if index >= len(entries):
+                self.counters['repeated'] += 1
+                return entries[-1]
+            self.counters['replayed'] += 1
+            return entries[index]
+
+    def stats(self):
+        with self.lock:
+            calls = sum(map(len, self.calls.values())) if self.calls is not None else None
+            return dict(self.counters, path=self.path, calls=calls)
+
+    def _load(self):
+        calls = defaultdict(list)
+        shapes = defaultdict(list)
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short when the recording process died
+                calls[entry['key']].append(entry)
+                shapes[entry['shape']].append(entry)
+        return calls, shapes
+
+
+recordings = {}
+recordings_lock = threading.Lock()
+
+
+def open_recording(path):
+    with recordings_lock:
+        if path not in recordings:
+            recordings[path] = Recording(path)
+        return recordings[path]
+
+
+def request_key(model, messages, kwargs):
+    return ResponseCache.key(model, messages, tools=kwargs.get('tools'), options=kwargs.get('options'),
+                             format=kwargs.get('format'))
+
+
+def request_shape(model, messages, kwargs):
+    system = [message for message in messages if message.get('role') == 'system']
+    return request_key(model, system, kwargs)
+
+
+class CallRecorder:
+    # Builds the entry for one call from what the client returns.
+
+    def __init__(self, recording, model, messages, stream, kwargs):
+        self.recording = recording
+        self.entry = {'key': request_key(model, messages, kwargs), 'shape': request_shape(model, messages, kwargs),
+                      'model': model, 'stream': stream}
+        self.chunks = []
+        self.last = self.started = time.monotonic()
+
+    def chunk(self, chunk):
+        now = time.monotonic()
+        plain = to_plain(chunk)
+        content, extra = split_message(plain.get('message') or {})
+        self.chunks.append([round(now - self.last, 4), content] + ([extra] if extra else []))
+        self.last = now
+        if plain.get('done'):
+            plain.pop('message', None)
+            self.entry['final'] = plain
+
+    def response(self, response):
+        self.entry['latency'] = round(time.monotonic() - self.started, 4)
+        self.entry['response'] = to_plain(response)
+        self.recording.append(self.entry)
+
+    def end(self, error=None):
+        if error is not None:
+            self.entry['error'] = str(error)
+        if self.entry['stream']:
+            self.entry['chunks'] = self.chunks
+            if error is None and 'final' not in self.entry:
+                self.entry['closed'] = True  # The caller stopped reading early.
+        self.recording.append(self.entry)
+
+
+class RecordingClient:
+    # Passes calls on to `client` (an ollama.Client) and records them.
+
+    def __init__(self, client, recording):
+        self.client = client
+        self.recording = recording
+
+    def chat(self, model, messages, stream=False, **kwargs):
+        recorder = CallRecorder(self.recording, model, messages, stream, kwargs)
+        if stream:
+            return self._stream(recorder, model, messages, kwargs)
+        try:
+            response = self.client.chat(model=model, messages=messages, stream=False, **kwargs)
+        except Exception as e:
+            recorder.end(e)
+            raise
+        recorder.response(response)
+        return response
+
+    def _stream(self, recorder, model, messages, kwargs):
+        error = None
+        stream = None
+        try:
+            stream = self.client.chat(model=model, messages=messages, stream=True, **kwargs)
+            for chunk in stream:
+                recorder.chunk(chunk)
+                yield chunk
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if stream is not None and hasattr(stream, 'close'):
+                stream.close()
+            recorder.end(error)
+
+    def stats(self):
+        return self.recording.stats()
+
+
+class AsyncRecordingClient(RecordingClient):
+
+    async def chat(self, model, messages, stream=False, **kwargs):
+        recorder = CallRecorder(self.recording, model, messages, stream, kwargs)
+        if stream:
+            return self._stream(recorder, model, messages, kwargs)
+        try:
+            response = await self.client.chat(model=model, messages=messages, stream=False, **kwargs)
+        except Exception as e:
+            recorder.end(e)
+            raise
+        recorder.response(response)
+        return response
+
+    async def _stream(self, recorder, model, messages, kwargs):
+        error = None
+        stream = None
+        try:
+            stream = await self.client.chat(model=model, messages=messages, stream=True, **kwargs)
+            async for chunk in stream:
+                recorder.chunk(chunk)
+                yield chunk
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if stream is not None and hasattr(stream, 'aclose'):
+                await stream.aclose()
+            recorder.end(error)
+
+
+def replay_chunks(entry):
+    # -> [(delay, chunk)] for a recorded call, whether or not it was streamed.
+    if 'chunks' not in entry:
+        response = entry.get('response')
+        return [(entry.get('latency', 0.0), response)] if response is not None else []
+    chunks = []
+    for index, item in enumerate(entry['chunks']):
+        message = dict(item[2] if len(item) > 2 else {}, role='assistant', content=item[1])
+        last = index == len(entry['chunks']) - 1 and 'final' in entry
+        chunk = dict(entry['final'], message=message) if last else {'model': entry['model'], 'message': message,
+                                                                     'done': False}
+        chunks.append((item[0], chunk))
+    return chunks
+
+
+def combine(chunks):
+    # A streamed recording asked for without streaming: one response.
+    content = []
+    message = {'role': 'assistant'}
+    response = {}
+    for _, chunk in chunks:
+        content.append(chunk['message'].get('content') or '')
+        message.update({key: value for key, value in chunk['message'].items() if key != 'content'})
+        response = chunk
+    return dict(response, message=dict(message, content=''.join(content)))
+
+
+class ReplayClient:
+    # Answers calls from a recording instead of Ollama, with the recorded
+    # delays multiplied by `delay_factor` (0 for maximum speed).
+
+    def __init__(self, recording, delay_factor=1.0):
+        self.recording = recording
+        self.delay_factor = delay_factor
+
+    def lookup(self, model, messages, kwargs):
+        entry = self.recording.next(request_key(model, messages, kwargs), request_shape(model, messages, kwargs))
+        if 'error' in entry:
+            raise ollama.ResponseError(entry['error'])
+        return entry
+
+    def chat(self, model, messages, stream=False, **kwargs):
+        entry = self.lookup(model, messages, kwargs)
+        chunks = replay_chunks(entry)
+        if stream:
+            return self._stream(chunks)
+        time.sleep(sum(delay for delay, _ in chunks) * self.delay_factor)
+        return combine(chunks) if entry['stream'] else entry['response']
+
+    def _stream(self, chunks):
+        for delay, chunk in chunks:
+            if self.delay_factor:
+                time.sleep(delay * self.delay_factor)
+            yield chunk
+
+    def stats(self):
+        return self.recording.stats()
+
+
+class AsyncReplayClient(ReplayClient):
+
+    async def chat(self, model, messages, stream=False, **kwargs):
+        entry = self.lookup(model, messages, kwargs)
+        chunks = replay_chunks(entry)
+        if stream:
+            return self._stream(chunks)
+        await asyncio.sleep(sum(delay for delay, _ in chunks) * self.delay_factor)
+        return combine(chunks) if entry['stream'] else entry['response']
+
+    async def _stream(self, chunks):
+        for delay, chunk in chunks:
+            if self.delay_factor:
+                await asyncio.sleep(delay * self.delay_factor)
+            yield chunk
+
+
+def wrap(client):
+    # The client LLMClient should use for `client`, given LLM_RECORD and
+    # LLM_REPLAY.
+    is_async = isinstance(client, ollama.AsyncClient)
+    if os.environ.get('LLM_REPLAY'):
+        recording = open_recording(os.environ['LLM_REPLAY'])
+        factor = parse_speed(os.environ.get('LLM_REPLAY_SPEED'))
+        return (AsyncReplayClient if is_async else ReplayClient)(recording, factor)
+    if os.environ.get('LLM_RECORD'):
+        recording = open_recording(os.environ['LLM_RECORD'])
+        return (AsyncRecordingClient if is_async else RecordingClient)(client, recording)
+    return client
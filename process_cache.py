@@ -0,0 +1,166 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import types
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import craft_sm
+from craft_sm import ToolCraftingProcess
+from session_store import store
+
+# Tool-crafting processes are created only when a session starts crafting and
+# are kept resident only while they are in use or recently used. Every use
+# ends by saving a compact snapshot to the session store; idle processes past
+# `idle_seconds`, or the least recently used ones beyond `max_resident`, are
+# then simply dropped ("hibernated") and rebuilt from the snapshot on the
+# session's next request. A process that is in use is never dropped.
+
+
+def deep_sizeof(obj, seen=None):
+    # Approximate memory owned by `obj`: the object plus everything it
+    # references, except code, classes and modules, which are shared.
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, (type, types.ModuleType, types.FunctionType,
+                                           types.BuiltinFunctionType, types.CodeType)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, OrderedDict)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif isinstance(obj, types.MethodType):
+        size += deep_sizeof(obj.__self__, seen)
+    elif isinstance(obj, functools.partial):
+        size += deep_sizeof(obj.args, seen) + deep_sizeof(obj.keywords, seen)
+    if hasattr(obj, '__dict__') and not isinstance(obj, type):
+        size += deep_sizeof(vars(obj), seen)
+    for slot in getattr(type(obj), '__slots__', ()):
+        if hasattr(obj, slot):
+            size += deep_sizeof(getattr(obj, slot), seen)
+    return size
+
+
+class ProcessCache:
+
+    def __init__(self, store, key='craft_process', max_resident=256, idle_seconds=600):
+        self.store = store
+        self.key = key
+        self.max_resident = max_resident
+        self.idle_seconds = idle_seconds
+        self.entries = OrderedDict()  # session -> {'process', 'revision', 'last_used', 'pins'}
+        self.lock = threading.Lock()
+        self.counters = {'created': 0, 'rehydrated': 0, 'hibernated': 0, 'forgotten': 0}
+        self.snapshot_bytes = {'total': 0, 'saves': 0}
+
+    @contextmanager
+    def use(self, session_id):
+        # Yields the session's process, creating or rehydrating it if needed,
+        # and saves its snapshot afterwards.
+        process = self._checkout(session_id)
+        try:
+            yield process
+        finally:
+            self._checkin(session_id, process)
+
+    def _checkout(self, session_id):
+        saved = self.store.get(session_id, self.key)
+        revision = saved['revision'] if saved else 0
+        with self.lock:
+            entry = self.entries.get(session_id)
+            if entry is None or entry['revision'] != revision:
+                # Missing here, or another worker has moved the session on.
+                if saved is None:
+                    process = ToolCraftingProcess(session_id)
+                    self.counters['created'] += 1
+                else:
+                    process = ToolCraftingProcess.restore(session_id, saved['process'])
+                    self.counters['rehydrated'] += 1
+                pins = entry['pins'] if entry else 0
+                entry = self.entries[session_id] = {'process': process, 'revision': revision, 'pins': pins}
+            entry['pins'] += 1
+            entry['last_used'] = time.monotonic()
+            self.entries.move_to_end(session_id)
+            return entry['process']
+
+    def _checkin(self, session_id, process):
+        # A pinned entry is only missing when the session was forgotten while
+        # in use (cleared, cancelling its job); its snapshot is not saved then.
+        with self.lock:
+            if session_id not in self.entries:
+                return
+        saved = self.store.get(session_id, self.key)
+        revision = (saved['revision'] if saved else 0) + 1
+        encoded = {'revision': revision, 'process': process.snapshot()}
+        self.store.set(session_id, self.key, encoded)
+        with self.lock:
+            self.snapshot_bytes['total'] += len(json.dumps(encoded))
+            self.snapshot_bytes['saves'] += 1
+            entry = self.entries.get(session_id)
+            if entry is None:
+                # Forgotten while the snapshot was being saved.
+                self.store.delete(session_id, self.key)
+            else:
+                entry['pins'] -= 1
+                entry['last_used'] = time.monotonic()
+                if entry['process'] is process:
+                    entry['revision'] = revision
+            self._sweep()
+
+    def sweep(self):
+        with self.lock:
+            self._sweep()
+
+    def _sweep(self):
+        # Caller holds the lock. Entries are in least-recently-used order.
+        now = time.monotonic()
+        for session_id in list(self.entries):
+            entry = self.entries[session_id]
+            over_capacity = len(self.entries) > self.max_resident
+            idle = now - entry['last_used'] > self.idle_seconds
+            if not (over_capacity or idle):
+                break
+            if entry['pins']:
+                continue
+            del self.entries[session_id]
+            self.counters['hibernated'] += 1
+
+    def forget(self, session_id):
+        with self.lock:
+            if self.entries.pop(session_id, None) is not None:
+                self.counters['forgotten'] += 1
+        self.store.delete(session_id, self.key)
+
+    def stats(self, sample=32):
+        self.sweep()
+        with self.lock:
+            resident = list(self.entries.values())
+            counters = dict(self.counters)
+            saves = self.snapshot_bytes['saves']
+            snapshot_bytes = self.snapshot_bytes['total'] / saves if saves else None
+        # The transition table and compiled spec are shared by every process
+        # and not counted. Sizing walks the object graph, so only the most
+        # recently used `sample` processes are measured.
+        shared = {id(craft_sm.TRANSITIONS), id(craft_sm.SPEC)}
+        sizes = [deep_sizeof(entry['process'], set(shared)) for entry in resident[-sample:]]
+        return dict(
+            counters,
+            resident=len(resident),
+            pinned=sum(1 for entry in resident if entry['pins']),
+            max_resident=self.max_resident,
+            idle_seconds=self.idle_seconds,
+            resident_bytes_per_session=sum(sizes) / len(sizes) if sizes else None,
+            hibernated_bytes_per_session=snapshot_bytes,
+        )
+
+
+processes = ProcessCache(
+    store,
+    max_resident=int(os.environ.get('CRAFT_MAX_RESIDENT', 256)),
+    idle_seconds=float(os.environ.get('CRAFT_IDLE_SECONDS', 600)),
+)
@@ -1,24 +1,59 @@
-from flask import Flask, request, render_template, jsonify, session
-from flask_socketio import SocketIO, emit
-from collections import deque, defaultdict
-import ollama
+from flask import Flask, Response, g, request, render_template, jsonify, session
+from flask_socketio import SocketIO, emit, join_room
 import uuid
+import os
 
+import cancellation
+from cancellation import cancellations
 from craft import create_craft_blueprint
+from streaming import ChunkCoalescer
+from llm_client import llm
+from scheduler import Scheduler, QueueFull, DEFAULT_LANES
+from clipboard import clipboards
+from service import CHAT_MODEL, chat_histories, summarize_clip
+import service
+import telemetry
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your_secret_key'  # Replace 'your_secret_key' with a secure key
-socketio = SocketIO(app, ping_interval=25000, ping_timeout=60000)
-craft_bp = create_craft_blueprint(app, socketio)
+app.config['SECRET_KEY'] = service.SECRET_KEY
+# With several workers, SOCKETIO_MESSAGE_QUEUE (e.g. redis://localhost:6379/0)
+# lets any of them emit to a room whose socket is connected to another.
+socketio = SocketIO(app, ping_interval=25000, ping_timeout=60000,
+                    message_queue=os.environ.get('SOCKETIO_MESSAGE_QUEUE'))
+# A chat job holds its worker for the whole stream, so by default there is a
+# worker for every chat call the model takes at once plus the craft lane's
+# share; more would only wait in the model's limiter.
+default_workers = llm.limiter(CHAT_MODEL).limit + DEFAULT_LANES['craft']['max_running']
+scheduler = Scheduler(socketio.start_background_task,
+                      workers=int(os.environ.get('SCHEDULER_WORKERS', default_workers)), lanes=DEFAULT_LANES)
+craft_bp = create_craft_blueprint(app, socketio, scheduler)
 app.register_blueprint(craft_bp, url_prefix='/craft')
 
-clipboard_queue = deque(maxlen=5)
-chat_histories = defaultdict(list)  # Store chat histories
-
 @app.before_request
 def ensure_session():
     if 'session' not in session:
         session['session'] = str(uuid.uuid4())
+        g.new_session = True
+
+@socketio.on('connect')
+def join_session_room():
+    # Every socket joins a room named after its session so that streamed
+    # output is only delivered to the browser that asked for it.
+    session_id = session.get('session')
+    if session_id:
+        join_room(session_id)
+        cancellations.connected(session_id)
+        # Only the connecting socket needs the full clipboard; later changes
+        # arrive as 'clipboard_delta' events.
+        emit('clipboard_snapshot', [{'id': clip_id, 'text': text} for clip_id, text in clipboards.items(session_id)])
+
+@socketio.on('disconnect')
+def leave_session():
+    # The session's running jobs are cancelled unless a socket of the same
+    # session reconnects within cancellation.DISCONNECT_GRACE seconds.
+    session_id = session.get('session')
+    if session_id:
+        cancellations.disconnected(session_id)
 
 @app.route('/')
 def index():
@@ -29,61 +64,117 @@ def generate():
     session_id = session['session']  # Use the session cookie to identify users
     prompt = request.form['prompt']
     
-    # Replace placeholders with actual clipboard content
-    for i in range(len(clipboard_queue)):
-        prompt = prompt.replace(f'\\clipboard+{i+1}', clipboard_queue[-(i+1)])
-    
-    # Add the user prompt to the chat history
-    chat_histories[session_id].append({'role': 'user', 'content': prompt})
-    
-    # Start streaming the response from the local model
+    # Clipboard placeholders become references to the stored clips; they are
+    # expanded when the prompt is sent, so the history keeps one copy of each.
+    # The prompt joins the chat history once its job runs, so a rejected one
+    # is not sent with later turns.
+    user_message = clipboards.reference(session_id, prompt)
+
+    # Start streaming the response from the local model. A newer prompt, a
+    # cleared history or a closed browser cancels it; the partial reply is
+    # then dropped.
+    token = cancellations.start(session_id, 'chat')
+
     def generate_response():
-        messages = chat_histories[session_id]  # Use the chat history
-        stream = ollama.chat(
-            model='codellama:13b',
+        with telemetry.labelled(route='/generate', session=session_id):
+            cancellation.run(token, stream_response, on_cancelled=lambda reason: socketio.emit(
+                'response_cancelled', {'reason': reason}, to=session_id))
+
+    def stream_response():
+        chat_histories.append(session_id, user_message)
+        # Recent turns plus a summary of older ones, with the clips filled in
+        messages = clipboards.render(session_id, chat_histories.prompt_messages(session_id), summarize=summarize_clip)
+        stream = llm.chat(
+            CHAT_MODEL,
             messages=messages,
+            session_id=session_id,
             stream=True,
             options={'temperature': 0}
         )
         
         response_chunks = []
+        coalescer = ChunkCoalescer(socketio, 'response_chunk', room=session_id)
         for chunk in stream:
             content = chunk['message']['content']
             response_chunks.append(content)
-            print(content)
-            socketio.emit('response_chunk', {'chunk': content})
+            coalescer.push(content)
+            if chunk.get('done'):
+                chat_histories.record_prompt_tokens(session_id, chunk.get('prompt_eval_count'))
+        coalescer.close()
         
         # Combine all response chunks into a single response
         full_response = ''.join(response_chunks)
         
         # Update chat history with unified AI response
-        chat_histories[session_id].append({'role': 'assistant', 'content': full_response})
+        chat_histories.append(session_id, {'role': 'assistant', 'content': full_response})
         # print(full_response)
-        socketio.emit('response_complete')
+        socketio.emit('response_complete', to=session_id)
 
-    socketio.start_background_task(generate_response)
+    try:
+        position = scheduler.submit('chat', generate_response, session_id)
+    except QueueFull:
+        cancellations.finish(token)
+        return jsonify({'status': 'rejected', 'error': 'The server is busy, please try again shortly.'}), 429
+    if position:
+        return jsonify({'status': 'queued', 'position': position})
     return jsonify({'status': 'streaming'})
 
+def clipboard_session():
+    # The browser's own session. The capture script has no cookie; it names
+    # a session and sends that session's capture token, or gets None.
+    if not g.get('new_session') or 'session' not in request.form:
+        return session['session']
+    return service.capture_session(app.config['SECRET_KEY'], request.form)
+
 @app.route('/add_text', methods=['POST'])
 def add_text():
+    session_id = clipboard_session()
+    if session_id is None:
+        return jsonify({'status': 'forbidden'}), 403
     text = request.form['text']
-    clipboard_queue.append(text)
-    socketio.emit('update_clipboard', list(clipboard_queue))
+    for delta in clipboards.add(session_id, text):
+        socketio.emit('clipboard_delta', delta, to=session_id)
     return jsonify({'status': 'success'})
 
 @app.route('/clear_queue', methods=['POST'])
 def clear_queue():
-    clipboard_queue.clear()
-    socketio.emit('update_clipboard', list(clipboard_queue))
+    session_id = clipboard_session()
+    if session_id is None:
+        return jsonify({'status': 'forbidden'}), 403
+    for delta in clipboards.clear(session_id):
+        socketio.emit('clipboard_delta', delta, to=session_id)
     return jsonify({'status': 'success'})
 
+@app.route('/session_id', methods=['GET'])
+def get_session_id():
+    session_id = session['session']
+    return jsonify({'session': session_id,
+                    'capture_token': service.capture_token(app.config['SECRET_KEY'], session_id)})
+
 @app.route('/clear_history', methods=['POST'])
 def clear_history():
     session_id = session['session']
-    if session_id in chat_histories:
-        del chat_histories[session_id]
+    cancellations.cancel(session_id, ('chat',), 'clear')
+    chat_histories.clear(session_id)
+    clipboards.forget_clips(session_id)
     return jsonify({'status': 'success'})
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify(service.stats(llm, scheduler))
+
+service.register_gauges(llm, scheduler)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Prometheus text format. Every worker process reports its own values.
+    return Response(telemetry.registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/history_tokens', methods=['GET'])
+def history_tokens():
+    session_id = session['session']
+    return jsonify(dict(chat_histories.token_counts(session_id), clips=clipboards.clip_stats(session_id)))
+
 
 
 if __name__ == '__main__':
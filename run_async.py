@@ -0,0 +1,347 @@
+import argparse
+import asyncio
+import os
+import threading
+import uuid
+from http.cookies import SimpleCookie
+
+import socketio
+from aiohttp import web
+from flask import Flask
+from flask.sessions import SecureCookieSessionInterface
+
+import cancellation
+import craft
+import craft_context
+import service
+import telemetry
+from cancellation import cancellations
+from clipboard import clipboards
+from llm_client import get_async_llm
+from process_cache import processes
+from scheduler import AsyncScheduler, QueueFull, DEFAULT_LANES
+from service import CHAT_MODEL, chat_histories, summarize_clip
+from streaming import ChunkCoalescer
+
+# The same HTTP routes and Socket.IO events as run.py, served by aiohttp on
+# one event loop:
+#
+#   pip install aiohttp
+#   python run_async.py --port 8000
+#
+# Chat streams and craft chains are coroutines that read from the async
+# Ollama client, so an open websocket or a slow stream costs a task and a
+# socket instead of a thread. Work that blocks (script runs, history
+# summaries, the classifier cascade) runs in the default thread pool.
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Session cookies are signed the way Flask signs them, so the two servers
+# accept each other's cookies.
+cookie_app = Flask(__name__)
+cookie_app.config['SECRET_KEY'] = service.SECRET_KEY
+cookie_serializer = SecureCookieSessionInterface().get_signing_serializer(cookie_app)
+COOKIE_NAME = cookie_app.config['SESSION_COOKIE_NAME']
+COOKIE_MAX_AGE = int(cookie_app.permanent_session_lifetime.total_seconds())
+
+message_queue = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+sio = socketio.AsyncServer(async_mode='aiohttp', ping_interval=25000, ping_timeout=60000,
+                           client_manager=socketio.AsyncRedisManager(message_queue) if message_queue else None)
+scheduler = AsyncScheduler(workers=int(os.environ.get('ASYNC_SCHEDULER_WORKERS', 1024)), lanes=DEFAULT_LANES)
+llm = get_async_llm()
+background = set()
+
+
+class LoopEmitter:
+    # socketio.emit(event, data, to=room) for the synchronous code shared
+    # with run.py (ChunkCoalescer, craft step listeners, script output
+    # readers). Events are queued and sent in order by one task on the loop;
+    # emit() may be called from any thread.
+
+    def __init__(self, sio):
+        self.sio = sio
+        self.loop = None
+        self.thread_id = None
+        self.queue = None
+
+    def start(self, loop):
+        self.loop = loop
+        self.thread_id = threading.get_ident()
+        self.queue = asyncio.Queue()
+        spawn(self._drain())
+
+    def emit(self, event, data=None, to=None):
+        item = (event, data, to)
+        if threading.get_ident() == self.thread_id:
+            self.queue.put_nowait(item)
+        else:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    async def _drain(self):
+        while True:
+            event, data, to = await self.queue.get()
+            await self.sio.emit(event, data, to=to)
+
+
+emitter = LoopEmitter(sio)
+
+
+def spawn(coroutine):
+    # Keeps a reference until the task is done, so it is not collected early.
+    task = asyncio.get_running_loop().create_task(coroutine)
+    background.add(task)
+    task.add_done_callback(background.discard)
+    return task
+
+
+def read_session(cookie):
+    if not cookie:
+        return {}
+    try:
+        return dict(cookie_serializer.loads(cookie, max_age=COOKIE_MAX_AGE))
+    except Exception:
+        return {}
+
+
+@web.middleware
+async def ensure_session(request, handler):
+    if request.path.startswith('/socket.io/'):
+        return await handler(request)
+    data = read_session(request.cookies.get(COOKIE_NAME))
+    created = 'session' not in data
+    if created:
+        data['session'] = str(uuid.uuid4())
+    request['session'] = data['session']
+    request['new_session'] = created
+    response = await handler(request)
+    if created:
+        response.set_cookie(COOKIE_NAME, cookie_serializer.dumps(data), httponly=True, path='/')
+    return response
+
+
+socket_sessions = {}  # sid -> session, for the disconnect handler
+
+
+@sio.on('connect')
+async def join_session_room(sid, environ):
+    # Every socket joins a room named after its session so that streamed
+    # output is only delivered to the browser that asked for it.
+    cookie = SimpleCookie(environ.get('HTTP_COOKIE', '')).get(COOKIE_NAME)
+    session_id = read_session(cookie.value if cookie else None).get('session')
+    if session_id:
+        await sio.enter_room(sid, session_id)
+        socket_sessions[sid] = session_id
+        cancellations.connected(session_id)
+        await sio.emit('clipboard_snapshot',
+                       [{'id': clip_id, 'text': text} for clip_id, text in clipboards.items(session_id)], to=sid)
+
+
+@sio.on('disconnect')
+async def leave_session(sid, *args):
+    session_id = socket_sessions.pop(sid, None)
+    if session_id:
+        cancellations.disconnected(session_id)
+
+
+routes = web.RouteTableDef()
+
+
+@routes.get('/')
+async def index(request):
+    return web.FileResponse(os.path.join(ROOT, 'templates', 'index.html'))
+
+
+@routes.post('/generate')
+async def generate(request):
+    session_id = request['session']
+    prompt = (await request.post())['prompt']
+    # The prompt joins the history once the job runs, so a rejected one is
+    # not sent with later turns.
+    user_message = clipboards.reference(session_id, prompt)
+    token = cancellations.start(session_id, 'chat')
+
+    async def generate_response():
+        with telemetry.labelled(route='/generate', session=session_id):
+            await cancellation.arun(token, lambda: stream_response(session_id, user_message),
+                                    on_cancelled=lambda reason: emitter.emit('response_cancelled', {'reason': reason},
+                                                                             to=session_id))
+
+    try:
+        position = scheduler.submit('chat', generate_response, session_id)
+    except QueueFull:
+        cancellations.finish(token)
+        return web.json_response({'status': 'rejected', 'error': 'The server is busy, please try again shortly.'},
+                                 status=429)
+    if position:
+        return web.json_response({'status': 'queued', 'position': position})
+    return web.json_response({'status': 'streaming'})
+
+
+async def stream_response(session_id, user_message):
+    chat_histories.append(session_id, user_message)
+    # Compacting the history and summarizing clips are occasional blocking
+    # calls, so the prompt is assembled in a worker thread.
+    messages = await asyncio.to_thread(
+        lambda: clipboards.render(session_id, chat_histories.prompt_messages(session_id), summarize=summarize_clip))
+    stream = await llm.chat(CHAT_MODEL, messages=messages, session_id=session_id, stream=True,
+                            options={'temperature': 0})
+
+    response_chunks = []
+    coalescer = ChunkCoalescer(emitter, 'response_chunk', room=session_id)
+    async for chunk in stream:
+        content = chunk['message']['content']
+        response_chunks.append(content)
+        coalescer.push(content)
+        if chunk.get('done'):
+            chat_histories.record_prompt_tokens(session_id, chunk.get('prompt_eval_count'))
+    coalescer.close()
+
+    chat_histories.append(session_id, {'role': 'assistant', 'content': ''.join(response_chunks)})
+    emitter.emit('response_complete', to=session_id)
+
+
+def clipboard_session(request, form):
+    # As in run.py: the cookie's session, or the one a capture request names
+    # with its capture token.
+    if not request['new_session'] or 'session' not in form:
+        return request['session']
+    return service.capture_session(cookie_app.config['SECRET_KEY'], form)
+
+
+@routes.post('/add_text')
+async def add_text(request):
+    form = await request.post()
+    session_id = clipboard_session(request, form)
+    if session_id is None:
+        return web.json_response({'status': 'forbidden'}, status=403)
+    for delta in clipboards.add(session_id, form['text']):
+        emitter.emit('clipboard_delta', delta, to=session_id)
+    return web.json_response({'status': 'success'})
+
+
+@routes.post('/clear_queue')
+async def clear_queue(request):
+    session_id = clipboard_session(request, await request.post())
+    if session_id is None:
+        return web.json_response({'status': 'forbidden'}, status=403)
+    for delta in clipboards.clear(session_id):
+        emitter.emit('clipboard_delta', delta, to=session_id)
+    return web.json_response({'status': 'success'})
+
+
+@routes.get('/session_id')
+async def get_session_id(request):
+    session_id = request['session']
+    return web.json_response({'session': session_id,
+                              'capture_token': service.capture_token(cookie_app.config['SECRET_KEY'], session_id)})
+
+
+@routes.post('/clear_history')
+async def clear_history(request):
+    session_id = request['session']
+    cancellations.cancel(session_id, ('chat',), 'clear')
+    chat_histories.clear(session_id)
+    clipboards.forget_clips(session_id)
+    return web.json_response({'status': 'success'})
+
+
+@routes.get('/stats')
+async def stats(request):
+    return web.json_response(await asyncio.to_thread(service.stats, llm, scheduler))
+
+
+@routes.get('/metrics')
+async def metrics(request):
+    return web.Response(body=telemetry.registry.render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+
+@routes.get('/history_tokens')
+async def history_tokens(request):
+    session_id = request['session']
+    return web.json_response(dict(chat_histories.token_counts(session_id), clips=clipboards.clip_stats(session_id)))
+
+
+@routes.post('/craft/craft-tools')
+async def craft_tools(request):
+    session_id = request['session']
+    user_message = (await request.json()).get('prompt')
+    token = cancellations.start(session_id, 'craft')
+
+    async def generate_tool_response():
+        with telemetry.labelled(route='/craft/craft-tools', session=session_id), \
+                processes.use(session_id) as process:
+            llm_response = await process.aprocess_interaction(
+                user_message, message_history=craft.load_history(session_id),
+                on_event=craft.step_listener(emitter, session_id, process))
+            emitter.emit('tool_response', {'response': llm_response, 'state': process.get_state_description()},
+                         to=session_id)
+
+    async def run_cancellable():
+        await cancellation.arun(token, generate_tool_response, on_cancelled=lambda reason: emitter.emit(
+            'tool_cancelled', {'reason': reason}, to=session_id))
+
+    try:
+        position = scheduler.submit('craft', run_cancellable, session_id)
+    except QueueFull:
+        cancellations.finish(token)
+        return web.json_response({'response': "The server is busy, please try again shortly.", 'state': 'rejected'},
+                                 status=429)
+    if position:
+        return web.json_response({'response': f"Queued at position {position}...", 'state': 'queued',
+                                  'position': position})
+    return web.json_response({'response': "Processing...", 'state': 'crafting'})
+
+
+@routes.post('/craft/execute-script')
+async def execute_script(request):
+    session_id = request['session']
+    body = await request.json()
+    script = body.get('script')
+    history = craft.load_history(session_id)
+    history.append(craft_context.entry('user', script, kind='script'))
+    token = cancellations.start(session_id, 'script')
+    # The thread runs with the token active (to_thread copies the context),
+    # so cancelling it kills the script.
+    spawn(asyncio.to_thread(cancellation.run, token, lambda: craft.run_script(
+        emitter, session_id, script, body.get('language', 'bash'), history)))
+    return web.json_response({'status': 'executing'})
+
+
+@routes.post('/craft/clear_craft_history')
+async def clear_craft_history(request):
+    craft.clear_session(request['session'])
+    return web.json_response({'status': 'success'})
+
+
+@routes.get('/craft/trace')
+async def trace(request):
+    return web.json_response(telemetry.tracer.dump(request['session']))
+
+
+async def start_emitter(app):
+    emitter.start(asyncio.get_running_loop())
+
+
+def create_app():
+    app = web.Application(middlewares=[ensure_session])
+    app.add_routes(routes)
+    app.router.add_static('/static', os.path.join(ROOT, 'static'))
+    sio.attach(app)
+    app.on_startup.append(start_emitter)
+    return app
+
+
+service.register_gauges(llm, scheduler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve LLMToolCraft on an asyncio event loop.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    web.run_app(create_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import asyncio
+import threading
+import time
+import traceback
+from collections import deque
+
+# Lower priority value runs first. `max_running` keeps long craft chains from
+# taking every worker, so interactive chat always has free capacity.
+DEFAULT_LANES = {
+    'chat': {'priority': 0, 'max_queue': 64, 'max_running': None},
+    'craft': {'priority': 1, 'max_queue': 16, 'max_running': 2},
+}
+
+WAIT_SAMPLES = 256
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Scheduler:
+    # Runs background work on a fixed pool of workers with bounded,
+    # prioritised queues. submit() never blocks: it either queues the job and
+    # reports how many jobs are ahead of it, or raises QueueFull.
+
+    def __init__(self, start_task, workers=4, lanes=None):
+        self.start_task = start_task
+        self.workers = workers
+        self.lanes = lanes or DEFAULT_LANES
+        self.order = sorted(self.lanes, key=lambda lane: self.lanes[lane]['priority'])
+
+        self.queues = {lane: deque() for lane in self.lanes}
+        self.running = {lane: 0 for lane in self.lanes}
+        self.counters = {lane: {'submitted': 0, 'rejected': 0, 'completed': 0, 'failed': 0} for lane in self.lanes}
+        self.waits = {lane: deque(maxlen=WAIT_SAMPLES) for lane in self.lanes}
+
+        self.cond = threading.Condition()
+        self.started = False
+
+    def submit(self, lane, fn, session_id=None):
+        # Returns the number of jobs that have to start before this one;
+        # 0 means a worker will pick it up right away.
+        with self.cond:
+            config = self.lanes[lane]
+            queue = self.queues[lane]
+            if len(queue) >= config['max_queue']:
+                self.counters[lane]['rejected'] += 1
+                raise QueueFull(lane)
+
+            ahead = len(queue) + sum(len(self.queues[other]) for other in self.order
+                                     if self.lanes[other]['priority'] < config['priority'])
+            queue.append((fn, session_id, time.monotonic()))
+            self.counters[lane]['submitted'] += 1
+            self._ensure_workers()
+            self.cond.notify()
+
+            free = self.workers - sum(self.running.values())
+            if config['max_running'] is not None:
+                free = min(free, config['max_running'] - self.running[lane])
+            if ahead < free:
+                return 0
+            return ahead - max(free, 0) + 1
+
+    def _ensure_workers(self):
+        if not self.started:
+            self.started = True
+            for _ in range(self.workers):
+                self.start_task(self._worker)
+
+    def _next_job(self):
+        for lane in self.order:
+            limit = self.lanes[lane]['max_running']
+            if self.queues[lane] and (limit is None or self.running[lane] < limit):
+                return lane, self.queues[lane].popleft()
+        return None, None
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                lane, job = self._next_job()
+                while job is None:
+                    self.cond.wait()
+                    lane, job = self._next_job()
+                fn, session_id, queued_at = job
+                self.running[lane] += 1
+                self.waits[lane].append(time.monotonic() - queued_at)
+
+            try:
+                fn()
+                outcome = 'completed'
+            except Exception:
+                traceback.print_exc()
+                outcome = 'failed'
+
+            with self.cond:
+                self.running[lane] -= 1
+                self.counters[lane][outcome] += 1
+                # A lane that was capped by max_running may be runnable again.
+                self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            result = {}
+            for lane in self.order:
+                waits = sorted(self.waits[lane])
+                result[lane] = dict(
+                    self.counters[lane],
+                    depth=len(self.queues[lane]),
+                    running=self.running[lane],
+                    max_queue=self.lanes[lane]['max_queue'],
+                    wait_avg=sum(waits) / len(waits) if waits else 0.0,
+                    wait_p95=waits[int(len(waits) * 0.95)] if waits else 0.0,
+                    wait_max=waits[-1] if waits else 0.0,
+                )
+            return result
+
+
+class AsyncScheduler(Scheduler):
+    # The same lanes, limits and queue positions for the asyncio server. Jobs
+    # are coroutine functions, run by worker tasks on the event loop, so a
+    # worker waiting on a slow stream costs a task rather than a thread.
+    # submit() must be called from the loop.
+
+    def __init__(self, workers=64, lanes=None):
+        super().__init__(None, workers=workers, lanes=lanes)
+        self.ready = asyncio.Event()
+
+    def submit(self, lane, fn, session_id=None):
+        position = super().submit(lane, fn, session_id)
+        self.ready.set()
+        return position
+
+    def _ensure_workers(self):
+        if not self.started:
+            self.started = True
+            loop = asyncio.get_running_loop()
+            self.tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _worker(self):
+        while True:
+            with self.cond:
+                lane, job = self._next_job()
+                if job is not None:
+                    fn, session_id, queued_at = job
+                    self.running[lane] += 1
+                    self.waits[lane].append(time.monotonic() - queued_at)
+            if job is None:
+                # Nothing runnable: wait for a submit or a finished job.
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+
+            try:
+                await fn()
+                outcome = 'completed'
+            except Exception:
+                traceback.print_exc()
+                outcome = 'failed'
+
+            with self.cond:
+                self.running[lane] -= 1
+                self.counters[lane][outcome] += 1
+            self.ready.set()
@@ -14,5 +14,8 @@ text=$(xclip -o -selection clipboard)
 echo "Clipboard text: $text" >> $LOGFILE
 
 # 调用Flask后端的接口将文本发送过去
-curl -X POST -d "text=$text" http://127.0.0.1:8000/add_text >> $LOGFILE 2>&1
+# 剪贴板按会话区分：LLMTOOLCRAFT_SESSION 为浏览器会话 ID，LLMTOOLCRAFT_TOKEN 为其 capture_token（打开 /session_id 查看）
+curl -X POST --data-urlencode "text=$text" --data-urlencode "session=$LLMTOOLCRAFT_SESSION" \
+    --data-urlencode "token=$LLMTOOLCRAFT_TOKEN" \
+    ${LLMTOOLCRAFT_URL:-http://127.0.0.1:8000}/add_text >> $LOGFILE 2>&1
 
@@ -0,0 +1,104 @@
+import hashlib
+import hmac
+import os
+import sys
+
+import classifier
+import speculation
+import telemetry
+from artifacts import artifacts
+from cancellation import cancellations
+from clipboard import clipboards, CLIP_HISTORY_TOKENS, CLIP_SUMMARY_PROMPT
+from executor import executor
+from history import ChatHistoryManager, SUMMARY_PROMPT, format_for_summary
+from llm_client import llm
+from process_cache import processes
+from session_store import store
+
+# What the threaded server (run.py) and the asyncio server (run_async.py)
+# share: the chat history and its summarizers, /stats and the gauges.
+
+CHAT_MODEL = 'codellama:13b'
+CHAT_TOKEN_BUDGET = int(os.environ.get('CHAT_TOKEN_BUDGET', 3000))
+
+def summarize_history(session_id, previous_summary, messages):
+    response = llm.chat(
+        CHAT_MODEL,
+        session_id=session_id,
+        messages=[
+            {'role': 'system', 'content': SUMMARY_PROMPT},
+            {'role': 'user', 'content': format_for_summary(
+                previous_summary, clipboards.render(session_id, messages, newest_budget=CLIP_HISTORY_TOKENS))}
+        ],
+        options={'temperature': 0, 'num_predict': chat_histories.summary_budget}
+    )
+    return response['message']['content']
+
+def summarize_clip(session_id, text, budget):
+    response = llm.chat(
+        CHAT_MODEL,
+        session_id=session_id,
+        messages=[
+            {'role': 'system', 'content': CLIP_SUMMARY_PROMPT.format(budget=budget)},
+            {'role': 'user', 'content': text}
+        ],
+        options={'temperature': 0, 'num_predict': budget}
+    )
+    return response['message']['content']
+
+chat_histories = ChatHistoryManager(summarize_history, token_budget=CHAT_TOKEN_BUDGET, store=store)  # Store chat histories
+
+
+# Every worker must sign session cookies with the same key. The default is
+# public, so anyone could forge capture tokens with it: while it is in use,
+# only the browser's own cookie can write to a clipboard.
+DEFAULT_SECRET_KEY = 'your_secret_key'
+SECRET_KEY = os.environ.get('SECRET_KEY', DEFAULT_SECRET_KEY)
+if SECRET_KEY == DEFAULT_SECRET_KEY:
+    print('warning: SECRET_KEY is not set; session cookies use a public key and clipboard capture '
+          'without a browser cookie is refused', file=sys.stderr)
+
+
+def capture_token(secret_key, session_id):
+    # The clipboard capture script proves it may write to a session with this
+    # token, which only that session's browser can read from /session_id.
+    return hmac.new(secret_key.encode('utf-8'), f'capture:{session_id}'.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def capture_session(secret_key, form):
+    # The session a capture request names, or None when its token is wrong
+    # or cannot be trusted because the key is the default.
+    if secret_key == DEFAULT_SECRET_KEY:
+        return None
+    session_id = form.get('session')
+    token = form.get('token') or ''
+    if session_id and hmac.compare_digest(token, capture_token(secret_key, session_id)):
+        return session_id
+    return None
+
+
+def stats(llm, scheduler):
+    # `llm` and `scheduler` are the ones the server streams and schedules with.
+    return {'scheduler': scheduler.stats(), 'llm': llm.stats(),
+            'cache': llm.cache.stats() if llm.cache else None,
+            'llm_record': llm.client.stats() if hasattr(llm.client, 'recording') else None,
+            'classifier': classifier.stats(), 'speculation': speculation.stats(),
+            'executor': executor.stats(), 'artifacts': artifacts.stats(),
+            'session_store': store.stats(), 'craft_processes': processes.stats(),
+            'traces': telemetry.tracer.stats(), 'cancellations': cancellations.stats()}
+
+
+def register_gauges(llm, scheduler):
+    # Point-in-time values that the components already keep, read on every scrape.
+    telemetry.registry.gauge('llm_slots_active', 'Calls holding a model concurrency slot.', ('model',),
+                             lambda: [((model, ), value['active']) for model, value in llm.stats().items()])
+    telemetry.registry.gauge('llm_slots_queued', 'Calls waiting for a model concurrency slot.', ('model',),
+                             lambda: [((model, ), value['queued']) for model, value in llm.stats().items()])
+    telemetry.registry.gauge('scheduler_queue_depth', 'Jobs waiting in each scheduler lane.', ('lane',),
+                             lambda: [((lane, ), value['depth']) for lane, value in scheduler.stats().items()])
+    telemetry.registry.gauge('scheduler_running', 'Jobs running in each scheduler lane.', ('lane',),
+                             lambda: [((lane, ), value['running']) for lane, value in scheduler.stats().items()])
+    telemetry.registry.gauge('scripts_running', 'Scripts currently running.', (),
+                             lambda: [((), executor.stats()['running'])])
+    telemetry.registry.gauge('craft_processes_resident', 'Tool-crafting processes held in memory.', (),
+                             lambda: [((), len(processes.entries))])
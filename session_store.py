@@ -0,0 +1,295 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+# Per-session state that has to be shared by every worker process serving the
+# app and survive restarts. A session has:
+#   - append-only message logs ('chat', 'craft', ...) whose entries get
+#     increasing sequence numbers; compaction may trim a log's oldest entries,
+#   - small JSON values by key (summaries, serialized state machines, ...).
+#
+# SESSION_STORE selects the backend:
+#   memory                       process-local, the default
+#   sqlite:///path/to/file.db    shared by all processes on the host (WAL)
+#
+# A session nothing has been written to for SESSION_TTL seconds (a week by
+# default, 0 to keep sessions forever) is deleted with all its logs and
+# values. Writes sweep for such sessions at most once every SWEEP_SECONDS;
+# sweep() runs one right away, e.g. from a cron job.
+SESSION_TTL = float(os.environ.get('SESSION_TTL', 7 * 24 * 3600))
+SWEEP_SECONDS = 60
+
+
+class MemoryStore:
+
+    def __init__(self, ttl=None):
+        self.logs = defaultdict(list)  # (session, log) -> [(seq, message)]
+        self.next_seq = defaultdict(lambda: 1)
+        self.values = defaultdict(dict)  # session -> key -> value
+        self.ttl = ttl
+        self.written = {}  # session -> time of its last write
+        self.next_sweep = 0
+        self.expired = 0
+        self.lock = threading.Lock()
+
+    def _touch(self, session_id):
+        # Caller holds the lock.
+        now = time.time()
+        self.written[session_id] = now
+        if self.ttl and now >= self.next_sweep:
+            self._sweep(now)
+
+    def sweep(self):
+        with self.lock:
+            self._sweep(time.time())
+
+    def _sweep(self, now):
+        # Caller holds the lock.
+        self.next_sweep = now + SWEEP_SECONDS
+        if not self.ttl:
+            return
+        cutoff = now - self.ttl
+        expired = {session_id for session_id, written in self.written.items() if written < cutoff}
+        if not expired:
+            return
+        for session_id in expired:
+            del self.written[session_id]
+            self.values.pop(session_id, None)
+        for key in [key for key in self.logs if key[0] in expired]:
+            del self.logs[key]
+        for key in [key for key in self.next_seq if key[0] in expired]:
+            del self.next_seq[key]
+        self.expired += len(expired)
+
+    def append(self, session_id, log, message):
+        with self.lock:
+            self._touch(session_id)
+            seq = self.next_seq[(session_id, log)]
+            self.next_seq[(session_id, log)] = seq + 1
+            self.logs[(session_id, log)].append((seq, json.loads(json.dumps(message))))
+            return seq
+
+    def read(self, session_id, log, after=0):
+        with self.lock:
+            return [(seq, message) for seq, message in self.logs.get((session_id, log), []) if seq > after]
+
+    def trim(self, session_id, log, upto):
+        # Drops entries with seq <= upto; sequence numbers are never reused.
+        with self.lock:
+            entries = self.logs.get((session_id, log))
+            if entries:
+                self.logs[(session_id, log)] = [(seq, message) for seq, message in entries if seq > upto]
+
+    def clear_log(self, session_id, log):
+        with self.lock:
+            self.logs.pop((session_id, log), None)
+
+    def get(self, session_id, key, default=None):
+        with self.lock:
+            value = self.values.get(session_id, {}).get(key)
+        return default if value is None else json.loads(value)
+
+    def set(self, session_id, key, value):
+        encoded = json.dumps(value)
+        with self.lock:
+            self._touch(session_id)
+            self.values[session_id][key] = encoded
+
+    def delete(self, session_id, key):
+        with self.lock:
+            self.values.get(session_id, {}).pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            sessions = set(self.values) | {session_id for session_id, _ in self.logs}
+            return {'backend': 'memory', 'sessions': len(sessions),
+                    'messages': sum(len(entries) for entries in self.logs.values()),
+                    'ttl': self.ttl, 'expired': self.expired}
+
+
+class SQLiteStore:
+    # One SQLite file in WAL mode, so readers never block the writer and
+    # several worker processes can share it. Each thread keeps its own
+    # connection.
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS messages (
+        session TEXT NOT NULL,
+        log TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        body TEXT NOT NULL,
+        PRIMARY KEY (session, log, seq)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS log_seq (
+        session TEXT NOT NULL,
+        log TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        PRIMARY KEY (session, log)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS session_values (
+        session TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (session, key)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS sessions (
+        session TEXT PRIMARY KEY,
+        written REAL NOT NULL
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS sessions_written ON sessions (written);
+    """
+
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self.local = threading.local()
+        self.next_sweep = 0
+        self.expired = 0
+        self.sweep_lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn().executescript(self.SCHEMA)
+        # Sessions from before the sessions table start their TTL now.
+        with self._transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO sessions (session, written) '
+                         'SELECT session, ? FROM (SELECT session FROM messages UNION '
+                         'SELECT session FROM session_values)', (time.time(),))
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def _transaction(self):
+        return _Transaction(self._conn())
+
+    def _touch(self, conn, session_id):
+        # Inside the caller's transaction.
+        conn.execute('INSERT INTO sessions (session, written) VALUES (?, ?) '
+                     'ON CONFLICT (session) DO UPDATE SET written = excluded.written', (session_id, time.time()))
+
+    def _maybe_sweep(self):
+        if not self.ttl:
+            return
+        with self.sweep_lock:
+            now = time.time()
+            if now < self.next_sweep:
+                return
+            self.next_sweep = now + SWEEP_SECONDS
+        self.sweep()
+
+    def sweep(self):
+        # Every worker sweeps; deleting the same sessions twice is harmless.
+        if not self.ttl:
+            return
+        cutoff = time.time() - self.ttl
+        with self._transaction() as conn:
+            expired = 'SELECT session FROM sessions WHERE written < ?'
+            for table in ('messages', 'log_seq', 'session_values'):
+                conn.execute(f'DELETE FROM {table} WHERE session IN ({expired})', (cutoff,))
+            count = conn.execute('DELETE FROM sessions WHERE written < ?', (cutoff,)).rowcount
+        with self.sweep_lock:
+            self.expired += count
+
+    def append(self, session_id, log, message):
+        # The sequence counter lives in its own table so trimmed logs never
+        # hand out a number twice; BEGIN IMMEDIATE serializes writers across
+        # processes.
+        with self._transaction() as conn:
+            conn.execute('INSERT INTO log_seq (session, log, seq) VALUES (?, ?, 1) '
+                         'ON CONFLICT (session, log) DO UPDATE SET seq = seq + 1', (session_id, log))
+            (seq,) = conn.execute('SELECT seq FROM log_seq WHERE session = ? AND log = ?',
+                                  (session_id, log)).fetchone()
+            conn.execute('INSERT INTO messages (session, log, seq, body) VALUES (?, ?, ?, ?)',
+                         (session_id, log, seq, json.dumps(message)))
+            self._touch(conn, session_id)
+        self._maybe_sweep()
+        return seq
+
+    def read(self, session_id, log, after=0):
+        conn = self._conn()
+        rows = conn.execute('SELECT seq, body FROM messages WHERE session = ? AND log = ? AND seq > ? ORDER BY seq',
+                            (session_id, log, after)).fetchall()
+        return [(seq, json.loads(body)) for seq, body in rows]
+
+    def trim(self, session_id, log, upto):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM messages WHERE session = ? AND log = ? AND seq <= ?', (session_id, log, upto))
+
+    def clear_log(self, session_id, log):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM messages WHERE session = ? AND log = ?', (session_id, log))
+
+    def get(self, session_id, key, default=None):
+        conn = self._conn()
+        row = conn.execute('SELECT value FROM session_values WHERE session = ? AND key = ?',
+                           (session_id, key)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set(self, session_id, key, value):
+        with self._transaction() as conn:
+            conn.execute('INSERT INTO session_values (session, key, value) VALUES (?, ?, ?) '
+                         'ON CONFLICT (session, key) DO UPDATE SET value = excluded.value',
+                         (session_id, key, json.dumps(value)))
+            self._touch(conn, session_id)
+        self._maybe_sweep()
+
+    def delete(self, session_id, key):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM session_values WHERE session = ? AND key = ?', (session_id, key))
+
+    def stats(self):
+        conn = self._conn()
+        (sessions,) = conn.execute('SELECT COUNT(*) FROM (SELECT session FROM messages UNION '
+                                   'SELECT session FROM session_values)').fetchone()
+        (messages,) = conn.execute('SELECT COUNT(*) FROM messages').fetchone()
+        return {'backend': 'sqlite', 'path': self.path, 'sessions': sessions, 'messages': messages,
+                'ttl': self.ttl, 'expired': self.expired}
+
+
+class _Transaction:
+    # `with store._transaction() as conn:` runs the block in BEGIN IMMEDIATE
+    # ... COMMIT, rolling back on error.
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+class MessageLog(list):
+    # A session log as a plain list, for code that appends to a history
+    # list. append() also writes the message to the store.
+
+    def __init__(self, store, session_id, log):
+        super().__init__(message for _, message in store.read(session_id, log))
+        self.store = store
+        self.session_id = session_id
+        self.log = log
+
+    def append(self, message):
+        self.store.append(self.session_id, self.log, message)
+        super().append(message)
+
+
+def create_store(url, ttl=None):
+    if not url or url == 'memory':
+        return MemoryStore(ttl)
+    if url.startswith('sqlite:///'):
+        return SQLiteStore(url[len('sqlite:///'):], ttl)
+    raise ValueError(f'Unsupported SESSION_STORE: {url}')
+
+
+store = create_store(os.environ.get('SESSION_STORE', 'memory'), SESSION_TTL)
@@ -13,7 +13,7 @@ def get_tools_with_triggers(action_type, available_triggers):
                                 "trigger": {
                                     "type": "string",
                                     "description": f"The trigger to send. Possible values are: {', '.join(map(str, available_triggers))}",
-                                    "enum": available_triggers
+                                    "enum": list(available_triggers)
                                 }
                             },
                             "required": ["trigger"]
@@ -46,6 +46,33 @@ Response Format:
 {response_format}
 """
 
+# The prefix-stable layout splits the system message in two: a preamble that
+# is the same for every state and goes first, and the state instructions that
+# go after the history. The start of the prompt then stays byte-identical
+# across state transitions and Ollama can reuse its KV cache for it.
+SHARED_SYSTEM_MESSAGE = """
+You are part of a tool development process managed by a state machine. Your role is to assist in developing a tool based on user requirements. The current state and its instructions are given in the system message right before the latest user message. Follow the instructions of that latest state only and adhere to its response format strictly.
+
+Required Action:
+- If action_type is 'task': Perform the task described in the Expected Behavior.
+- If action_type is 'classification': Respond ONLY with one of the Available Actions. DO NOT FORGET the underscore. Do not include any explanation.
+"""
+
+STATE_MESSAGE_TEMPLATE = """
+Current State: {current_state}
+State Description: {state_description}
+
+Available Actions: {available_actions}
+
+Action Type: {action_type}
+
+Expected Behavior:
+{expected_behavior}
+
+Response Format:
+{response_format}
+"""
+
 STATE_DESCRIPTIONS_DICT = {
     #############################
     # REQUIREMENT PROPOSAL STATE
@@ -479,24 +506,146 @@ Respond ONLY with:
     },
 }
 
-def extract_trigger(response):
-    valid_triggers = [
-                  'propose_design',
-                  'refine_design',
-                  'propose_refined_design',
-                  'implement_design',
-                  'eval_script',
-                  'results_met_expectations',
-                  'results_not_met_expectations',
-                  'iterate',
-                  'summarize_development',
-                  'refine_tool',
-                  'end_tool_crafting',
-                  'new_project']
+def extract_trigger(response, valid_triggers):
     response = response.strip().lower()
     if response in valid_triggers:
         return response
     else:
         raise ValueError(f"Invalid trigger: {response}")
 
-      
\ No newline at end of file
+
+ACTION_TYPES = ('task', 'classification')
+
+
+def as_tuple(names):
+    if not names:
+        return ()
+    return (names,) if isinstance(names, str) else tuple(names)
+
+
+class SharedMachine:
+    # Base for models driven by a shared StateMachineSpec instead of a
+    # transitions.Machine per object. The instance only holds `state`; the
+    # transition table lives on the class, and bind_spec() adds one method per
+    # trigger, so `process.implement_design()` works as before.
+
+    __slots__ = ('state',)
+    spec = None
+
+    def trigger(self, name):
+        # Returns True if a transition was taken and False if every candidate
+        # was blocked by its conditions.
+        candidates = self.spec.table.get((self.state, name))
+        if candidates is None:
+            raise ValueError(f"Can't trigger event {name} from state {self.state}!")
+        for dest, conditions, unless in candidates:
+            if all(getattr(self, check)() for check in conditions) and not any(getattr(self, check)() for check in unless):
+                self.state = dest
+                return True
+        return False
+
+    @classmethod
+    def bind_spec(cls, spec):
+        cls.spec = spec
+        for name in spec.valid_triggers:
+            if name in vars(cls):
+                raise ValueError(f"Trigger {name} would shadow {cls.__name__}.{name}")
+            setattr(cls, name, trigger_method(name))
+
+
+def trigger_method(name):
+    def fire(self):
+        return self.trigger(name)
+    fire.__name__ = name
+    return fire
+
+
+class StateMachineSpec:
+    # Everything about the state machine that does not depend on a session,
+    # computed once: triggers per state, the rendered system messages for both
+    # prompt layouts, the tool schemas and the set of valid triggers. All
+    # sessions share one instance, so none of it may be mutated.
+
+    def __init__(self, states, transitions, descriptions):
+        self.states = tuple(states)
+        self.transitions = tuple(transitions)
+        self.descriptions = descriptions
+        self.validate()
+
+        triggers = {state: [] for state in self.states}
+        for transition in self.transitions:
+            if transition['trigger'] not in triggers[transition['source']]:
+                triggers[transition['source']].append(transition['trigger'])
+        self.triggers = {state: tuple(names) for state, names in triggers.items()}
+        self.valid_triggers = frozenset(t['trigger'] for t in self.transitions)
+
+        # (source, trigger) -> dest for transitions whose destination does not
+        # depend on conditions, i.e. where the next state is known up front.
+        self.destinations = {}
+        conditional = set()
+        for transition in self.transitions:
+            key = (transition['source'], transition['trigger'])
+            if transition.get('conditions') or transition.get('unless') or key in self.destinations:
+                conditional.add(key)
+            self.destinations[key] = transition['dest']
+        for key in conditional:
+            del self.destinations[key]
+
+        # (source, trigger) -> ((dest, conditions, unless), ...) in definition
+        # order. The first candidate whose conditions hold is taken, as in
+        # transitions.Machine.
+        table = {}
+        for transition in self.transitions:
+            table.setdefault((transition['source'], transition['trigger']), []).append((
+                transition['dest'],
+                as_tuple(transition.get('conditions')),
+                as_tuple(transition.get('unless')),
+            ))
+        self.table = {key: tuple(candidates) for key, candidates in table.items()}
+
+        self.action_types = {}
+        self.system_messages = {}
+        self.state_messages = {}
+        self.tools = {}
+        for state in self.states:
+            info = descriptions[state]
+            fields = dict(
+                current_state=state,
+                state_description=info['description'],
+                available_actions=', '.join(self.triggers[state]),
+                action_type=info['action_type'],
+                expected_behavior=info['expected_behavior'],
+                response_format=info['response_format'],
+            )
+            self.action_types[state] = info['action_type']
+            self.system_messages[state] = SYSTEM_MESSAGE_TEMPLATE.format(**fields)
+            self.state_messages[state] = STATE_MESSAGE_TEMPLATE.format(**fields)
+            self.tools[state] = get_tools_with_triggers(info['action_type'], self.triggers[state])
+
+    def validate(self):
+        errors = []
+        states = set(self.states)
+        if states != set(self.descriptions):
+            errors.append(f"states without descriptions: {sorted(states - set(self.descriptions))}, "
+                          f"descriptions without states: {sorted(set(self.descriptions) - states)}")
+        for transition in self.transitions:
+            for end in ('source', 'dest'):
+                if transition[end] not in states:
+                    errors.append(f"transition {transition['trigger']} has unknown {end} {transition[end]}")
+        for state in self.states:
+            info = self.descriptions.get(state)
+            if info is None:
+                continue
+            if info['action_type'] not in ACTION_TYPES:
+                errors.append(f"{state} has unknown action_type {info['action_type']}")
+            if info['action_type'] == 'classification':
+                # A classification state can only answer with the triggers the
+                # machine accepts, so the prompt must list exactly those.
+                triggers = {t['trigger'] for t in self.transitions if t['source'] == state}
+                if not triggers:
+                    errors.append(f"classification state {state} has no outgoing triggers")
+                elif triggers != set(info['available_actions']):
+                    errors.append(f"{state} lists available_actions {sorted(info['available_actions'])} "
+                                  f"but the transitions accept {sorted(triggers)}")
+        if errors:
+            raise ValueError("Inconsistent state machine definition:\n  " + "\n  ".join(errors))
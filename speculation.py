@@ -0,0 +1,130 @@
+import contextvars
+import queue
+import threading
+from collections import defaultdict
+
+import telemetry
+
+# Prior guesses for the trigger a classification state will pick. Once a state
+# has been observed, the most frequent trigger seen so far is used instead.
+PRIORS = {
+    'review': 'implement_design',
+    'script_execution_evaluation': 'results_met_expectations',
+    'final_review': 'end_tool_crafting',
+}
+
+stats_lock = threading.Lock()
+observed = defaultdict(lambda: defaultdict(int))  # state -> trigger -> count
+speculation_stats = defaultdict(lambda: {'started': 0, 'hits': 0, 'misses': 0, 'wasted_tokens': 0})
+
+
+def predict(state, triggers):
+    with stats_lock:
+        counts = observed.get(state)
+        if counts:
+            return max(counts, key=counts.get)
+    prior = PRIORS.get(state)
+    return prior if prior in triggers else None
+
+
+def observe(state, trigger):
+    with stats_lock:
+        observed[state][trigger] += 1
+
+
+class SpeculativeCall:
+    # Runs a streamed LLM call in the background for the state we expect to
+    # enter next. Chunks are buffered in a queue, so a committed speculation
+    # can be consumed like a live stream, including the part that is already
+    # done. cancel() stops reading and closes the upstream stream.
+
+    def __init__(self, state, trigger, next_state, messages, call):
+        self.state = state
+        self.trigger = trigger
+        self.next_state = next_state
+        self.messages = messages
+        self.call = call
+
+        self.chunks = queue.Queue()
+        self.cancelled = threading.Event()
+        self.streamed_chunks = 0
+        self.final = None
+        self.done = threading.Event()
+        self.waste_recorded = False
+
+        with stats_lock:
+            speculation_stats[state]['started'] += 1
+        # The call keeps the caller's telemetry labels and trace.
+        self.thread = threading.Thread(target=contextvars.copy_context().run, args=(self._run,), daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        # Labelled with the state the call was made for.
+        with telemetry.labelled(state=self.next_state):
+            self._prefetch()
+
+    def _prefetch(self):
+        stream = None
+        try:
+            stream = self.call(self.messages)
+            if self.cancelled.is_set():
+                return
+            for chunk in stream:
+                if self.cancelled.is_set():
+                    break
+                self.streamed_chunks += 1
+                if chunk.get('done'):
+                    self.final = chunk
+                self.chunks.put(chunk)
+        except Exception as e:
+            self.chunks.put(e)
+        finally:
+            if stream is not None and hasattr(stream, 'close'):
+                stream.close()
+            self.chunks.put(None)
+            self.done.set()
+            if self.cancelled.is_set():
+                self._record_waste()
+
+    def commit(self):
+        with stats_lock:
+            speculation_stats[self.state]['hits'] += 1
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def cancel(self):
+        # Does not wait: a running worker stops at its next chunk and records
+        # the tokens it generated as wasted when it exits.
+        self.cancelled.set()
+        with stats_lock:
+            speculation_stats[self.state]['misses'] += 1
+        if self.done.is_set():
+            self._record_waste()
+
+    def _record_waste(self):
+        # The final chunk has Ollama's own counts. A call stopped before it
+        # only has the chunks seen so far; Ollama streams about one token per
+        # chunk, and the prompt evaluation it already did goes uncounted.
+        if self.final is not None:
+            wasted = (self.final.get('eval_count') or 0) + (self.final.get('prompt_eval_count') or 0)
+        else:
+            wasted = self.streamed_chunks
+        with stats_lock:
+            if self.waste_recorded:
+                return
+            self.waste_recorded = True
+            speculation_stats[self.state]['wasted_tokens'] += wasted
+
+
+def stats():
+    with stats_lock:
+        result = {}
+        for state, values in speculation_stats.items():
+            decided = values['hits'] + values['misses']
+            result[state] = dict(values, hit_rate=values['hits'] / decided if decided else None)
+        return result
@@ -1,7 +1,9 @@
 // app.js
 
 const supportedCommands = ["\\clipboard+"];
-let clipboardQueue = [];
+let clipboardQueue = [];  // clip texts, oldest first
+let clipboardIds = [];    // server ids of the clips, parallel to clipboardQueue
+let editedClipIds = new Set();  // server ids of clips edited in the detailed view
 let highLevelView = true;
 let craftToolHighLevelView = true;
 
@@ -27,13 +29,16 @@ $(document).ready(function () {
     console.log(purified_prompt);
 
     $.post("/generate", { prompt: purified_prompt }, function (data) {
-      if (data.status === 'streaming') {
-        $('#status').text('Generating response...');
+      if (data.status === 'streaming' || data.status === 'queued') {
+        $('#status').text(data.status === 'queued' ? `Queued at position ${data.position}...` : 'Generating response...');
         $('#response').html('<pre></pre>');
         accumulatedResponse = ''; 
       }
     }).fail(function (error) {
       console.error("Error:", error);
+      if (error.status === 429) {
+        $('#status').text(error.responseJSON.error);
+      }
     });
   });
 
@@ -41,6 +46,7 @@ $(document).ready(function () {
   // Existing socket event listeners
   socket.on('response_chunk', function (data) {
     console.log("Received chunk:", data.chunk);
+    $('#status').text('Generating response...');
     accumulatedResponse += data.chunk;
     renderMarkdown(accumulatedResponse);
   });
@@ -50,6 +56,14 @@ $(document).ready(function () {
     $('#status').text('');
   });
 
+  // A newer prompt or a cleared history stopped the reply
+  socket.on('response_cancelled', function (data) {
+    console.log('Response cancelled:', data.reason);
+    if (data.reason !== 'resubmit') {
+      $('#status').text('');
+    }
+  });
+
   $("#craft-tools-form").on("submit", function (event) {
     event.preventDefault();
     if (craftToolHighLevelView) {
@@ -73,11 +87,34 @@ $(document).ready(function () {
       },
       error: function (error) {
         console.error("Error:", error);
-        $('#craft-response').text("Error occurred while processing the request.");
+        if (error.status === 429) {
+          $('#craft-state').text(error.responseJSON.state);
+          $('#craft-response').text(error.responseJSON.response);
+        } else {
+          $('#craft-response').text("Error occurred while processing the request.");
+        }
       }
     });
   });
   
+  // Progress of a running craft request: streamed task output and state changes
+  let craftStreamState = null;
+  let craftAccumulated = '';
+
+  socket.on('tool_chunk', function (data) {
+    if (data.state !== craftStreamState) {
+      craftStreamState = data.state;
+      craftAccumulated = '';
+    }
+    craftAccumulated += data.chunk;
+    $('#craft-response').html(marked.parse(craftAccumulated));
+  });
+
+  socket.on('tool_step', function (data) {
+    console.log("Craft step:", data.state, "->", data.next_state, data.output || '');
+    $('#craft-state').text(data.description);
+  });
+
   socket.on('tool_response', function(data) {
     console.log("Received tool response:", data);
     if (data) {
@@ -91,6 +128,13 @@ $(document).ready(function () {
     }
 });
 
+  socket.on('tool_cancelled', function (data) {
+    console.log("Craft request cancelled:", data.reason);
+    if (data.reason !== 'resubmit') {
+      $('#craft-state').text('cancelled');
+    }
+  });
+
   // Ensure socket.io connection is established
   socket.on('disconnect', (reason) => {
     console.log(`Disconnected: ${reason}`);
@@ -121,15 +165,35 @@ socket.on('connect', () => {
   $("#clear-queue-btn").on("click", function () {
     $.post("/clear_queue", function (data) {
       clipboardQueue = [];
+      clipboardIds = [];
+      editedClipIds.clear();
       updateClipboardQueue();
     }).fail(function (error) {
       console.error("Error:", error);
     });
   });
 
-  // Socket event for clipboard update
-  socket.on('update_clipboard', function (data) {
-    clipboardQueue = data;
+  // Clipboard events: the full list once per connection, then deltas
+  socket.on('clipboard_snapshot', function (clips) {
+    clipboardQueue = clips.map(clip => clip.text);
+    clipboardIds = clips.map(clip => clip.id);
+    editedClipIds.clear();
+    updateClipboardQueue();
+  });
+
+  socket.on('clipboard_delta', function (delta) {
+    if (delta.op === 'append') {
+      clipboardQueue.push(delta.text);
+      clipboardIds.push(delta.id);
+    } else if (delta.op === 'evict') {
+      const evicted = new Set(delta.ids);
+      clipboardQueue = clipboardQueue.filter((_, index) => !evicted.has(clipboardIds[index]));
+      clipboardIds = clipboardIds.filter(id => !evicted.has(id));
+    } else if (delta.op === 'clear') {
+      clipboardQueue = [];
+      clipboardIds = [];
+      editedClipIds.clear();
+    }
     updateClipboardQueue();
   });
 
@@ -377,15 +441,21 @@ function getTextUpToCursor(node) {
 }
 
 
+// Clips go back to their \clipboard+N placeholders, which the server expands
+// from its own copy within the prompt's token budgets. Only a clip edited in
+// the detailed view is sent as text, since the server has not seen the edit.
 function reverseTransformation(lowLevelContent) {
   const parser = new DOMParser();
   const doc = parser.parseFromString(lowLevelContent, 'text/html');
   const editableElements = doc.querySelectorAll('.editable');
 
   editableElements.forEach(element => {
+    const id = element.getAttribute('data-id');
+    const index = clipboardQueue.length - parseInt(id, 10);
     const textContent = element.firstChild.nodeValue;
+    const edited = editedClipIds.has(clipboardIds[index]) || textContent.trim() !== (clipboardQueue[index] || '').trim();
 
-    lowLevelContent = lowLevelContent.replace(element.outerHTML, textContent);
+    lowLevelContent = lowLevelContent.replace(element.outerHTML, edited ? textContent : `\\clipboard+${id}`);
   });
 
   const purifiedContent = lowLevelContent.replace(/<\/?[^>]+(>|$)/g, "");
@@ -411,7 +481,11 @@ function convertToHighLevel(prompt) {
   editableElements.forEach(element => {
     const id = element.getAttribute('data-id');
     const text = element.innerText.replace(/\d+$/, '').trim();
-    clipboardQueue[clipboardQueue.length - parseInt(id, 10)] = text;
+    const index = clipboardQueue.length - parseInt(id, 10);
+    if (text !== (clipboardQueue[index] || '').trim()) {
+      editedClipIds.add(clipboardIds[index]);
+    }
+    clipboardQueue[index] = text;
     prompt = prompt.replace(element.outerHTML, `\\clipboard+${id}`);
   });
 
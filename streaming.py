@@ -0,0 +1,54 @@
+import time
+
+# Default frame limits: a frame is sent when either this much time has passed
+# since the last frame or this many bytes are waiting, whichever comes first.
+FLUSH_INTERVAL = 0.03
+FLUSH_BYTES = 256
+
+
+class ChunkCoalescer:
+    # Collects streamed tokens for a single session and emits them to that
+    # session's room in frames instead of one websocket message per token.
+    #
+    # The first token of a stream is sent immediately so time-to-first-token
+    # is not delayed; later tokens are grouped until FLUSH_INTERVAL or
+    # FLUSH_BYTES is reached. Call close() at the end to send the remainder.
+
+    def __init__(self, socketio, event, room, key='chunk', extra=None,
+                 interval=FLUSH_INTERVAL, max_bytes=FLUSH_BYTES):
+        self.socketio = socketio
+        self.event = event
+        self.room = room
+        self.key = key
+        self.extra = extra or {}
+        self.interval = interval
+        self.max_bytes = max_bytes
+
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.last_flush = 0.0
+        self.frames = 0
+
+    def push(self, text):
+        if not text:
+            return
+        self.buffer.append(text)
+        self.buffered_bytes += len(text.encode('utf-8'))
+
+        now = time.monotonic()
+        if self.buffered_bytes >= self.max_bytes or now - self.last_flush >= self.interval:
+            self.flush(now)
+
+    def flush(self, now=None):
+        if not self.buffer:
+            return
+        payload = dict(self.extra)
+        payload[self.key] = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.last_flush = now if now is not None else time.monotonic()
+        self.frames += 1
+        self.socketio.emit(self.event, payload, to=self.room)
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,359 @@
+import contextvars
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+# Metrics in the Prometheus text format, plus per-session trace spans.
+#
+# Everything recorded is labelled from the current context: background tasks
+# wrap their work in labelled(route=..., session=...) and the craft engine adds
+# the state of the step it is running. Code inside a Flask request that has no
+# route label gets the request's URL rule. Context variables do not follow
+# work into new threads, so threads that should keep the labels are started
+# with contextvars.copy_context().run.
+
+TRACE_MAX_SESSIONS = int(os.environ.get('TRACE_MAX_SESSIONS', 1000))
+TRACE_MAX_SPANS = int(os.environ.get('TRACE_MAX_SPANS', 2000))
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+TOKEN_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+current_labels = contextvars.ContextVar('telemetry_labels', default={})
+current_span = contextvars.ContextVar('telemetry_span', default=None)
+
+
+@contextmanager
+def labelled(**labels):
+    token = current_labels.set(dict(current_labels.get(), **labels))
+    try:
+        yield
+    finally:
+        current_labels.reset(token)
+
+
+def label(name):
+    value = current_labels.get().get(name)
+    if value is None and name == 'route':
+        try:
+            from flask import has_request_context, request
+            if has_request_context():
+                value = request.url_rule.rule if request.url_rule else 'unmatched'
+        except ImportError:
+            pass
+    return 'none' if value is None else str(value)
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) if name in labels else label(name) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.append(f'{self.name}{format_labels(self.labelnames, key)} {format_value(value)}')
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, help, labelnames=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [count per bucket..., count over the last bucket, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        if value is None:
+            return
+        key = tuple(str(labels[name]) if name in labels else label(name) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            items = sorted((key, list(counts)) for key, counts in self.values.items())
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="%s"' % format_value(float(bound))
+                lines.append(f'{self.name}_bucket{format_labels(self.labelnames, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, key)} {format_value(counts[-1])}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+
+class Gauge:
+    # Read when the metrics are rendered: `collect()` returns
+    # [(label values, value)] from a component's own counters.
+
+    def __init__(self, name, help, labelnames, collect):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        for key, value in self.collect():
+            lines.append(f'{self.name}{format_labels(self.labelnames, key)} {format_value(value)}')
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=SECONDS_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, labelnames, collect):
+        return self.register(Gauge(name, help, labelnames, collect))
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class Span:
+
+    def __init__(self, name, session_id, parent, attributes):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.session_id = session_id
+        self.parent = parent
+        self.attributes = attributes
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        return {'id': self.id, 'parent': self.parent, 'name': self.name, 'start': self.start,
+                'duration': self.duration, 'attributes': self.attributes, 'error': self.error}
+
+
+class Tracer:
+    # Finished spans of the most recently active sessions, newest last. A
+    # session keeps its last `max_spans` spans.
+
+    def __init__(self, max_sessions=TRACE_MAX_SESSIONS, max_spans=TRACE_MAX_SPANS):
+        self.max_sessions = max_sessions
+        self.max_spans = max_spans
+        self.sessions = OrderedDict()  # session -> deque of span dicts
+        self.lock = threading.Lock()
+
+    def start(self, name, **attributes):
+        # Starts a span without making it current, for work such as a streamed
+        # LLM call that is consumed piecemeal by its caller; finish it with end().
+        parent = current_span.get()
+        return Span(name, current_labels.get().get('session'), parent.id if parent else None, attributes)
+
+    def end(self, span, error=None):
+        span.duration = time.perf_counter() - span.started
+        if error is not None:
+            span.error = f'{type(error).__name__}: {error}'
+        if span.session_id is None:
+            return
+        with self.lock:
+            spans = self.sessions.get(span.session_id)
+            if spans is None:
+                spans = self.sessions[span.session_id] = deque(maxlen=self.max_spans)
+                while len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+            self.sessions.move_to_end(span.session_id)
+            spans.append(span.to_dict())
+
+    @contextmanager
+    def span(self, name, **attributes):
+        span = self.start(name, **attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            current_span.reset(token)
+            self.end(span, error=e)
+            raise
+        current_span.reset(token)
+        self.end(span)
+
+    def dump(self, session_id):
+        with self.lock:
+            spans = list(self.sessions.get(session_id, ()))
+        return {'session': session_id, 'spans': spans}
+
+    def forget(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def stats(self):
+        with self.lock:
+            return {'sessions': len(self.sessions), 'spans': sum(len(spans) for spans in self.sessions.values())}
+
+
+registry = Registry()
+tracer = Tracer()
+
+LLM_LABELS = ('model', 'route', 'state')
+llm_requests = registry.counter(
+    'llm_requests_total', 'LLM calls by outcome (ok, error, cancelled, closed before the end).',
+    LLM_LABELS + ('outcome',))
+llm_queue_seconds = registry.histogram(
+    'llm_queue_seconds', 'Time spent waiting for a model concurrency slot.', ('model', 'route'))
+llm_request_seconds = registry.histogram(
+    'llm_request_seconds', 'Wall time of the call once it has a slot.', LLM_LABELS)
+llm_first_token_seconds = registry.histogram(
+    'llm_time_to_first_token_seconds', 'Time from sending a streamed call to its first chunk.', LLM_LABELS)
+llm_total_seconds = registry.histogram(
+    'llm_total_duration_seconds', 'Ollama total_duration.', LLM_LABELS)
+llm_load_seconds = registry.histogram(
+    'llm_load_duration_seconds', 'Ollama load_duration (model loading).', LLM_LABELS)
+llm_prompt_eval_seconds = registry.histogram(
+    'llm_prompt_eval_duration_seconds', 'Ollama prompt_eval_duration.', LLM_LABELS)
+llm_eval_seconds = registry.histogram(
+    'llm_eval_duration_seconds', 'Ollama eval_duration (generation).', LLM_LABELS)
+llm_prompt_tokens = registry.histogram(
+    'llm_prompt_eval_tokens', 'Ollama prompt_eval_count.', LLM_LABELS, TOKEN_BUCKETS)
+llm_eval_tokens = registry.histogram(
+    'llm_eval_tokens', 'Ollama eval_count.', LLM_LABELS, TOKEN_BUCKETS)
+llm_reclaimed_seconds = registry.counter(
+    'llm_reclaimed_seconds_total', 'Estimated model time saved by cancelled calls: the mean time of completed '
+    'calls with the same labels, less the time the cancelled call ran.', LLM_LABELS)
+
+craft_step_seconds = registry.histogram(
+    'craft_step_seconds', 'Duration of one process_interaction step.', ('state', 'action_type', 'outcome'))
+craft_interaction_seconds = registry.histogram(
+    'craft_interaction_seconds', 'Duration of a whole process_interaction call.', ('route',))
+script_seconds = registry.histogram(
+    'script_seconds', 'Script run time.', ('runner', 'status'))
+script_queue_seconds = registry.histogram(
+    'script_queue_seconds', 'Time spent waiting for a script worker.', ('runner',))
+scripts_reused = registry.counter(
+    'scripts_reused_total', 'Script runs answered from a memoized result.', ('language',))
+
+OLLAMA_DURATIONS = (
+    ('total_duration', llm_total_seconds),
+    ('load_duration', llm_load_seconds),
+    ('prompt_eval_duration', llm_prompt_eval_seconds),
+    ('eval_duration', llm_eval_seconds),
+)
+
+
+class LLMCall:
+    # Measures one call to the model: created once the call has its slot,
+    # given every chunk (or the whole response) as it arrives and ended
+    # exactly once, whether the call finished, failed, was cancelled or was
+    # closed early.
+
+    completed = {}  # label values -> [calls, seconds] of the calls that finished
+    completed_lock = threading.Lock()
+
+    def __init__(self, model, queued_seconds, stream):
+        self.model = model
+        self.stream = stream
+        self.labels = {'model': model, 'route': label('route'), 'state': label('state')}
+        self.started = time.perf_counter()
+        self.first_chunk = None
+        self.final = None
+        self.span = tracer.start('llm', model=model, stream=stream, queued_seconds=queued_seconds)
+        llm_queue_seconds.observe(queued_seconds, model=model, route=self.labels['route'])
+
+    def chunk(self, chunk):
+        if self.first_chunk is None:
+            self.first_chunk = time.perf_counter()
+        if chunk.get('done') or not self.stream:
+            self.final = chunk
+
+    def end(self, error=None, cancelled=False):
+        if cancelled:
+            outcome = 'cancelled'
+        elif error is not None:
+            outcome = 'error'
+        elif self.final is None:
+            outcome = 'closed'
+        else:
+            outcome = 'ok'
+        seconds = time.perf_counter() - self.started
+        key = tuple(self.labels.values())
+        with self.completed_lock:
+            if outcome == 'ok':
+                totals = self.completed.setdefault(key, [0, 0.0])
+                totals[0] += 1
+                totals[1] += seconds
+            elif outcome == 'cancelled' and key in self.completed:
+                calls, total = self.completed[key]
+                llm_reclaimed_seconds.inc(max(total / calls - seconds, 0.0), **self.labels)
+        llm_requests.inc(outcome=outcome, **self.labels)
+        llm_request_seconds.observe(seconds, **self.labels)
+        if self.stream and self.first_chunk is not None:
+            llm_first_token_seconds.observe(self.first_chunk - self.started, **self.labels)
+        fields = {}
+        if self.final is not None:
+            for field, histogram in OLLAMA_DURATIONS:
+                value = self.final.get(field)
+                if value is not None:
+                    fields[field] = value / 1e9
+                    histogram.observe(value / 1e9, **self.labels)
+            for field, histogram in (('prompt_eval_count', llm_prompt_tokens), ('eval_count', llm_eval_tokens)):
+                value = self.final.get(field)
+                if value is not None:
+                    fields[field] = value
+                    histogram.observe(value, **self.labels)
+        self.span.set(outcome=outcome, state=self.labels['state'], **fields)
+        if self.first_chunk is not None:
+            self.span.set(first_chunk_seconds=self.first_chunk - self.started)
+        tracer.end(self.span, error=error)
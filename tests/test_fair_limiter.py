@@ -0,0 +1,131 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from cancellation import CancelToken, Cancelled
+from llm_client import FairLimiter
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.001)
+
+
+def queue_waiter(limiter, key, granted, token=None):
+    # Starts a thread that waits for a slot and records `key` once it has
+    # one; returns after the thread has joined the queue.
+    queued = limiter.queued()
+
+    def wait():
+        try:
+            limiter.acquire(key, token)
+        except Cancelled:
+            granted.append(('cancelled', key))
+            return
+        granted.append(key)
+
+    thread = threading.Thread(target=wait, daemon=True)
+    thread.start()
+    wait_until(lambda: limiter.queued() == queued + 1)
+    return thread
+
+
+def test_never_exceeds_limit():
+    limiter = FairLimiter(3)
+    peak = 0
+    lock = threading.Lock()
+
+    def work(key):
+        nonlocal peak
+        limiter.acquire(key)
+        try:
+            with lock:
+                peak = max(peak, limiter.active)
+            time.sleep(0.005)
+        finally:
+            limiter.release()
+
+    threads = [threading.Thread(target=work, args=(f'session-{i % 4}',)) for i in range(24)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak == 3
+    assert limiter.active == 0
+    assert limiter.queued() == 0
+
+
+def test_slots_go_round_robin_across_sessions():
+    limiter = FairLimiter(1)
+    limiter.acquire('holder')
+    granted = []
+    threads = [queue_waiter(limiter, key, granted) for key in ('a', 'a', 'a', 'b', 'c')]
+
+    for count in range(1, len(threads) + 1):
+        limiter.release()
+        wait_until(lambda: len(granted) == count)
+    # 'a' queued three requests first, but 'b' and 'c' each get a turn before
+    # its second one.
+    assert granted == ['a', 'b', 'c', 'a', 'a']
+    limiter.release()
+    assert limiter.active == 0
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    limiter = FairLimiter(1)
+    limiter.acquire('holder')
+    granted = []
+    token = CancelToken('a', 'chat')
+    cancelled = queue_waiter(limiter, 'a', granted, token)
+    other = queue_waiter(limiter, 'b', granted)
+
+    token.cancel('test')
+    cancelled.join(5)
+    assert granted == [('cancelled', 'a')]
+    assert limiter.queued() == 1
+
+    limiter.release()
+    other.join(5)
+    assert granted[-1] == 'b'
+    limiter.release()
+    assert limiter.active == 0
+
+
+def test_threads_and_coroutines_share_one_cap():
+    limiter = FairLimiter(1)
+    limiter.acquire('thread')
+
+    async def main():
+        waiter = asyncio.create_task(limiter.acquire_async('task'))
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        assert limiter.queued() == 1
+        threading.Timer(0.01, limiter.release).start()
+        await asyncio.wait_for(waiter, 5)
+        assert limiter.active == 1
+        limiter.release()
+
+    asyncio.run(main())
+    assert limiter.active == 0
+
+
+def test_cancelled_task_gives_back_its_place():
+    limiter = FairLimiter(1)
+    limiter.acquire('thread')
+
+    async def main():
+        waiter = asyncio.create_task(limiter.acquire_async('task'))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    asyncio.run(main())
+    assert limiter.queued() == 0
+    limiter.release()
+    assert limiter.active == 0
@@ -0,0 +1,162 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from llm_cache import ResponseCache, stream_chunks
+
+
+def response(content):
+    return {'model': 'm', 'message': {'role': 'assistant', 'content': content}, 'done': True}
+
+
+def test_concurrent_identical_calls_share_one_upstream_call():
+    cache = ResponseCache()
+    key = cache.key('m', [{'role': 'user', 'content': 'hi'}], options={'temperature': 0})
+    calls = []
+    results = []
+
+    def call():
+        calls.append(1)
+        time.sleep(0.05)
+        return response('hello')
+
+    def ask():
+        results.append(cache.get_or_call(key, call))
+
+    threads = [threading.Thread(target=ask) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(hit for _, hit in results) == [False] + [True] * 7
+    assert all(value['message']['content'] == 'hello' for value, _ in results)
+    stats = cache.stats()
+    assert stats['misses'] == 1
+    assert stats['coalesced'] == 7
+
+
+def test_waiter_takes_over_when_the_leader_fails():
+    cache = ResponseCache()
+    started = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    def failing_call():
+        started.set()
+        release.wait()
+        raise RuntimeError('upstream failed')
+
+    def lead():
+        try:
+            cache.get_or_call('k', failing_call)
+        except RuntimeError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    started.wait()
+    follower_result = []
+    follower = threading.Thread(target=lambda: follower_result.append(
+        cache.get_or_call('k', lambda: response('second try'))))
+    follower.start()
+    time.sleep(0.02)
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert len(errors) == 1
+    assert follower_result == [(response('second try'), False)]
+
+
+def test_threads_and_coroutines_share_a_flight():
+    cache = ResponseCache()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def blocking_call():
+        calls.append('thread')
+        started.set()
+        release.wait()
+        return response('from thread')
+
+    leader = threading.Thread(target=cache.get_or_call, args=('k', blocking_call))
+    leader.start()
+    started.wait()
+
+    async def coroutine_call():
+        calls.append('coroutine')
+        return response('from coroutine')
+
+    async def main():
+        waiter = asyncio.create_task(cache.aget_or_call('k', coroutine_call))
+        await asyncio.sleep(0.02)
+        release.set()
+        return await asyncio.wait_for(waiter, 5)
+
+    value, hit = asyncio.run(main())
+    leader.join()
+    assert calls == ['thread']
+    assert hit
+    assert value['message']['content'] == 'from thread'
+
+
+def test_memory_tier_evicts_least_recently_used():
+    size = len(json.dumps(response('x' * 100)))
+    cache = ResponseCache(max_bytes=size * 2)
+    cache.put('a', response('x' * 100))
+    cache.put('b', response('x' * 100))
+    cache.get('a')
+    cache.put('c', response('x' * 100))
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.stats()['evictions'] == 1
+
+
+def test_disk_tier_is_bounded_and_survives_restart(tmp_path):
+    size = len(json.dumps(response('x' * 100)))
+    cache = ResponseCache(max_bytes=0, cache_dir=str(tmp_path), disk_max_bytes=size * 2)
+    for key in ('aa1', 'bb2', 'cc3'):
+        cache.put(key, response('x' * 100))
+        time.sleep(0.01)
+    files = sorted(name for _, _, names in os.walk(tmp_path) for name in names)
+    assert files == ['bb2.json', 'cc3.json']
+    assert cache.stats()['disk_evictions'] == 1
+
+    reopened = ResponseCache(cache_dir=str(tmp_path), disk_max_bytes=size * 2)
+    assert reopened.get('cc3')['message']['content'] == 'x' * 100
+    assert reopened.stats()['disk_hits'] == 1
+
+
+def test_stream_chunks_rebuild_the_response():
+    stored = dict(response('Hello there,\n  world!'), eval_count=5)
+    chunks = stream_chunks(stored)
+    assert len(chunks) > 2
+    assert all(not chunk['done'] for chunk in chunks[:-1])
+    assert ''.join(chunk['message']['content'] for chunk in chunks) == stored['message']['content']
+    assert chunks[-1]['done'] and chunks[-1]['eval_count'] == 5
+
+
+@pytest.mark.parametrize('options, cached', [({'temperature': 0}, True), ({'temperature': 0.7}, False), (None, False)])
+def test_only_deterministic_calls_are_cached(options, cached):
+    from llm_client import LLMClient
+
+    class FakeClient:
+        def __init__(self):
+            self.calls = 0
+
+        def chat(self, model, messages, stream=False, **kwargs):
+            self.calls += 1
+            return response('reply')
+
+    llm = LLMClient(cache=ResponseCache())
+    llm.client = FakeClient()
+    for _ in range(2):
+        llm.chat('m', [{'role': 'user', 'content': 'hi'}], options=options)
+    assert llm.client.calls == (1 if cached else 2)
@@ -0,0 +1,113 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from scheduler import AsyncScheduler, QueueFull, Scheduler
+
+LANES = {
+    'chat': {'priority': 0, 'max_queue': 3, 'max_running': None},
+    'craft': {'priority': 1, 'max_queue': 2, 'max_running': 1},
+}
+
+
+def start_thread(target):
+    threading.Thread(target=target, daemon=True).start()
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.001)
+
+
+def test_full_lane_rejects_without_blocking():
+    workers = []
+    scheduler = Scheduler(workers.append, workers=1, lanes=LANES)  # workers never start
+    for _ in range(LANES['craft']['max_queue']):
+        scheduler.submit('craft', lambda: None)
+    with pytest.raises(QueueFull):
+        scheduler.submit('craft', lambda: None)
+    # Each lane has its own bound.
+    scheduler.submit('chat', lambda: None)
+    stats = scheduler.stats()
+    assert stats['craft']['rejected'] == 1
+    assert stats['craft']['depth'] == 2
+    assert stats['chat']['depth'] == 1
+
+
+def test_submit_reports_jobs_ahead():
+    scheduler = Scheduler(lambda worker: None, workers=2, lanes=LANES)
+    assert [scheduler.submit('chat', lambda: None) for _ in range(3)] == [0, 0, 1]
+    # Craft jobs queue behind every chat job, and only one may run at once.
+    assert scheduler.submit('craft', lambda: None) == 3
+
+
+def test_higher_priority_lane_runs_first():
+    scheduler = Scheduler(start_thread, workers=1, lanes=LANES)
+    gate = threading.Event()
+    order = []
+    scheduler.submit('chat', gate.wait)
+    wait_until(lambda: scheduler.stats()['chat']['running'] == 1)
+
+    scheduler.submit('craft', lambda: order.append('craft'))
+    scheduler.submit('chat', lambda: order.append('chat'))
+    gate.set()
+    wait_until(lambda: len(order) == 2)
+    assert order == ['chat', 'craft']
+
+
+def test_max_running_keeps_workers_for_chat():
+    scheduler = Scheduler(start_thread, workers=2, lanes=LANES)
+    gate = threading.Event()
+    done = threading.Event()
+    scheduler.submit('craft', gate.wait)
+    scheduler.submit('craft', gate.wait)
+    wait_until(lambda: scheduler.stats()['craft']['running'] == 1)
+
+    scheduler.submit('chat', done.set)
+    assert done.wait(5)
+    assert scheduler.stats()['craft']['depth'] == 1
+    gate.set()
+    wait_until(lambda: scheduler.stats()['craft']['completed'] == 2)
+
+
+def test_failed_job_does_not_stop_the_worker(capsys):
+    scheduler = Scheduler(start_thread, workers=1, lanes=LANES)
+    done = threading.Event()
+    scheduler.submit('chat', lambda: 1 / 0)
+    scheduler.submit('chat', done.set)
+    assert done.wait(5)
+    wait_until(lambda: scheduler.stats()['chat']['completed'] == 1)
+    assert scheduler.stats()['chat']['failed'] == 1
+    assert 'ZeroDivisionError' in capsys.readouterr().err
+
+
+def test_async_scheduler_runs_by_priority():
+    async def main():
+        scheduler = AsyncScheduler(workers=1, lanes=LANES)
+        gate = asyncio.Event()
+        order = []
+
+        def job(name):
+            async def run():
+                order.append(name)
+            return run
+
+        scheduler.submit('chat', gate.wait)
+        await asyncio.sleep(0)
+        scheduler.submit('craft', job('craft'))
+        scheduler.submit('chat', job('chat'))
+        gate.set()
+        for _ in range(100):
+            if len(order) == 2:
+                break
+            await asyncio.sleep(0.01)
+        assert order == ['chat', 'craft']
+        for task in scheduler.tasks:
+            task.cancel()
+
+    asyncio.run(main())
@@ -0,0 +1,63 @@
+import copy
+
+import pytest
+from transitions import Machine, MachineError
+
+from craft_sm import SPEC, STATE_DESCRIPTIONS_DICT, TRANSITIONS, ToolCraftingProcess
+from sm_utils import StateMachineSpec
+
+
+class LegacyProcess:
+    # The model as it was before the shared engine: a transitions.Machine per
+    # instance, built from the same transition list.
+
+    max_iterations = ToolCraftingProcess.max_iterations
+
+    def __init__(self, state, iteration_count):
+        self.iteration_count = iteration_count
+        Machine(model=self, states=ToolCraftingProcess.states, transitions=copy.deepcopy(TRANSITIONS), initial=state)
+
+    def max_iterations_reached(self):
+        return self.iteration_count >= self.max_iterations
+
+
+def outcome(process, trigger):
+    try:
+        getattr(process, trigger)()
+    except (MachineError, ValueError):
+        return 'invalid'
+    return process.state
+
+
+@pytest.mark.parametrize('iteration_count', [0, ToolCraftingProcess.max_iterations])
+@pytest.mark.parametrize('state', ToolCraftingProcess.states)
+def test_every_trigger_matches_transitions_machine(state, iteration_count):
+    for trigger in sorted(SPEC.valid_triggers):
+        legacy = LegacyProcess(state, iteration_count)
+        process = ToolCraftingProcess('test')
+        process.state = state
+        process.iteration_count = iteration_count
+        assert outcome(process, trigger) == outcome(legacy, trigger), (state, trigger)
+
+
+def test_available_triggers_match_transitions_machine():
+    machine = Machine(model=LegacyProcess.__new__(LegacyProcess), states=ToolCraftingProcess.states,
+                      transitions=copy.deepcopy(TRANSITIONS), initial='requirement_proposal')
+    for state in ToolCraftingProcess.states:
+        assert set(SPEC.triggers[state]) == set(machine.get_triggers(state)) - {f'to_{s}' for s in machine.states}
+
+
+def test_shared_tables_cannot_be_changed_through_a_session():
+    process = ToolCraftingProcess('test')
+    process.state = 'review'
+    assert isinstance(process.get_triggers(), tuple)
+    enum = SPEC.tools['review'][0]['function']['parameters']['properties']['trigger']['enum']
+    enum.append('injected')
+    assert 'injected' not in process.get_triggers()
+
+
+def test_spec_rejects_prompts_that_disagree_with_the_transitions():
+    descriptions = copy.deepcopy(STATE_DESCRIPTIONS_DICT)
+    descriptions['review']['available_actions'] = ['implement_design']
+    with pytest.raises(ValueError, match='review'):
+        StateMachineSpec(ToolCraftingProcess.states, TRANSITIONS, descriptions)
@@ -0,0 +1,256 @@
+import importlib
+import itertools
+import json
+import os
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+
+# A zygote is a long-lived Python process that has already imported the
+# modules crafted tools usually need. Every run is a fresh fork of it, so a
+# script starts with warm imports and copy-on-write memory, and nothing one
+# run does is visible to the next.
+#
+# Protocol over a Unix socket, one connection per run:
+#   client -> zygote: 4-byte length (with the stdout/stderr pipe fds attached)
+#                     followed by a JSON request {code, argv, cwd, limits}
+#   zygote -> client: JSON lines {"pid": ...} and then {"returncode": ...}
+
+MAXFD = os.sysconf('SC_OPEN_MAX')
+DEFAULT_PRELOAD = os.environ.get('ZYGOTE_PRELOAD', 'json,re,os,sys,csv,math,datetime,pathlib,subprocess,urllib.request')
+HEADER = struct.Struct('!I')
+# A client sends its whole request at once; one that stalls is dropped.
+REQUEST_TIMEOUT = 5
+
+
+def recv_exactly(conn, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('zygote connection closed')
+        data += chunk
+    return bytes(data)
+
+
+def run_child(request, out_fd, err_fd, apply_limits):
+    # Runs in the forked child and never returns. The child keeps only its
+    # stdin/stdout/stderr: the zygote's listening socket and the pipes of
+    # other runs it is serving must not be reachable from the script.
+    code = 1
+    try:
+        os.setsid()
+        apply_limits(request['limits'])()
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(out_fd, 1)
+        os.dup2(err_fd, 2)
+        os.closerange(3, MAXFD)
+        if request.get('cwd'):
+            os.chdir(request['cwd'])
+        sys.argv = ['<crafted>'] + list(request.get('argv', []))
+        try:
+            exec(compile(request['code'], '<crafted>', 'exec'), {'__name__': '__main__', '__builtins__': __builtins__})
+            code = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except BaseException as e:
+            # Skip our own frame so the traceback starts in the script.
+            traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+            code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def start_run(conn, server, apply_limits):
+    # Reads one request and forks its run; returns the child's pid.
+    conn.settimeout(REQUEST_TIMEOUT)
+    header, fds, _, _ = socket.recv_fds(conn, HEADER.size, 2)
+    (length,) = HEADER.unpack(header)
+    out_fd, err_fd = fds
+    try:
+        request = json.loads(recv_exactly(conn, length))
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            server.close()
+            run_child(request, out_fd, err_fd, apply_limits)
+    finally:
+        os.close(out_fd)
+        os.close(err_fd)
+    return pid
+
+
+def serve(socket_path, preload):
+    # The zygote is single-threaded, so a fork never copies a lock that
+    # another thread holds (the import lock, stdio buffers, logging). One
+    # selector loop accepts runs, notices the app going away (EOF on our stdin,
+    # which is its pipe) and reports runs that ended, through their pidfds.
+    from executor import apply_limits
+
+    for name in preload:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            print(f'zygote: could not preload {name}: {e}', file=sys.stderr)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(64)
+
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ, 'accept')
+    selector.register(sys.stdin.fileno(), selectors.EVENT_READ, 'parent')
+
+    print('ready', flush=True)
+    while True:
+        for key, _ in selector.select():
+            if key.data == 'accept':
+                conn, _ = server.accept()
+                try:
+                    pid = start_run(conn, server, apply_limits)
+                except (OSError, ValueError, struct.error):
+                    conn.close()
+                    continue
+                selector.register(os.pidfd_open(pid), selectors.EVENT_READ, (conn, pid))
+                try:
+                    conn.sendall(json.dumps({'pid': pid}).encode() + b'\n')
+                except OSError:
+                    pass  # Still reaped when it exits.
+            elif key.data == 'parent':
+                if not os.read(key.fd, 4096):
+                    os._exit(0)
+            else:
+                conn, pid = key.data
+                selector.unregister(key.fd)
+                os.close(key.fd)
+                _, status = os.waitpid(pid, 0)
+                try:
+                    conn.sendall(json.dumps({'returncode': os.waitstatus_to_exitcode(status)}).encode() + b'\n')
+                except OSError:
+                    pass  # The client gave up on the run.
+                conn.close()
+
+
+class ReplyReader:
+    # Reads the zygote's JSON lines. A read that times out can be retried,
+    # which is how the caller waits with a wall-clock limit.
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.buffer = b''
+
+    def read(self, timeout=None):
+        self.conn.settimeout(timeout)
+        while b'\n' not in self.buffer:
+            chunk = self.conn.recv(4096)
+            if not chunk:
+                raise ConnectionError('zygote connection closed')
+            self.buffer += chunk
+        line, _, self.buffer = self.buffer.partition(b'\n')
+        return json.loads(line)
+
+    def close(self):
+        self.conn.close()
+
+
+class ZygotePool:
+    # Starts `processes` zygotes on first use and spreads runs across them.
+    # A zygote that has died, or that cannot be reached, is started again
+    # and the run retried once.
+
+    def __init__(self, processes=1, preload=None):
+        self.processes = processes
+        self.preload = preload if preload is not None else [m for m in DEFAULT_PRELOAD.split(',') if m]
+        self.zygotes = []
+        self.cycle = None
+        self.lock = threading.Lock()
+        self.directory = None
+        self.restarts = 0
+
+    def start(self):
+        with self.lock:
+            if self.zygotes:
+                return
+            self.directory = tempfile.mkdtemp(prefix='zygote-')
+            for index in range(self.processes):
+                path = os.path.join(self.directory, f'{index}.sock')
+                self.zygotes.append((self._launch(path), path))
+            self.cycle = itertools.cycle(range(self.processes))
+
+    def _launch(self, path):
+        proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), path, ','.join(self.preload)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        proc.stdout.readline()  # 'ready' once the preloads are imported
+        return proc
+
+    def _restart(self, index, proc):
+        # Replaces zygote `index` unless another caller already has.
+        with self.lock:
+            current, path = self.zygotes[index]
+            if current is not proc:
+                return current, path
+            proc.kill()
+            proc.wait()
+            if os.path.exists(path):
+                os.unlink(path)
+            self.zygotes[index] = (self._launch(path), path)
+            self.restarts += 1
+            return self.zygotes[index]
+
+    def spawn(self, code, out_fd, err_fd, limits, argv=(), cwd=None):
+        # Forks a run and returns (reply reader, pid). The reader delivers
+        # the return code once the run is over.
+        self.start()
+        with self.lock:
+            index = next(self.cycle)
+            proc, path = self.zygotes[index]
+        payload = json.dumps({'code': code, 'argv': list(argv), 'cwd': cwd, 'limits': limits}).encode()
+        if proc.poll() is not None:
+            proc, path = self._restart(index, proc)
+        try:
+            return self._request(path, payload, out_fd, err_fd)
+        except OSError:
+            proc, path = self._restart(index, proc)
+            return self._request(path, payload, out_fd, err_fd)
+
+    def _request(self, path, payload, out_fd, err_fd):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(path)
+            socket.send_fds(conn, [HEADER.pack(len(payload))], [out_fd, err_fd])
+            conn.sendall(payload)
+            replies = ReplyReader(conn)
+            return replies, replies.read()['pid']
+        except BaseException:
+            conn.close()
+            raise
+
+    def stats(self):
+        with self.lock:
+            return {'zygotes': len(self.zygotes), 'restarts': self.restarts, 'preload': self.preload}
+
+    def close(self):
+        with self.lock:
+            for proc, _ in self.zygotes:
+                proc.kill()
+            self.zygotes = []
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1], [m for m in sys.argv[2].split(',') if m])